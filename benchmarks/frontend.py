@@ -0,0 +1,175 @@
+""" Times the front end (lexing with includes, macro expansion and C++ code
+    generation) on synthetic programs of growing size and prints how each
+    phase scales, see generate.py for the programs.
+
+    Between two sizes a phase scales as size ** exponent, so an exponent
+    near 1 is linear and near 2 is quadratic. The run fails if a phase
+    grows faster than --max-exponent between the two biggest sizes.
+
+    python benchmarks/frontend.py
+    python benchmarks/frontend.py --sizes 1M 2M 4M 8M -o frontend.json """
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from generate import MAIN_FILENAME, generate, parse_size
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, ROOT_DIR)
+
+import pang
+
+PHASES = ["lex", "expand", "program", "codegen"]
+
+# Phases faster than this (in seconds) are too noisy to work out an exponent
+NOISE_FLOOR = 0.05
+
+def front_end(filename: str, optimise: bool, phase_done) -> tuple[int, int]:
+    """ Runs every phase on filename, calling phase_done with the name of
+        each phase as it finishes. Returns the number of tokens before and
+        after macro expansion. """
+    with open(filename, "r", encoding="utf-8") as file:
+        lexer = pang.Lexer(file.read(), MAIN_FILENAME)
+
+    lexer.get_tokens_without_macros()
+    phase_done("lex")
+    tokens = len(lexer.toks)
+
+    lexer.expand_macros()
+    phase_done("expand")
+
+    program = pang.Program(lexer.toks)
+    phase_done("program")
+
+    pang.compile_ops(program, optimise)
+    phase_done("codegen")
+
+    return tokens, len(program)
+
+def measure(filename: str, optimise: bool, repeat: int) -> dict:
+    """ Fastest time of each phase over repeat runs, then the peak memory
+        each phase allocated on top of what it started with """
+    times = {phase: math.inf for phase in PHASES}
+    peaks = {}
+
+    for run in range(repeat + 1):
+        # Included files would come from the token cache after the first run
+        shutil.rmtree(pang.TOKEN_CACHE_DIR, ignore_errors=True)
+
+        # tracemalloc slows everything down, so memory has a run of its own
+        tracing = run == repeat
+        last = [perf_counter(), 0]
+
+        if tracing:
+            tracemalloc.start()
+
+        def phase_done(phase: str) -> None:
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                peaks[phase] = peak - last[1]
+                last[1] = current
+                tracemalloc.reset_peak()
+            else:
+                now = perf_counter()
+                times[phase] = min(times[phase], now - last[0])
+                last[0] = now
+
+        tokens, expanded = front_end(filename, optimise, phase_done)
+
+        if tracing:
+            tracemalloc.stop()
+
+    return {
+        "size": sum(os.path.getsize(name) for name in os.listdir(".") if name.endswith(".pang")),
+        "tokens": tokens,
+        "expanded": expanded,
+        "times": times,
+        "peaks": peaks,
+    }
+
+def exponent(small: dict, big: dict, key: str, phase: str) -> float:
+    """ How fast phase grew between two results, None if it was too fast to tell """
+    if key == "times" and small[key][phase] < NOISE_FLOOR:
+        return None
+
+    if small[key][phase] <= 0 or big[key][phase] <= 0:
+        return None
+
+    return math.log(big[key][phase] / small[key][phase]) / math.log(big["size"] / small["size"])
+
+def report(results: list[dict]) -> None:
+    print("%10s %10s %10s  %s" % ("size", "tokens", "expanded", "  ".join("%18s" % phase for phase in PHASES)))
+
+    for index, result in enumerate(results):
+        print("%8.2fMB %10d %10d  %s" % (result["size"] / (1 << 20), result["tokens"], result["expanded"], "  ".join(
+            "%8.3fs %7.1fMB" % (result["times"][phase], result["peaks"][phase] / (1 << 20)) for phase in PHASES)))
+
+        if index:
+            print("%32s  %s" % ("exponent", "  ".join("%9s %8s" % tuple(
+                "-" if value is None else "%.2f" % value
+                for value in (exponent(results[index - 1], result, key, phase) for key in ("times", "peaks")))
+                for phase in PHASES)))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Times how the pang front end scales with the size of the source.")
+    parser.add_argument("-s", "--sizes", nargs="+", type=parse_size, default=[parse_size(size) for size in ("256K", "512K", "1M", "2M", "4M")], help="source sizes, e.g. 512K or 4M")
+    parser.add_argument("-n", "--repeat", type=int, default=2, help="runs at every size, the fastest is kept")
+    parser.add_argument("-O", "--optimise", action="store_true", help="use the optimise pass of compile_ops")
+    parser.add_argument("--includes", type=int, default=32, help="number of included files")
+    parser.add_argument("--depth", type=int, default=16, help="macros in each chain of nested expansions")
+    parser.add_argument("--string-length", type=int, default=256, help="characters in each string literal")
+    parser.add_argument("--max-exponent", type=float, default=1.5, help="growth that fails, 1 is linear and 2 quadratic")
+    parser.add_argument("-o", "--output", help="where to write the results as JSON")
+    options = parser.parse_args()
+
+    results = []
+
+    for size in sorted(options.sizes):
+        with tempfile.TemporaryDirectory() as directory:
+            generate(directory, size, options.includes, options.depth, string_length=options.string_length)
+
+            # Included files are found relative to the working directory
+            cwd = os.getcwd()
+            os.chdir(directory)
+
+            try:
+                results.append(measure(MAIN_FILENAME, options.optimise, options.repeat))
+            finally:
+                os.chdir(cwd)
+
+    report(results)
+
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+
+    if len(results) < 2:
+        return
+
+    found = []
+
+    for phase in PHASES:
+        for key, name in (("times", "time"), ("peaks", "memory")):
+            value = exponent(results[-2], results[-1], key, phase)
+
+            if value is not None and value > options.max_exponent:
+                found.append("%s %s grows as size ** %.2f" % (phase, name, value))
+
+    if found:
+        print("\nFront end scaling past size ** %.2f:" % options.max_exponent)
+        print("\n".join("  " + line for line in found))
+        sys.exit(1)
+
+    print("\nNo phase scales past size ** %.2f." % options.max_exponent)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+""" Writes synthetic pang programs for the front end benchmark: thousands
+    of macros in chains that expand into each other, long string literals
+    and a tree of included files, padded out to a given size.
+
+    The programs only use built in keywords (no std.pang) and are meant to
+    be lexed and compiled, not run.
+
+    python benchmarks/generate.py out --size 4M
+    cd out && python ../pang.py main.pang -c -C -o main """
+
+import argparse
+import os
+
+MAIN_FILENAME = "main.pang"
+
+# Bodies of the macros at the bottom of each chain
+LEAF_BODIES = [
+    "1 add",
+    "dup 2 mul swap sub",
+    "dup 0 < while do 1 sub dup 0 < end",
+    "3 swap dup 7 = if do 1 add end swap",
+]
+
+# Characters repeated in the string literals, with a few escapes
+STRING_CHARS = "The quick brown fox jumps over the lazy dog \\n\\t\\\" "
+
+def parse_size(text: str) -> int:
+    """ 512K, 4M or a number of bytes """
+    multiplier = {"K": 1 << 10, "M": 1 << 20}.get(text[-1:].upper(), 1)
+    return int(float(text.rstrip("kKmM")) * multiplier)
+
+def chain(prefix: str, index: int, depth: int) -> str:
+    """ depth macros, each one expanding the one before it """
+    lines = ["macro %s_0 %s end" % (prefix, LEAF_BODIES[index % len(LEAF_BODIES)])]
+
+    for level in range(1, depth):
+        lines.append("macro %s_%d dup %d add %s_%d swap end" % (prefix, level, level, prefix, level - 1))
+
+    return "\n".join(lines) + "\n"
+
+def string_literal(length: int) -> str:
+    repeats = length // len(STRING_CHARS) + 1
+    return "\"%s\"" % (STRING_CHARS * repeats)[:length].rstrip("\\")
+
+def generate(directory: str, size: int, includes: int = 32, depth: int = 16, uses: int = 4, string_length: int = 256) -> str:
+    """ Writes a program of roughly size bytes to directory, returns the
+        path of its main file.
+
+        Every chain of depth macros goes in one of the included files and
+        its top macro is used uses times by the main file, which also gets
+        a string literal of string_length characters per chain. Each
+        included file includes the one before it, so most includes are of
+        files that have already been included. """
+    os.makedirs(directory, exist_ok=True)
+
+    libraries = [[] for _ in range(includes)]
+    body = []
+    written = 0
+    index = 0
+
+    while written < size:
+        prefix = "m%d" % index
+        macros = chain(prefix, index, depth)
+        code = "0 %s\n%s\n" % (" ".join(["%s_%d" % (prefix, depth - 1)] * uses), string_literal(string_length))
+
+        libraries[index % includes].append(macros)
+        body.append(code)
+
+        written += len(macros) + len(code)
+        index += 1
+
+    for number, macros in enumerate(libraries):
+        with open(os.path.join(directory, "lib%d.pang" % number), "w", encoding="utf-8") as file:
+            if number:
+                file.write("include \"lib%d.pang\"\n\n" % (number - 1))
+
+            file.write("".join(macros))
+
+    filename = os.path.join(directory, MAIN_FILENAME)
+
+    with open(filename, "w", encoding="utf-8") as file:
+        # Included files are found relative to the working directory
+        file.write("".join("include \"lib%d.pang\"\n" % number for number in reversed(range(includes))))
+        file.write("\n" + "".join(body))
+
+    return filename
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Writes a synthetic pang program for front end benchmarks.")
+    parser.add_argument("directory", help="where to write the program")
+    parser.add_argument("-s", "--size", type=parse_size, default=parse_size("1M"), help="total source size, e.g. 512K or 4M")
+    parser.add_argument("--includes", type=int, default=32, help="number of included files")
+    parser.add_argument("--depth", type=int, default=16, help="macros in each chain of nested expansions")
+    parser.add_argument("--uses", type=int, default=4, help="uses of each chain in the main file")
+    parser.add_argument("--string-length", type=int, default=256, help="characters in each string literal")
+    options = parser.parse_args()
+
+    filename = generate(options.directory, options.size, options.includes, options.depth, options.uses, options.string_length)
+    print("Written %s." % filename)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+""" Times pang workloads on the interpreter engines and as compiled binaries
+    (g++ -O1, -O2 and -O3, each with and without pang's own -O optimise pass
+    in compile_ops), writes the results as JSON and fails if a result is
+    slower than in a baseline file.
+
+    Workloads that finish quickly (most compiled ones take a few
+    milliseconds) are run several times in a row for every measurement,
+    so each measurement takes at least MIN_MEASURE_TIME.
+
+    python benchmarks/run.py -o results.json
+    python benchmarks/run.py --baseline results.json --threshold 0.1 """
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+PANG = os.path.join(ROOT_DIR, "pang.py")
+
+# Slowdowns smaller than this (in seconds) over a whole measurement, all
+# the runs timed together, are too noisy to call a regression
+NOISE_FLOOR = 0.005
+
+# Every measurement runs a workload enough times to take at least this long
+MIN_MEASURE_TIME = 0.1
+
+# Name: (program, arguments), "{big}" is replaced with the big input file
+WORKLOADS = {
+    "fib": ("tests/fib.pang", []),
+    "countloop": ("tests/countloop.pang", []),
+    "rot13": ("benchmarks/rot13.pang", []),
+    "strings": ("benchmarks/strings.pang", []),
+    "range": ("benchmarks/range.pang", []),
+    "subscript": ("benchmarks/subscript.pang", ["arg%d" % i for i in range(100)]),
+    "fread": ("benchmarks/fread.pang", ["{big}"]),
+}
+
+ENGINES = ["switch", "fused", "python"]
+LEVELS = ["-O1", "-O2", "-O3"]
+
+# Every target, compiled ones are named by the g++ level and whether
+# pang's optimise pass was used
+TARGETS = ENGINES + ["g++ %s" % level for level in LEVELS] + ["g++ %s optimise" % level for level in LEVELS]
+
+BIG_FILE_SIZE = 4 << 20
+
+def run(command: list[str], cwd: str) -> float:
+    """ Runs command, returns how long it took """
+    start = perf_counter()
+    result = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = perf_counter() - start
+
+    if result.returncode != 0:
+        # pang reports its errors on stdout, compiled programs on stderr
+        output = (result.stdout[-2000:] + result.stderr[-2000:]).decode(errors="replace")
+        raise RuntimeError("%s failed with exit code %d:\n%s" % (" ".join(command), result.returncode, output))
+
+    return elapsed
+
+def runs_per_measurement(command: list[str], cwd: str) -> int:
+    """ How many times command must run to take MIN_MEASURE_TIME, the run
+        it is worked out from also warms up the caches """
+    return max(1, math.ceil(MIN_MEASURE_TIME / run(command, cwd)))
+
+def make_big_file(directory: str) -> str:
+    filename = os.path.join(directory, "big.txt")
+    line = "The quick brown fox jumps over the lazy dog. 0123456789\n"
+
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(line * (BIG_FILE_SIZE // len(line)))
+
+    return filename
+
+def compile_workload(program: str, name: str, directory: str, targets: list[str]) -> dict[str, list[str]]:
+    """ Builds a binary for every compiled target, returns their commands """
+    commands = {}
+
+    for optimise in (False, True):
+        levels = [level for level in LEVELS if ("g++ %s%s" % (level, " optimise" if optimise else "")) in targets]
+
+        if not levels:
+            continue
+
+        # -C writes the C++ without compiling it, pang's -O flag turns on optimise
+        source = os.path.join(directory, "%s%s" % (name, "_opt" if optimise else ""))
+        subprocess.run(
+            [sys.executable, PANG, program, "-c", "-C", "-o", source] + (["-O1"] if optimise else []),
+            cwd=ROOT_DIR, stdout=subprocess.DEVNULL, check=True)
+
+        for level in levels:
+            binary = "%s%s" % (source, level)
+            subprocess.run(["g++", source + ".cc", "-o", binary, level, "-s"], cwd=directory, check=True)
+            commands["g++ %s%s" % (level, " optimise" if optimise else "")] = [binary]
+
+    return commands
+
+def bench(workloads: list[str], targets: list[str], repeat: int) -> dict[str, dict[str, dict[str, float]]]:
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        big = make_big_file(directory)
+
+        for name in workloads:
+            program, args = WORKLOADS[name]
+            args = [big if arg == "{big}" else arg for arg in args]
+
+            commands = {
+                # The program is passed as the first argument, like argv[0]
+                # of compiled programs
+                engine: [sys.executable, PANG, program, "-engine", engine, "-args", program]
+                for engine in ENGINES if engine in targets
+            }
+            commands.update(compile_workload(program, name, directory, targets))
+
+            results[name] = {}
+
+            for target in targets:
+                command = commands[target] + args
+                loops = runs_per_measurement(command, ROOT_DIR)
+                times = [sum(run(command, ROOT_DIR) for _ in range(loops)) / loops for _ in range(repeat)]
+                results[name][target] = {"min": min(times), "median": statistics.median(times), "loops": loops}
+
+                print("%-12s %-18s %10.4f s (%d runs)" % (name, target, min(times), loops), flush=True)
+
+    return results
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """ Describes every result more than threshold slower than in baseline """
+    found = []
+
+    for name, targets in results.items():
+        for target, result in targets.items():
+            old = baseline.get(name, {}).get(target)
+
+            if old is None:
+                continue
+
+            new_time = result["min"]
+            old_time = old["min"]
+
+            if new_time > old_time * (1 + threshold) and (new_time - old_time) * result.get("loops", 1) > NOISE_FLOOR:
+                found.append("%s (%s): %.4f s -> %.4f s (+%.0f%%)" % (
+                    name, target, old_time, new_time, 100 * (new_time / old_time - 1)))
+
+    return found
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Times pang workloads on the interpreter and compiled.")
+    parser.add_argument("-o", "--output", default=os.path.join(BENCH_DIR, "results.json"), help="where to write the results")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="runs of every workload, the fastest is kept")
+    parser.add_argument("-w", "--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("-t", "--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown that fails, 0.1 is 10%%")
+    options = parser.parse_args()
+
+    baseline = None
+
+    if options.baseline:
+        # Read before running, the output may overwrite it
+        with open(options.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)["results"]
+
+    results = bench(options.workloads, options.targets, options.repeat)
+
+    with open(options.output, "w", encoding="utf-8") as file:
+        json.dump({
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": options.repeat,
+            "results": results,
+        }, file, indent=4)
+
+    print("\nResults written to %s." % options.output)
+
+    if baseline is not None:
+        found = regressions(results, baseline, options.threshold)
+
+        if found:
+            print("\n%d regressions past %.0f%%:" % (len(found), 100 * options.threshold))
+            print("\n".join("  " + regression for regression in found))
+            sys.exit(1)
+
+        print("No regressions past %.0f%%." % (100 * options.threshold))
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,47 @@ if sys.version_info < (3, 6):
     print("DepreciationError: Please install a python version greater than 3.5.")
     exit(1)
 
-from time import perf_counter, sleep
+from time import perf_counter, perf_counter_ns, sleep
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Union
+from typing import Collection, Iterable, Iterator, Optional, Union
+from collections import deque
+from array import array
+from heapq import heappop, heappush
+from concurrent.futures import ProcessPoolExecutor
+import re
 import os
+import pickle
+import struct
+import hashlib
+import mmap
 
 MAX_PREALLOC = 1024
+TOKEN_CACHE_DIR = "__pangcache__"
+TOKEN_CACHE_VERSION = 1
+PARALLEL_LEX_MIN_SIZE = 1 << 19
+WATCH_INTERVAL = 0.25
+STREAM_CHUNK_SIZE = 1 << 20
+OUTPUT_FLUSH_SIZE = 1 << 16
+READ_CHUNK_SIZE = 1 << 16
+PROFILE_ROWS = 25
+BYTECODE_MAGIC = b"PANGC"
+BYTECODE_VERSION = 2
 PRE_ARGV_ALLOCATE = 32
+ENTRY_DEPTH = 1
+STACK_WIDEN_AFTER = 2
+CONSTANT_WINDOW = 16
 PANG_SYS = os.path.dirname(os.path.realpath(__file__)) + "\\"
 
 NEWLINE_SYSCALLS = [
+    0x001, 0x003,
     0x005, 0x006,
     0x007, 0x008,
-    0x012,
+    0x00A, 0x00D,
+    0x00F, 0x012,
+    0x013, 0x014,
+    0x015, 0x016,
+    0x017,
 ]
 
 try:
@@ -83,6 +110,9 @@ class TokenType(Enum):
     # Syscalls
     SYSCALL = auto()
 
+    # Only exists between scanning and resolving includes
+    INCLUDE = auto()
+
     # For undefined tokens
     NONE = auto()
 
@@ -121,10 +151,202 @@ keyword_map = {
     "syscall": TokenType.SYSCALL,
 }
 
+reverse_keyword_map = {
+    **{typ: raw for raw, typ in keyword_map.items()},
+    TokenType.DO: "do",
+    TokenType.END: "end",
+    TokenType.MACRO: "macro",
+    TokenType.EQUAL: "=",
+    TokenType.NOT_EQUAL: "!",
+    TokenType.GREATER_THAN: ">",
+    TokenType.SMALLER_THAN: "<",
+}
+
 def Croak(err_typ: ErrorType, msg: str):
+    # Output written by the program comes before the error
+    Output.flush_all()
     print("%sError: %s" % (err_typ._name_, msg))
     exit(1)
 
+# Compiled patterns used by the lexer, slices are taken from the source
+# instead of building up strings one character at a time.
+WHITESPACE_RE = re.compile(r"[ \t\n]*")
+IDENTIFIER_RE = re.compile(r"[_a-zA-Z0-9]*")
+NUMBER_RE = re.compile(r"[0-9]+")
+HEX_RE = re.compile(r"[0-9a-fA-F]*")
+
+IDENTIFIER_START = "_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+atom_map = {
+    "=": TokenType.EQUAL,
+    "!": TokenType.NOT_EQUAL,
+    ">": TokenType.GREATER_THAN,
+    "<": TokenType.SMALLER_THAN,
+}
+
+def token_cache_path(real_filename: str) -> str:
+    return os.path.join(
+        os.path.dirname(real_filename),
+        TOKEN_CACHE_DIR,
+        os.path.basename(real_filename) + ".tokens")
+
+def token_rows(toks: list[Token]) -> list[tuple]:
+    """ Tokens as plain tuples, so they do not depend on which module
+        (__main__ or pang) the Token class was pickled from. """
+    return [(tok.typ._name_, tok.raw, tok.value, tok.ln) for tok in toks]
+
+def rows_to_tokens(rows: list[tuple], filename: str) -> list[Token]:
+    return [Token(TokenType[typ], raw, value, filename, ln) for typ, raw, value, ln in rows]
+
+def read_include(filename: str) -> tuple[bytes, tuple]:
+    """ Returns the contents of an included file and its cache key """
+    real_filename = os.path.realpath(filename)
+
+    try:
+        data = open(real_filename, "rb").read()
+    except OSError:
+        Croak(ErrorType.File, "could not include file \"%s\"" % filename)
+
+    return data, (
+        TOKEN_CACHE_VERSION,
+        real_filename,
+        os.stat(real_filename).st_mtime_ns,
+        hashlib.sha256(data).hexdigest(),
+    )
+
+def load_cached_tokens(filename: str, key: tuple) -> Optional[list[Token]]:
+    try:
+        with open(token_cache_path(key[1]), "rb") as cache:
+            cached_key, rows = pickle.load(cache)
+
+        if cached_key == key:
+            return rows_to_tokens(rows, filename)
+    except (OSError, EOFError, ValueError, TypeError, KeyError, pickle.UnpicklingError):
+        # Missing or broken cache, lex the file again.
+        pass
+
+    return None
+
+def scan_include(filename: str, data: bytes, key: tuple) -> list[Token]:
+    """ Scans an included file and stores its tokens in __pangcache__ """
+    cache_filename = token_cache_path(key[1])
+
+    # Same newline translation as opening in text mode.
+    src = data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+    lexer = Lexer(src, filename)
+    lexer.scan()
+
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+
+        temp_filename = "%s.%d" % (cache_filename, os.getpid())
+
+        with open(temp_filename, "wb") as cache:
+            pickle.dump((key, token_rows(lexer.toks)), cache, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        # The cache is optional (e.g. read only install directory).
+        pass
+
+    return lexer.toks
+
+def lex_include(filename: str) -> list[Token]:
+    """ Scans an included file, reusing the tokens cached in __pangcache__
+        when the real path, mtime and contents of the file are unchanged. """
+    data, key = read_include(filename)
+    toks = load_cached_tokens(filename, key)
+
+    if toks is None:
+        toks = scan_include(filename, data, key)
+
+    return toks
+
+def lex_include_rows(filename: str) -> list[tuple]:
+    """ lex_include for worker processes """
+    return token_rows(lex_include(filename))
+
+def lex_include_tree(toks: list[Token], memo: Optional[dict] = None, skip: Collection[str] = ()) -> dict[str, list[Token]]:
+    """ Lexes every file included (directly or not) by toks, returning the
+        unresolved tokens of each file keyed on its real path.
+
+        The include graph is walked one level at a time. Files in a level do
+        not depend on each other, so when a level has enough uncached source
+        (and there is more than one cpu) it is lexed in a process pool.
+
+        memo maps real paths to (mtime, tokens), files that have not been
+        modified since they were added to it are not read again. Files in
+        skip (real paths) have already been included and are not lexed. """
+    lexed = {}
+    level = toks
+    pool = None
+
+    try:
+        while True:
+            pending = {}
+
+            for tok in level:
+                if tok.typ != TokenType.INCLUDE:
+                    continue
+
+                real_filename = os.path.realpath(tok.value)
+
+                if real_filename not in lexed and real_filename not in pending and real_filename not in skip:
+                    pending[real_filename] = tok.value
+
+            if not pending:
+                break
+
+            uncached = {}
+
+            for real_filename, filename in pending.items():
+                if memo is not None and real_filename in memo:
+                    mtime, memo_toks = memo[real_filename]
+
+                    if os.path.exists(real_filename) and os.stat(real_filename).st_mtime_ns == mtime:
+                        lexed[real_filename] = memo_toks
+                        continue
+
+                data, key = read_include(filename)
+                cached = load_cached_tokens(filename, key)
+
+                if cached is None:
+                    uncached[real_filename] = (filename, data, key)
+                else:
+                    lexed[real_filename] = cached
+
+                if memo is not None:
+                    memo[real_filename] = (key[2], cached)
+
+            uncached_size = sum(len(data) for _, data, _ in uncached.values())
+
+            if len(uncached) > 1 and uncached_size >= PARALLEL_LEX_MIN_SIZE and (os.cpu_count() or 1) > 1:
+                if pool is None:
+                    pool = ProcessPoolExecutor()
+
+                filenames = [filename for filename, _, _ in uncached.values()]
+
+                for real_filename, filename, rows in zip(uncached, filenames, pool.map(lex_include_rows, filenames)):
+                    lexed[real_filename] = rows_to_tokens(rows, filename)
+            else:
+                for real_filename, (filename, data, key) in uncached.items():
+                    lexed[real_filename] = scan_include(filename, data, key)
+
+            if memo is not None:
+                for real_filename in uncached:
+                    memo[real_filename] = (memo[real_filename][0], lexed[real_filename])
+
+            level = [tok for real_filename in pending for tok in lexed[real_filename]]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return lexed
+
+class NeedMoreSource(Exception):
+    """ Raised by a streaming lexer when a token reaches the end of the source fed so far """
+
 class Lexer():
     def __init__(self, src: str, filename: str = "N/A") -> None:
         self.index = 0
@@ -133,9 +355,44 @@ class Lexer():
         self.size = len(src)
         self.toks: list[Token] = []
         self.includes: list[str] = []
+        self.macros: dict[str, Macro] = {}
+        self.sites: list[Optional[Expansion]] = []
+
+        # Tokens of included files kept in memory by watch mode
+        self.include_memo: Optional[dict[str, tuple[int, list[Token]]]] = None
+
+        # Line tracking, newlines are counted once as the lexer moves forward.
+        self.ln_index = 0
+        self.ln_count = 0
+
+        # False while more source is still to be fed (see stream_tokens).
+        self.final = True
 
     def line(self, l_break: int) -> int:
-        return self.raw[:l_break].count("\n") + 1
+        if l_break < self.ln_index:
+            # Only used by errors that look back, no need to be fast.
+            return self.ln_count + 1 - self.raw.count("\n", l_break, self.ln_index)
+
+        self.ln_count += self.raw.count("\n", self.ln_index, l_break)
+        self.ln_index = l_break
+
+        return self.ln_count + 1
+
+    def need_more(self) -> None:
+        """ Called when a token runs into the end of the source. When the
+            source is being streamed, stops scanning until more is fed. """
+        if not self.final:
+            raise NeedMoreSource()
+
+    def feed(self, src: str, final: bool) -> None:
+        """ Drops the source that has been scanned and appends src to the rest """
+        self.line(self.index)
+        self.ln_index -= self.index
+
+        self.raw = self.raw[self.index:] + src
+        self.size = len(self.raw)
+        self.index = 0
+        self.final = final
 
     def _get(self) -> str:
         """ Returns current value and index++ """
@@ -154,19 +411,26 @@ class Lexer():
         return self.raw[self.index]
 
     def atom(self, tok_typ: TokenType) -> None:
-        self.toks.append(Token(tok_typ, self._peek(), self._get(), self.fn, self.line(self.index - 1)))
+        start = self.index
+        raw = self.raw[start]
+        self.index += 1
+
+        self.toks.append(Token(tok_typ, raw, raw, self.fn, self.line(start)))
 
     def num(self) -> None:
         start = self.index
-        raw = ""
+        self.index = NUMBER_RE.match(self.raw, start).end()
+        raw = self.raw[start:self.index]
 
-        while self._peek() and self._peek() in "1234567890":
-            raw += self._get()
+        if self.index == self.size:
+            self.need_more()
         
         if raw == "0" and self._peek() in ("x", "X"):
-            raw += self._get()
-            while self._peek() and self._peek() in "1234567890abcdefABCDEF":
-                raw += self._get()
+            self.index = HEX_RE.match(self.raw, self.index + 1).end()
+            raw = self.raw[start:self.index]
+
+            if self.index == self.size:
+                self.need_more()
             
             self.toks.append(Token(
                 TokenType.INT, raw, int(raw, 16),
@@ -178,56 +442,60 @@ class Lexer():
 
     def raw_string(self) -> None:
         start = self.index
-        raw = ""
-
-        # Add 1 to index to skip \" character
-        self.index += 1
 
-        while self._peek() != "\"":
-            raw += self._peek()
+        # Add 1 to start to skip \" character
+        close = self.raw.find("\"", start + 1)
 
-            if not self._get():
-                Croak(
-                    ErrorType.Syntax,
-                    "unterminated string literal in file \"%s\" (detected at line: %d)" % (
-                        self.fn, self.line(start)
-                    )
+        if close == -1:
+            self.need_more()
+            Croak(
+                ErrorType.Syntax,
+                "unterminated string literal in file \"%s\" (detected at line: %d)" % (
+                    self.fn, self.line(start)
                 )
+            )
+
+        raw = self.raw[start + 1:close]
 
         # Add 1 to index to skip \" character
-        self.index += 1
+        self.index = close + 1
 
         self.toks.append(Token(TokenType.STR, "\"%s\"" % raw, raw, self.fn, self.line(start)))
 
     def string(self) -> None:
         start = self.index
-        raw = ""
-
-        # Add 1 to index to skip \" character
-        self.index += 1
+        close = start
 
-        while self._peek() != "\"":
-            raw += self._peek()
+        while True:
+            close = self.raw.find("\"", close + 1)
 
-            if not self._get():
+            if close == -1:
+                self.need_more()
                 Croak(
                     ErrorType.Syntax,
                     "unterminated string literal in file \"%s\" (detected at line: %d)" % (
                         self.fn, self.line(start)
                     )
                 )
-            
-            if self._peek() == "\"" and not raw.endswith("\\\\") and raw[-1] == "\\":
-                raw += self._get()
+
+            raw = self.raw[start + 1:close]
+
+            # \" is part of the string, \\" is not
+            if not raw.endswith("\\") or raw.endswith("\\\\"):
+                break
 
         # Add 1 to index to skip \" character
-        self.index += 1
+        self.index = close + 1
 
         self.toks.append(Token(TokenType.STR, "\"%s\"" % raw, raw.encode("raw_unicode_escape").decode("unicode_escape"), self.fn, self.line(start)))
 
     def char(self) -> None:
         start = self.index
 
+        # A char always ends at the first \' after its value
+        if self.raw.find("\'", start + 2) == -1:
+            self.need_more()
+
         # Add 1 to index to skip \' character
         self.index += 1
 
@@ -241,16 +509,18 @@ class Lexer():
                 )
             )
         elif raw == "\\":
-            while self._peek() != "\'":
-                raw += self._peek()
+            close = self.raw.find("\'", self.index)
 
-                if not self._get():
-                    Croak(
-                        ErrorType.Syntax,
-                        "unterminated char literal in file \"%s\" (detected at line: %d)" % (
-                            self.fn, self.line(start)
-                        )
+            if close == -1:
+                Croak(
+                    ErrorType.Syntax,
+                    "unterminated char literal in file \"%s\" (detected at line: %d)" % (
+                        self.fn, self.line(start)
                     )
+                )
+
+            raw = self.raw[self.index - 1:close]
+            self.index = close
             
             raw = raw.encode("raw_unicode_escape").decode("unicode_escape")
         
@@ -267,25 +537,35 @@ class Lexer():
     def comment(self) -> None:
         self.index += 1
 
+        if self.index == self.size:
+            self.need_more()
+
         if self._peek() == "/":
-            while self._peek() != "\n":
-                if not self._get():
-                    break
+            close = self.raw.find("\n", self.index)
+
+            if close == -1:
+                self.need_more()
+
+            self.index = self.size if close == -1 else close
             return
         elif self._peek() == "*":
-            self.index += 1
-            while self._peek():
-                if self._get() + self._peek() == "*/":
-                    break
-            self.index += 1
+            close = self.raw.find("*/", self.index + 1)
+
+            if close == -1:
+                self.need_more()
+
+            self.index = self.size + 1 if close == -1 else close + 2
             return
         
         Croak(ErrorType.Syntax, "expected // or /* */ comment")
 
     def include_file(self) -> None:
-        while self._peek() in " \n\t":
-            if not self._get():
-                assert False, "Must include a file"
+        ln = self.line(self.index)
+        self.index = WHITESPACE_RE.match(self.raw, self.index).end()
+
+        if self.index >= self.size:
+            self.need_more()
+            assert False, "Must include a file"
 
         systemfile = self._peek() == "\'"
 
@@ -297,50 +577,72 @@ class Lexer():
                 )
             )
         
-        include_filename = self._get()
-
-        while (self._peek() != "\"" and not systemfile) or (self._peek() != "\'" and systemfile):
-            include_filename += self._peek()
+        close = self.raw.find("\'" if systemfile else "\"", self.index + 1)
 
-            if not self._get():
-                Croak(
-                    ErrorType.Syntax,
-                    "unterminated string literal in file \"%s\" (detected at line: %d)" % (
-                        self.fn, self.line(self.index)
-                    )
+        if close == -1:
+            self.need_more()
+            Croak(
+                ErrorType.Syntax,
+                "unterminated string literal in file \"%s\" (detected at line: %d)" % (
+                    self.fn, self.line(self.size)
                 )
+            )
+
+        include_filename = self.raw[self.index:close]
         
         # Add 1 to index to skip \" or \' character
-        self.index += 1
+        self.index = close + 1
 
         if systemfile:
             include_filename = PANG_SYS + include_filename
 
-        # skip as has already been included
-        if include_filename in self.includes:
-            return
+        # includes are resolved after scanning, see resolve_includes
+        self.toks.append(Token(TokenType.INCLUDE, include_filename, include_filename, self.fn, ln))
+
+    def resolve_includes(self) -> None:
+        self.toks = list(self.iter_resolved(self.toks))
+
+    def iter_resolved(self, toks: Iterable[Token]) -> Iterator[Token]:
+        """ Yields toks with include tokens replaced by the included tokens.
+            When toks is a list the whole include tree is lexed up front,
+            otherwise each include is lexed when it is reached. """
+        lexed = lex_include_tree(toks, self.include_memo) if isinstance(toks, list) else {}
+
+        yield from self.stitch_includes(toks, lexed)
+
+    def stitch_includes(self, toks: Iterable[Token], lexed: dict[str, list[Token]]) -> Iterator[Token]:
+        for tok in toks:
+            if tok.typ != TokenType.INCLUDE:
+                yield tok
+                continue
+
+            real_filename = os.path.realpath(tok.value)
+
+            # skip as has already been included
+            if real_filename in self.includes:
+                continue
 
-        new_toks = Lexer(open(include_filename, "r", encoding="utf-8").read(), include_filename)
-        new_toks.includes = self.includes
-        new_toks.get_tokens_without_macros()
+            if real_filename not in lexed:
+                lexed.update(lex_include_tree([tok], self.include_memo, self.includes))
 
-        self.includes.append(include_filename)
+            self.includes.append(real_filename)
 
-        self.toks += new_toks.toks
+            yield from self.stitch_includes(lexed[real_filename], lexed)
 
     def identifier(self) -> None:
         start = self.index
-        raw = self._get()
+        end = IDENTIFIER_RE.match(self.raw, start + 1).end()
+
+        if end == self.size:
+            self.need_more()
 
-        if raw == "r" and self._peek() == "\"":
+        if self.raw[start] == "r" and self.raw.startswith("\"", start + 1):
+            self.index += 1
             self.raw_string()
             return
 
-        while self._peek() in "_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789":
-            raw += self._peek()
-
-            if not self._get():
-                break
+        self.index = end
+        raw = self.raw[start:self.index]
         
         if raw == "macro":
             self.toks.append(Token(TokenType.MACRO, raw, raw, self.fn, self.line(start)))
@@ -355,66 +657,82 @@ class Lexer():
         else:
             self.toks.append(Token(TokenType.ID, raw, raw, self.fn, self.line(start)))
 
-    def get_tokens_without_macros(self) -> None:
-        while self._peek():
-            end = False
-            while self._peek() in " \t\n":
-                self.index += 1
+    def scan(self) -> None:
+        """ Lexes the source, leaving include tokens unresolved """
+        while self.index < self.size:
+            self.index = WHITESPACE_RE.match(self.raw, self.index).end()
 
-                if not self._peek():
-                    end = True
-                    break
-                
-            if end:
+            if self.index >= self.size:
                 break
             
-            current = self._peek()
-            
-            if current in "_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ":
-                self.identifier()
-            elif current in "1234567890":
-                self.num()
-            elif current == "\"":
-                self.string()
-            elif current == "\'":
-                self.char()
-            elif current == "/":
-                self.comment()
-            elif current == "=":
-                self.atom(TokenType.EQUAL)
-            elif current == "!":
-                self.atom(TokenType.NOT_EQUAL)
-            elif current == ">":
-                self.atom(TokenType.GREATER_THAN)
-            elif current == "<":
-                self.atom(TokenType.SMALLER_THAN)
-            else:
-                Croak(
-                    ErrorType.Syntax,
-                    "invalid character found in file \"%s\" (detected at line: %d): %c" % (
-                        self.fn, self.line(self.index), current
-                    )
+            start = self.index
+            current = self.raw[start]
+
+            try:
+                self.scan_token(current)
+            except NeedMoreSource:
+                # Scanned again once more source has been fed.
+                self.index = start
+                return
+
+    def scan_token(self, current: str) -> None:
+        if current in IDENTIFIER_START:
+            self.identifier()
+        elif current in "1234567890":
+            self.num()
+        elif current == "\"":
+            self.string()
+        elif current == "\'":
+            self.char()
+        elif current == "/":
+            self.comment()
+        elif current in atom_map:
+            self.atom(atom_map[current])
+        else:
+            Croak(
+                ErrorType.Syntax,
+                "invalid character found in file \"%s\" (detected at line: %d): %c" % (
+                    self.fn, self.line(self.index), current
                 )
+            )
     
+    def get_tokens_without_macros(self) -> None:
+        self.scan()
+        self.resolve_includes()
+
     def get_tokens(self) -> None:
         self.get_tokens_without_macros()
+        self.expand_macros()
+
+    def expand_macros(self) -> None:
+        toks = self.toks
 
-        macro_added_toks = []
-        macro = False
+        # Expanded tokens are shared with the macro bodies and are never
+        # modified, sites[i] is the expansion that toks[i] came from
+        # (None if it was not expanded from a macro).
+        self.toks = []
+        self.sites = []
+
+        for expanded_toks, sites in self.iter_expanded(toks):
+            self.toks += expanded_toks
+            self.sites += sites
+
+    def iter_expanded(self, toks: Iterable[Token]) -> Iterator[tuple[list[Token], list[Optional["Expansion"]]]]:
+        """ Collects macro definitions and expands the tokens outside of them
+            as toks is consumed, yielding (tokens, sites) in program order.
+
+            Macros can be used before they are defined, so tokens after a use
+            of an undefined macro are held back until it has been defined. """
+        held = deque()
         macro_name = False
         skip_end = 0
-        cur_name = ""
-        cur_tok = Token()
+        cur_tok = None
         cur_toks = []
-        macros = {}
+        self.macros = {}
 
-        # Add macros
-        for tok in self.toks:
-            if tok.typ == TokenType.DO:
-                skip_end += 1
-            
+        for tok in toks:
             if tok.typ == TokenType.MACRO:
-                if macro:
+                if cur_tok is not None:
                     Croak(
                         ErrorType.Syntax,
                         "macro cannot define a macro in itself, found in file \"%s\" (at line %d)" % (
@@ -435,85 +753,157 @@ class Lexer():
                     )
                 
                 cur_tok = tok
-                cur_name = cur_tok.value
                 macro_name = False
-                macro = True
                 continue
 
-            if macro:
-                if tok.typ == TokenType.END and not skip_end:
-                    macro = False
-
-                    if cur_name in macros:
-                        Croak(
-                            ErrorType.Name, "redefinition of macro %s in file \"%s\" (detected at line: %d)" % (
-                                cur_name, cur_tok.filename, cur_tok.ln
-                            )
-                        )
+            if cur_tok is None:
+                held.append(tok)
 
-                    macros[cur_name] = cur_toks
-                    cur_toks = []
-                    continue
-                
-                if tok.typ == TokenType.END and skip_end:
-                    skip_end -= 1
-                
-                if tok.typ != TokenType.ID:
-                    cur_toks.append(tok)
-                else:
-                    # print(tok.raw) # open(self.includes[0], "r", encoding="utf-8").read().count("\n", 0, tok.ind))
-                    if tok.value not in macros:
-                        Croak(
-                            ErrorType.Name,
-                            "undefined reference to identifier %s in file \"%s\" (detected at line: %d)" % (
-                                tok.raw, tok.filename, tok.ln
-                            )
-                        )
-                    
-                    for macro_tok in macros[tok.value]:#[0]:
-                        cur_toks.append(macro_tok)
-        
-        skip_macro = False
-        skip_end = 0
+                while held and (held[0].typ != TokenType.ID or held[0].value in self.macros):
+                    yield self.expand_top(held.popleft())
 
-        for tok in self.toks:
-            if skip_macro:
-                if tok.typ == TokenType.DO:
-                    skip_end += 1
-                elif tok.typ == TokenType.END and not skip_end:
-                    skip_macro = False
-                elif tok.typ == TokenType.END and skip_end:
-                    skip_end -= 1
-                
                 continue
-                
-            if tok.typ == TokenType.ID:
-                if not tok.value in macros:
+
+            if tok.typ == TokenType.DO:
+                skip_end += 1
+
+            if tok.typ == TokenType.END and not skip_end:
+                if cur_tok.value in self.macros:
                     Croak(
-                        ErrorType.Name,
-                        "undefined reference to identifier %s in file \"%s\" (detected at line: %d)" % (
-                            tok.raw, tok.filename, tok.ln
+                        ErrorType.Name, "redefinition of macro %s in file \"%s\" (detected at line: %d)" % (
+                            cur_tok.value, cur_tok.filename, cur_tok.ln
                         )
                     )
 
-                for macro_tok in macros[tok.value]:
-                    macro_tok.ln = tok.ln
-                    macro_tok.filename = tok.filename
+                self.macros[cur_tok.value] = Macro(cur_tok, tuple(cur_toks), self.macros)
+                cur_tok = None
+                cur_toks = []
+
+                while held and (held[0].typ != TokenType.ID or held[0].value in self.macros):
+                    yield self.expand_top(held.popleft())
+
+                continue
+            
+            if tok.typ == TokenType.END and skip_end:
+                skip_end -= 1
+            
+            # macros can only use macros defined before them
+            if tok.typ == TokenType.ID and tok.value not in self.macros:
+                Croak(
+                    ErrorType.Name,
+                    "undefined reference to identifier %s in file \"%s\" (detected at line: %d)" % (
+                        tok.raw, tok.filename, tok.ln
+                    )
+                )
+
+            cur_toks.append(tok)
+
+        while held:
+            yield self.expand_top(held.popleft())
+
+    def expand_top(self, tok: Token) -> tuple[list[Token], list[Optional["Expansion"]]]:
+        """ Expands a token outside of any macro """
+        if tok.typ != TokenType.ID:
+            return [tok], [None]
+
+        if not tok.value in self.macros:
+            Croak(
+                ErrorType.Name,
+                "undefined reference to identifier %s in file \"%s\" (detected at line: %d)" % (
+                    tok.raw, tok.filename, tok.ln
+                )
+            )
+
+        return self.expand(self.macros[tok.value], tok)
+
+    def expand(self, macro: "Macro", call: Token) -> tuple[list[Token], list[Optional["Expansion"]]]:
+        """ Returns the expansion of macro (called by call) and its sites """
+        toks = []
+        sites = []
+        macro.expansions += 1
+        stack = [(iter(macro.body), Expansion(macro, call))]
+
+        while stack:
+            body, site = stack[-1]
+
+            for tok in body:
+                if tok.typ != TokenType.ID:
+                    toks.append(tok)
+                    sites.append(site)
+                    continue
+
+                sub_macro = self.macros[tok.value]
+                sub_macro.expansions += 1
+                sub_site = Expansion(sub_macro, tok, site)
 
-                    macro_added_toks.append(macro_tok)
-            elif tok.typ == TokenType.MACRO:
-                # skip macros as they have already been added
-                skip_macro = True
+                if sub_macro.leaf:
+                    toks += sub_macro.body
+                    sites += [sub_site] * sub_macro.size
+                    continue
+
+                stack.append((iter(sub_macro.body), sub_site))
+                break
             else:
-                macro_added_toks.append(tok)
-        
-        self.toks = macro_added_toks
+                stack.pop()
+
+        return toks, sites
+
+    def macro_stats(self) -> list[tuple[str, int, int, int]]:
+        """ Returns (name, body size, expanded size, expansions) for every
+            macro, sorted by the number of tokens it added to the program. """
+        return sorted((
+            (macro.tok.value, len(macro.body), macro.size, macro.expansions)
+            for macro in self.macros.values()
+        ), key=lambda stat: stat[2] * stat[3], reverse=True)
+
+class Macro():
+    """ A macro body, shared (never copied) by every expansion of it """
+
+    def __init__(self, tok: Token, body: tuple[Token, ...], macros: dict[str, "Macro"]) -> None:
+        self.tok = tok
+        self.body = body
+        self.leaf = all(body_tok.typ != TokenType.ID for body_tok in body)
+        self.expansions = 0
+
+        # Number of tokens after fully expanding the macro.
+        self.size = sum(
+            macros[body_tok.value].size if body_tok.typ == TokenType.ID else 1
+            for body_tok in body
+        )
+
+@dataclass
+class Expansion():
+    """ Where a macro was expanded: call is the identifier token that called it
+        and parent is the expansion call came from (None if it was not expanded). """
+    macro: Macro
+    call: Token
+    parent: Optional["Expansion"] = None
+
+    def chain(self) -> list[str]:
+        """ Macro names from the outermost expansion to this one """
+        names = []
+        site = self
+
+        while site is not None:
+            names.append(site.macro.tok.value)
+            site = site.parent
+
+        return names[::-1]
+
+    def call_site(self) -> Token:
+        """ The identifier token outside of any macro that started the expansion """
+        site = self
+
+        while site.parent is not None:
+            site = site.parent
+
+        return site.call
 
 class Syscall(Enum):
     # Process control
-    FORK = auto() # Unimplemented
+    FORK = auto()
     EXIT = auto()
-    EXEC = auto() # Unimplemented
+    EXEC = auto()
     KILL = auto() # Unimplemented
 
     # File management
@@ -526,22 +916,170 @@ class Syscall(Enum):
     IOCTL = auto() # Unimplemented
 
     # Information maintenance
-    GETPID = auto() # Unimplemented
+    GETPID = auto()
     ALARM = auto() # Unimplemented
     SLEEP = auto()
     #TIME = auto()
 
     # Communication
-    PIPE = auto() # Unimplemented
+    PIPE = auto()
     SHMGET = auto() # Unimplemented
-    MMAP = auto() # Unimplemented
+    MMAP = auto()
 
     # Stack operations
     RESIZE = auto()
     POINTER = auto()
     LENGTH = auto()
 
-def find_end(ind: int, ops: list[Token]) -> int:
+    # Memory maps (made by MMAP)
+    MLOAD = auto()
+    MSTORE = auto()
+    MLOAD64 = auto()
+    MSTORE64 = auto()
+    MUNMAP = auto()
+
+class Program():
+    """ Expanded tokens stored as parallel columns instead of Token objects.
+
+        ops[i] is the TokenType value of instruction i and operands[i] is its
+        INT value or, for STR, an index into literals. Locations are stored as
+        lines[i] and files[i] (an index into filenames). """
+
+    def __init__(self, toks: Iterable[Token] = ()) -> None:
+        self.ops = array("B")
+        self.operands = array("q")
+        self.lines = array("i")
+        self.files = array("I")
+        self.filenames: list[str] = []
+        self.literals: list[tuple[int, ...]] = []
+
+        self.filename_index: dict[str, int] = {}
+        self.literal_index: dict[str, int] = {}
+
+        self.extend(toks)
+
+    def extend(self, toks: Iterable[Token]) -> None:
+        """ Appends tokens to the end of the program """
+        toks = list(toks)
+        operands = []
+
+        self.ops += array("B", [tok.typ.value for tok in toks])
+        self.lines += array("i", [max(tok.ln, 0) for tok in toks])
+
+        for tok in toks:
+            if tok.filename not in self.filename_index:
+                self.filename_index[tok.filename] = len(self.filenames)
+                self.filenames.append(tok.filename)
+
+            self.files.append(self.filename_index[tok.filename])
+
+            if tok.typ == TokenType.INT:
+                operands.append(tok.value)
+            elif tok.typ == TokenType.STR:
+                if tok.value not in self.literal_index:
+                    self.literal_index[tok.value] = len(self.literals)
+                    self.literals.append(tuple(ord(ch) for ch in tok.value) + (len(tok.value),))
+
+                operands.append(self.literal_index[tok.value])
+            else:
+                operands.append(0)
+
+        if isinstance(self.operands, array):
+            try:
+                operands = array("q", operands)
+            except OverflowError:
+                # Bignum literals cannot be stored in an int64 column.
+                self.operands = self.operands.tolist()
+
+        self.operands += operands
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    def token(self, ind: int) -> Token:
+        """ Rebuilds the token at ind (raw is rebuilt from the value) """
+        typ = TokenType(self.ops[ind])
+        operand = self.operands[ind]
+
+        if typ == TokenType.INT:
+            value = operand
+            raw = str(operand)
+        elif typ == TokenType.STR:
+            value = join(self.literals[operand][:-1])
+            raw = "\"%s\"" % value
+        else:
+            value = raw = reverse_keyword_map.get(typ, typ._name_.lower())
+
+        return Token(typ, raw, value, self.filenames[self.files[ind]], self.lines[ind])
+
+    def tokens(self):
+        """ Yields each instruction as a Token, one at a time """
+        for ind in range(len(self.ops)):
+            yield self.token(ind)
+
+# Opcodes used by the interpreter (TokenType values)
+OP_ID = TokenType.ID.value
+OP_EXCOR = TokenType.EXCOR.value
+OP_BITOR = TokenType.BITOR.value
+OP_BITAND = TokenType.BITAND.value
+OP_BITNOT = TokenType.BITNOT.value
+OP_LSHIFT = TokenType.LSHIFT.value
+OP_RSHIFT = TokenType.RSHIFT.value
+OP_IF = TokenType.IF.value
+OP_DO = TokenType.DO.value
+OP_END = TokenType.END.value
+OP_WHILE = TokenType.WHILE.value
+OP_INT = TokenType.INT.value
+OP_STR = TokenType.STR.value
+OP_SUB = TokenType.SUB.value
+OP_ADD = TokenType.ADD.value
+OP_MUL = TokenType.MUL.value
+OP_DIVMOD = TokenType.DIVMOD.value
+OP_DUP = TokenType.DUP.value
+OP_SWAP = TokenType.SWAP.value
+OP_BACK = TokenType.BACK.value
+OP_FRONT = TokenType.FRONT.value
+OP_EQUAL = TokenType.EQUAL.value
+OP_NOT_EQUAL = TokenType.NOT_EQUAL.value
+OP_GREATER_THAN = TokenType.GREATER_THAN.value
+OP_SMALLER_THAN = TokenType.SMALLER_THAN.value
+OP_BUF = TokenType.BUF.value
+OP_SYSCALL = TokenType.SYSCALL.value
+
+def stream_tokens(filename: str, lex_name: str) -> Iterator[Token]:
+    """ Lexes a file STREAM_CHUNK_SIZE characters at a time, yielding its
+        tokens (with unresolved includes) without reading all of it. """
+    lexer = Lexer("", lex_name)
+    lexer.final = False
+
+    with open(filename, "r", encoding="utf-8") as file:
+        while not lexer.final:
+            src = file.read(STREAM_CHUNK_SIZE)
+
+            lexer.feed(src, not src)
+            lexer.scan()
+
+            yield from lexer.toks
+            lexer.toks = []
+
+def stream_program(filename: str, lex_name: str, keep_sites: bool = False) -> tuple["Lexer", Program]:
+    """ Streams filename through lexing, include resolution and macro
+        expansion straight into a Program. The expansion sites are kept in
+        lexer.sites if keep_sites is set. """
+    lexer = Lexer("", lex_name)
+    program = Program()
+    expanded = lexer.iter_expanded(lexer.iter_resolved(stream_tokens(filename, lex_name)))
+
+    for toks, sites in expanded:
+        program.extend(toks)
+
+        if keep_sites:
+            lexer.sites += sites
+
+    return lexer, program
+
+def match_end(ind: int, ops: array) -> int:
+    """ Returns the index of the end matching the block at ind, or -1 """
     skip_end = 0
     end = ind
     size = len(ops) - 1
@@ -549,347 +1087,1058 @@ def find_end(ind: int, ops: list[Token]) -> int:
     while end < size:
         end += 1
 
-        if ops[end].typ == TokenType.DO:
+        if ops[end] == OP_DO:
             skip_end += 1
         
-        if ops[end].typ == TokenType.END:
+        if ops[end] == OP_END:
             if not skip_end:
                 return end
 
             skip_end -= 1
     
-    Croak(ErrorType.Syntax, "expected end (at line %d)" % (ops[ind].ln))
+    return -1
+
+def find_end(ind: int, program: Program) -> int:
+    end = match_end(ind, program.ops)
+
+    if end < 0:
+        Croak(ErrorType.Syntax, "expected end (at line %d)" % (program.lines[ind]))
+
+    return end
+
+def resolve_jumps(program: Program) -> array:
+    """ Jump table for the interpreter, computed once instead of scanning
+        for the matching end every time a branch is taken.
+
+        For if and while, the index of the matching end, a missing end is
+        a syntax error. For the end of a while, the index of the while.
+        Otherwise -1. """
+    ops = program.ops
+    size = len(ops)
+    jumps = array("q", [-1]) * size
+    closes = {}
+    open_blocks = []
+
+    for ind, op in enumerate(ops):
+        if op == OP_DO:
+            open_blocks.append(ind)
+        elif op == OP_END and open_blocks:
+            closes[open_blocks.pop()] = ind
+
+    for ind, op in enumerate(ops):
+        if op != OP_IF and op != OP_WHILE:
+            continue
+
+        # Same as find_end, the token after the branch (normally do) is
+        # skipped and the next end that is not nested is the match.
+        if ind + 1 < size and ops[ind + 1] == OP_DO:
+            end = closes.get(ind + 1, -1)
+        else:
+            end = match_end(ind + 1, ops)
+
+        if end < 0:
+            # Reports the missing end
+            find_end(ind + 1, program)
+
+        jumps[ind] = end
+
+        if op == OP_WHILE:
+            jumps[end] = ind
+
+    return jumps
+
+# Instructions as (items they need, items they pop, items they push). The
+# need is what the interpreter checks for, back and front only move one item.
+STACK_EFFECTS = {
+    OP_INT: (0, 0, 1),
+    OP_DUP: (1, 1, 2),
+    OP_BITNOT: (1, 1, 1),
+    OP_SWAP: (2, 2, 2),
+    OP_BACK: (2, 1, 1),
+    OP_FRONT: (2, 1, 1),
+    OP_BUF: (2, 2, 1),
+    OP_DIVMOD: (2, 2, 2),
+    OP_IF: (1, 1, 0),
+    OP_SYSCALL: (1, 1, 0),
+    **{op: (2, 2, 1) for op in (
+        OP_SUB, OP_ADD, OP_MUL, OP_EQUAL, OP_NOT_EQUAL, OP_GREATER_THAN, OP_SMALLER_THAN,
+        OP_BITAND, OP_BITOR, OP_EXCOR, OP_LSHIFT, OP_RSHIFT)},
+}
 
-def get_syscall(num: int, last: str = "pop(&vars.mem)") -> str:
-    syscalls = {
-        #0x001: "PANG_FORK();\n",
-        0x002: "exit(%s);\n" % last,
-        0x005: "PANG_OPEN(&vars);\n",
-        0x006: "PANG_READ(&vars);\n",
-        0x007: "PANG_WRITE(&vars);\n",
-        0x008: "PANG_CLOSE(&vars);\n",
-        0x00C: "std::this_thread::sleep_for(std::chrono::milliseconds(%s));\n" % last,
-        0x010: "if (vars.mem.back() > 0) { vars.mem.resize(((int64_t) vars.mem.size()) - vars.mem.back() - 1); } else { vars.mem.resize(-vars.mem.back()); }\n",
-        0x011: "if (vars.mem.back() < 0) { vars.mem.back() += vars.mem.size() - 1; } vars.mem.push_back(vars.mem[%s]);\n" % last,
-        0x012: "vars.mem.push_back(vars.mem.size());\n"
-    }
+# Syscalls that always pop and push the same number of items (after their
+# number) as (items they pop, items they push)
+SYSCALL_EFFECTS = {
+    Syscall.FORK.value: (0, 1),
+    Syscall.WRITE.value: (1, 0),
+    Syscall.CLOSE.value: (1, 0),
+    Syscall.GETPID.value: (0, 1),
+    Syscall.SLEEP.value: (1, 0),
+    Syscall.PIPE.value: (0, 2),
+    Syscall.POINTER.value: (1, 1),
+    Syscall.LENGTH.value: (0, 1),
+    Syscall.MLOAD.value: (2, 1),
+    Syscall.MSTORE.value: (3, 0),
+    Syscall.MLOAD64.value: (2, 1),
+    Syscall.MSTORE64.value: (3, 0),
+    Syscall.MUNMAP.value: (1, 0),
+}
 
-    if last != "pop(&vars.mem)":
-        last = int(last)
-    
-    if num in (0x010, 0x011) and type(last) == int:
-        if last > 0:
-            syscalls[0x010] = "vars.mem.resize(((int64_t) vars.mem.size()) - %d);\n" % last
-            syscalls[0x011] = "vars.mem.push_back(vars.mem[%d]);\n" % last
-        else:
-            syscalls[0x010] = "vars.mem.resize(-%d);\n" % last
-            syscalls[0x011] = "vars.mem.back() += vars.mem.size() - 1; vars.mem.push_back(vars.mem[%d]);\n" % last
+def syscall_effect(number: int, count: Optional[int], lo: int, hi: Optional[int]) -> Optional[tuple[int, Optional[int]]]:
+    """ Bounds of the stack depth after a syscall (see stack_depths), lo and
+        hi are the bounds once its number has been popped. count is the
+        item under the number if it is known (for resize). Returns None
+        when the program does not go on (exit). """
+    if number in SYSCALL_EFFECTS:
+        pops, pushes = SYSCALL_EFFECTS[number]
+        return max(lo - pops, 0) + pushes, None if hi is None else hi - pops + pushes
+    elif number == Syscall.EXIT.value:
+        return None
+    elif number == Syscall.OPEN.value:
+        # Two strings (at least their lengths) for the descriptor
+        return 1, None if hi is None else hi - 1
+    elif number == Syscall.MMAP.value:
+        return 2, hi
+    elif number == Syscall.READ.value:
+        return max(lo - 2, 0) + 1, None
+    elif number == Syscall.RESIZE.value and count is not None:
+        lo = max(lo - 1, 0)
+
+        # An empty stack is at most -1 items over the start, as it starts
+        # with at least one
+        if count > 0:
+            return max(lo - count, 0), None if hi is None else max(hi - 1 - count, -1)
+        elif count < 0:
+            # Compiled programs grow the stack to -count items
+            return min(lo, -count), None if hi is None else max(hi - 1, -count - 1)
+
+        return 0, -1
+
+    # exec, resize by an unknown count and the unimplemented syscalls
+    return 0, None
+
+def stack_depths(program: Program, jumps: Optional[array] = None) -> tuple[array, Optional[int]]:
+    """ Works out, without running the program, the fewest items the stack
+        can have before each instruction. Both ways out of every if and
+        while are followed, loops are gone through again until the depths
+        stop changing (a depth that still changes after STACK_WIDEN_AFTER
+        times is given up on).
+
+        Returns the depths (-1 for instructions that are never reached) and
+        the most items the stack grows by over the ones it starts with
+        (None if a loop or a syscall can grow it without a limit). The
+        stack starts with at least ENTRY_DEPTH items, argc. """
+    ops = program.ops
+    operands = program.operands
+    size = len(ops)
+
+    if jumps is None:
+        jumps = resolve_jumps(program)
+
+    lows = array("q", [-1]) * size
+    highs: list[Optional[int]] = [None] * size
+    merges = bytearray(size)
+    peak = 0
+    bounded = True
+
+    # Instructions reached from somewhere else than the one before them
+    joins = set()
+
+    for ind, op in enumerate(ops):
+        if (op == OP_IF or op == OP_WHILE or op == OP_END) and jumps[ind] >= 0:
+            joins.add(jumps[ind] + 1)
+
+    pending = []
+    queued = set()
+
+    def reach(target: int, lo: int, hi: Optional[int]) -> None:
+        nonlocal peak, bounded
+
+        if hi is None:
+            bounded = False
+        elif hi > peak:
+            peak = hi
+
+        if target >= size:
+            return
 
-    if num not in syscalls:
-        Croak(ErrorType.Stack, "Syscall number not valid. (number: %d)" % num)
+        if lows[target] >= 0:
+            old_lo, old_hi = lows[target], highs[target]
+            new_lo = min(old_lo, lo)
+            new_hi = None if hi is None or old_hi is None else max(old_hi, hi)
 
-    return syscalls[num]
+            if new_lo == old_lo and new_hi == old_hi:
+                return
 
-def remove_newline(_Str: str) -> str:
-    seperated = _Str.split("\n")
-    if not seperated[-1]:
-        seperated = seperated[:-1]
+            merges[target] = min(merges[target] + 1, 255)
 
-    return "\n".join(seperated[:-1]) + "\n"
+            if merges[target] > STACK_WIDEN_AFTER:
+                if new_lo != old_lo:
+                    new_lo = 0
+                if new_hi != old_hi:
+                    new_hi = None
 
-def compile_ops(toks: list, optimise: bool) -> str:
-    """ Compiles to C++ """
-    
-    if len(toks) <= 0:
-        Croak(ErrorType.Compile, "nothing to compile")
+            lo, hi = new_lo, new_hi
 
-    out = ""
+        lows[target] = lo
+        highs[target] = hi
 
-    indent_width = 4
-    prev_int = []
-    prev = Token()
-    pre_allocator = PRE_ARGV_ALLOCATE
-    direct_syscall = False
-    direct_buf = False
-    direct_divmod = False
+        if target not in queued:
+            queued.add(target)
+            heappush(pending, target)
+
+    if size:
+        reach(0, ENTRY_DEPTH, 0)
+
+    while pending:
+        ind = heappop(pending)
+        queued.discard(ind)
+        lo, hi = lows[ind], highs[ind]
+
+        # Straight-line code is followed without going through the queue
+        while True:
+            op = ops[ind]
+            popped = max(lo - 1, 0), None if hi is None else hi - 1
+
+            if op == OP_IF:
+                reach(ind + 1, *popped)
+                reach(jumps[ind] + 1, *popped)
+                break
+            elif op == OP_WHILE:
+                # The condition is not popped when the stack is empty
+                reach(ind + 1, *popped)
+                reach(jumps[ind] + 1, popped[0], hi)
+                break
+            elif op == OP_END and jumps[ind] >= 0:
+                reach(jumps[ind] + 1, *popped)
+                reach(ind + 1, popped[0], hi)
+                break
+            elif op == OP_SYSCALL:
+                known = ind > 0 and ops[ind - 1] == OP_INT and ind not in joins
+                count_known = known and ind > 1 and ops[ind - 2] == OP_INT and ind - 1 not in joins
+
+                if not known:
+                    after = 0, None
+                else:
+                    after = syscall_effect(
+                        operands[ind - 1], operands[ind - 2] if count_known else None, *popped)
+
+                if after is None:
+                    break
+
+                lo, hi = after
+            elif op == OP_STR:
+                pushes = len(program.literals[operands[ind]])
+                lo, hi = lo + pushes, None if hi is None else hi + pushes
+            elif op in STACK_EFFECTS:
+                _, pops, pushes = STACK_EFFECTS[op]
+                lo, hi = max(lo - pops, 0) + pushes, None if hi is None else hi - pops + pushes
+
+            if ind + 1 >= size or ind + 1 in joins:
+                reach(ind + 1, lo, hi)
+                break
+
+            ind += 1
+
+            if hi is None:
+                bounded = False
+            elif hi > peak:
+                peak = hi
+
+            if lows[ind] == lo and highs[ind] == hi:
+                break
+
+            lows[ind] = lo
+            highs[ind] = hi
+
+    return lows, peak if bounded else None
+
+def stack_safe(program: Program, lows: array) -> bytearray:
+    """ 1 for the instructions that stack_depths proved to always have the
+        items they need, their stack checks can be skipped """
+    safe = bytearray(len(program))
+
+    for ind, op in enumerate(program.ops):
+        if op in STACK_EFFECTS:
+            need = STACK_EFFECTS[op][0]
+        elif op == OP_WHILE or op == OP_END:
+            need = 1
+        else:
+            continue
+
+        if lows[ind] >= need:
+            safe[ind] = 1
+
+    return safe
+
+# Instructions folded when both of their items are constants, as functions
+# of (left, right). Bitwise instructions are left alone, the C++ backend
+# has none.
+CONSTANT_FOLDS = {
+    OP_SUB: lambda left, right: left - right,
+    OP_ADD: lambda left, right: left + right,
+    OP_MUL: lambda left, right: left * right,
+    OP_EQUAL: lambda left, right: int(left == right),
+    OP_NOT_EQUAL: lambda left, right: int(left != right),
+    OP_GREATER_THAN: lambda left, right: int(left < right),
+    OP_SMALLER_THAN: lambda left, right: int(left > right),
+}
+
+class Block():
+    """ A basic block, the instructions in [start, stop). Only its first
+        instruction is jumped to and only its last one jumps. """
+
+    __slots__ = ("start", "stop")
+
+    def __init__(self, start: int, stop: int) -> None:
+        self.start = start
+        self.stop = stop
+
+def is_branch(op: int, ind: int, jumps: array) -> bool:
+    """ If the instruction can go somewhere else than the next one """
+    return op == OP_IF or op == OP_WHILE or (op == OP_END and jumps[ind] >= 0)
+
+def basic_blocks(program: Program, jumps: array) -> list[Block]:
+    """ Splits the program into basic blocks, in program order """
+    ops = program.ops
+    size = len(ops)
+    leaders = {0}
+
+    for ind, op in enumerate(ops):
+        if is_branch(op, ind, jumps):
+            leaders.add(ind + 1)
+
+            if jumps[ind] >= 0:
+                leaders.add(jumps[ind] + 1)
+
+    starts = sorted(ind for ind in leaders if ind < size)
+
+    return [Block(start, stop) for start, stop in zip(starts, starts[1:] + [size])]
+
+def constant_step(state: list, op: int, operand: int, program: Program, int64: bool) -> bool:
+    """ Runs an instruction that is not a branch on state, the values on
+        top of the stack (None for the ones that are not known, the top is
+        last). Returns False if the program stops there. """
+    if op == OP_INT:
+        state.append(wrap64(operand) if int64 else operand)
+    elif op == OP_STR:
+        state += program.literals[operand]
+    elif op == OP_DUP:
+        state.append(state[-1] if state else None)
+    elif op == OP_SWAP:
+        if len(state) < 2:
+            state[:0] = [None] * (2 - len(state))
+
+        state[-1], state[-2] = state[-2], state[-1]
+    elif op == OP_BACK:
+        del state[-1:]
+    elif op == OP_FRONT:
+        # The item at the bottom (which may be the first one known) goes on top
+        del state[:1]
+        state.append(None)
+    elif op in CONSTANT_FOLDS:
+        right = state.pop() if state else None
+        left = state.pop() if state else None
+
+        if left is None or right is None:
+            state.append(None)
+        else:
+            value = CONSTANT_FOLDS[op](left, right)
+            state.append(wrap64(value) if int64 else value)
+    elif op == OP_SYSCALL:
+        number = state.pop() if state else None
+
+        if number == Syscall.EXIT.value:
+            return False
+        elif number in SYSCALL_EFFECTS:
+            pops, pushes = SYSCALL_EFFECTS[number]
+            del state[max(len(state) - pops, 0):]
+            state += [None] * pushes
+        elif number == Syscall.RESIZE.value and state and state[-1] is not None and state[-1] > 0:
+            count = state.pop()
+            del state[max(len(state) - count, 0):]
+        else:
+            # Unknown syscalls can change anything on the stack
+            state.clear()
+    elif op in STACK_EFFECTS:
+        _, pops, pushes = STACK_EFFECTS[op]
+        del state[max(len(state) - pops, 0):]
+        state += [None] * pushes
+
+    del state[:-CONSTANT_WINDOW]
+    return True
+
+def constant_exits(state: list, ind: int, program: Program, jumps: array, int64: bool) -> list[tuple[int, tuple]]:
+    """ Where the program goes after instruction ind (the last of a block)
+        and the values known on the stack there. A branch with a known
+        condition only goes one way. """
+    op = program.ops[ind]
+    size = len(program)
+
+    if not is_branch(op, ind, jumps):
+        if not constant_step(state, op, program.operands[ind], program, int64) or ind + 1 >= size:
+            return []
+
+        return [(ind + 1, tuple(state))]
+
+    # The condition (of while and its end, only when the stack is not
+    # empty, which it is not if the condition is known)
+    cond = state.pop() if state else None
+    end = jumps[ind]
+
+    if op == OP_END:
+        taken, skipped = end + 1, ind + 1
+    else:
+        taken, skipped = ind + 1, end + 1
+
+    targets = []
+
+    if cond != 0:
+        targets.append(taken)
+    if not cond:
+        targets.append(skipped)
+
+    return [(target, tuple(state)) for target in targets if target < size]
+
+def join_constants(old: tuple, new: tuple) -> tuple:
+    """ The values known on both ways into a block """
+    size = min(len(old), len(new))
+
+    if not size:
+        return ()
+
+    return tuple(value if value == other else None for value, other in zip(old[-size:], new[-size:]))
+
+def propagate_constants(program: Program, jumps: array, blocks: list[Block], int64: bool = False) -> list[Optional[tuple]]:
+    """ Works out, without running the program, the values that are always
+        on top of the stack (at most CONSTANT_WINDOW of them) when each
+        block starts. Both ways out of every if and while are followed
+        unless the condition is known, and loops are gone through again
+        until nothing changes (a value that changes around a loop is no
+        longer known).
+
+        Returns a tuple for each block with the top last and None for the
+        values that are not known, or None if the block is never reached.
+        With int64 set, values wrap around like compiled programs. """
+    numbers = {block.start: number for number, block in enumerate(blocks)}
+    entries: list[Optional[tuple]] = [None] * len(blocks)
+
+    if not blocks:
+        return entries
+
+    entries[0] = ()
+    pending = [0]
+    queued = {0}
+
+    while pending:
+        number = heappop(pending)
+        queued.discard(number)
+        block = blocks[number]
+        state = list(entries[number])
+        reached = True
+
+        for ind in range(block.start, block.stop - 1):
+            if not constant_step(state, program.ops[ind], program.operands[ind], program, int64):
+                reached = False
+                break
+
+        if not reached:
+            continue
+
+        for target, after in constant_exits(state, block.stop - 1, program, jumps, int64):
+            target = numbers[target]
+            old = entries[target]
+            new = after if old is None else join_constants(old, after)
+
+            if new == old:
+                continue
+
+            entries[target] = new
+
+            if target not in queued:
+                queued.add(target)
+                heappush(pending, target)
+
+    return entries
+
+def fold_constants(program: Program, int64: bool = False) -> tuple[Program, list[int]]:
+    """ Rewrites the program with the values found by propagate_constants:
+        instructions on constants are replaced by the constant they make,
+        dup of a known value becomes the value, swaps of constants are
+        done in place, purges of them are left out and if (or while)
+        blocks with a constant condition are kept without the check or
+        removed.
+
+        Constants are only written to the stack when an instruction needs
+        them there, before every branch, end and block that is jumped to.
+        Returns the new program and, for each of its instructions, the
+        index of the instruction it came from. """
+    ops = program.ops
+    operands = program.operands
+    size = len(ops)
+    jumps = resolve_jumps(program)
+    blocks = basic_blocks(program, jumps)
+    entries = dict(zip((block.start for block in blocks), propagate_constants(program, jumps, blocks, int64)))
+
+    new_ops = []
+    new_operands = []
+    origins = []
+
+    # Constants not written yet as (value, index they came from)
+    pending: list[tuple[int, int]] = []
+
+    # do and end of the blocks whose check was removed
+    skipped = set()
+    state = None
+    ind = 0
+
+    def emit(op: int, operand: int, origin: int) -> None:
+        new_ops.append(op)
+        new_operands.append(operand)
+        origins.append(origin)
+
+    def flush() -> None:
+        for value, origin in pending:
+            emit(OP_INT, value, origin)
+
+        pending.clear()
+
+    while ind < size:
+        op = ops[ind]
+
+        if ind in entries:
+            state = None if entries[ind] is None else list(entries[ind])
+
+        if ind in skipped:
+            ind += 1
+            continue
+
+        if state is None:
+            # Never reached, kept as it is
+            flush()
+            emit(op, operands[ind], ind)
+            ind += 1
+            continue
+
+        end = jumps[ind]
+
+        # The value it pushes is known once it has run
+        known = op == OP_INT or (op == OP_DUP and len(state) > 0 and state[-1] is not None)
+
+        if op in CONSTANT_FOLDS and len(pending) >= 2:
+            del pending[-2:]
+            known = True
+        elif op == OP_SWAP and len(pending) >= 2:
+            pending[-1], pending[-2] = pending[-2], pending[-1]
+        elif op == OP_SYSCALL and len(pending) >= 2 and pending[-1][0] == Syscall.RESIZE.value and (
+                0 < pending[-2][0] <= len(pending) - 2):
+            # Only constants that were never written are purged
+            del pending[-pending[-2][0] - 2:]
+        elif (op == OP_IF or op == OP_WHILE) and pending and end >= 0 and ops[ind + 1] == OP_DO and (
+                op == OP_IF or jumps[end] == ind) and not (op == OP_WHILE and state[-1]):
+            pending.pop()
+
+            if state[-1]:
+                # Always taken, only the do and end are left out
+                skipped.add(ind + 1)
+                skipped.add(end)
+                ind += 1
+            else:
+                ind = end + 1
+
+            continue
+        elif not known:
+            flush()
+            emit(op, operands[ind], ind)
+
+        if not is_branch(op, ind, jumps) and not constant_step(state, op, operands[ind], program, int64):
+            state = None
+        elif known:
+            pending.append((state[-1], ind))
+
+        ind += 1
+
+    flush()
+
+    folded = Program()
+    folded.ops = array("B", new_ops)
+    folded.lines = array("i", [program.lines[origin] for origin in origins])
+    folded.files = array("I", [program.files[origin] for origin in origins])
+    folded.filenames = program.filenames
+    folded.filename_index = program.filename_index
+    folded.literals = program.literals
+    folded.literal_index = program.literal_index
+
+    try:
+        folded.operands = array("q", new_operands)
+    except OverflowError:
+        # Bignum constants cannot be stored in an int64 column
+        folded.operands = new_operands
+
+    return folded, origins
+
+def get_syscall(num: int, last: str = "pop(&vars.mem)") -> str:
+    syscalls = {
+        0x001: "PANG_FORK(&vars);\n",
+        0x002: "exit(%s);\n" % last,
+        0x003: "PANG_EXEC(&vars);\n",
+        0x005: "PANG_OPEN(&vars);\n",
+        0x006: "PANG_READ(&vars);\n",
+        0x007: "PANG_WRITE(&vars);\n",
+        0x008: "PANG_CLOSE(&vars);\n",
+        0x00A: "PANG_GETPID(&vars);\n",
+        0x00C: "std::this_thread::sleep_for(std::chrono::milliseconds(%s));\n" % last,
+        0x00D: "PANG_PIPE(&vars);\n",
+        0x010: "if (vars.mem.back() > 0) { vars.mem.resize(((int64_t) vars.mem.size()) - vars.mem.back() - 1); } else { vars.mem.resize(-vars.mem.back()); }\n",
+        0x011: "if (vars.mem.back() < 0) { vars.mem.back() += vars.mem.size() - 1; } vars.mem.push_back(vars.mem[%s]);\n" % last,
+        0x012: "vars.mem.push_back(vars.mem.size());\n",
+        0x00F: "PANG_MMAP(&vars);\n",
+        0x013: "PANG_MLOAD(&vars);\n",
+        0x014: "PANG_MSTORE(&vars);\n",
+        0x015: "PANG_MLOAD64(&vars);\n",
+        0x016: "PANG_MSTORE64(&vars);\n",
+        0x017: "PANG_MUNMAP(&vars);\n",
+    }
+
+    if last != "pop(&vars.mem)":
+        last = int(last)
+    
+    if num in (0x010, 0x011) and type(last) == int:
+        # The number was never pushed, so it is not counted in the size
+        if last > 0:
+            syscalls[0x010] = "vars.mem.resize(((int64_t) vars.mem.size()) - %d);\n" % last
+        else:
+            syscalls[0x010] = "vars.mem.resize(%d);\n" % -last
+
+        if last >= 0:
+            syscalls[0x011] = "vars.mem.push_back(vars.mem[%d]);\n" % last
+        else:
+            syscalls[0x011] = "vars.mem.push_back(vars.mem[vars.mem.size() - %d]);\n" % -last
+
+    if num not in syscalls:
+        Croak(ErrorType.Stack, "Syscall number not valid. (number: %d)" % num)
+
+    return syscalls[num]
+
+def compile_stats(run_ops: list[dict[int, int]], run_calls: list[dict[int, int]]) -> str:
+    """ The counters and report of a program compiled with --stats.
+
+        Every straight-line run of the program counts its executions in
+        stats_runs, run_ops[i] and run_calls[i] are the instructions and the
+        syscalls (with a number known when compiling) in run i, so the totals
+        are only worked out when the program exits. """
+    op_count = max(typ.value for typ in TokenType) + 1
+    syscall_count = max(syscall.value for syscall in Syscall) + 1
+
+    start  = "uint64_t stats_runs[%d];\n" % len(run_ops)
+    start += "\n"
+
+    for name, runs in (("stats_ops", run_ops), ("stats_calls", run_calls)):
+        start += "const uint64_t %s[][3] = {\n" % name
+
+        for run, counts in enumerate(runs):
+            for key, count in counts.items():
+                start += "    {%d, %d, %d},\n" % (run, key, count)
+
+        start += "    {0, 0, 0},\n"
+        start += "};\n"
+        start += "\n"
+
+    start += "const char *stats_op_names[] = {%s};\n" % ", ".join(
+        "\"%s\"" % (instruction_name(op) if op in TokenType._value2member_map_ else "") for op in range(op_count))
+    start += "const char *stats_syscall_names[] = {%s};\n" % ", ".join(
+        "\"%s\"" % (Syscall(number)._name_.lower() if number else "") for number in range(syscall_count))
+    start += "\n"
+    start += "void stats_print(const std::map<int64_t, uint64_t> &counts, bool syscalls) {\n"
+    start += "    std::vector<std::pair<uint64_t, int64_t>> sorted;\n"
+    start += "\n"
+    start += "    for (auto &count : counts) {\n"
+    start += "        if (count.second) {\n"
+    start += "            sorted.push_back({count.second, count.first});\n"
+    start += "        }\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    std::stable_sort(sorted.begin(), sorted.end(), [](auto &a, auto &b) { return a.first > b.first; });\n"
+    start += "\n"
+    start += "    for (auto &count : sorted) {\n"
+    start += "        char name[64];\n"
+    start += "\n"
+    start += "        if (!syscalls) {\n"
+    start += "            snprintf(name, sizeof(name), \"%s\", stats_op_names[count.second]);\n"
+    start += "        } else if (count.second > 0 && count.second < %d) {\n" % syscall_count
+    start += "            snprintf(name, sizeof(name), \"%s (0x%03llX)\", stats_syscall_names[count.second], (long long) count.second);\n"
+    start += "        } else {\n"
+    start += "            snprintf(name, sizeof(name), \"0x%03llX\", (long long) count.second);\n"
+    start += "        }\n"
+    start += "\n"
+    start += "        fprintf(stderr, \"  %-16s %12llu\\n\", name, (unsigned long long) count.first);\n"
+    start += "    }\n"
+    start += "}\n"
+    start += "\n"
+    start += "uint64_t stats_total(const std::map<int64_t, uint64_t> &counts) {\n"
+    start += "    uint64_t total = 0;\n"
+    start += "\n"
+    start += "    for (auto &count : counts) {\n"
+    start += "        total += count.second;\n"
+    start += "    }\n"
+    start += "    return total;\n"
+    start += "}\n"
+    start += "\n"
+    start += "// Registered with atexit, so it also runs after the exit syscall\n"
+    start += "void stats_report() {\n"
+    start += "    std::map<int64_t, uint64_t> ops;\n"
+    start += "    std::map<int64_t, uint64_t> syscalls = pang_stats.syscalls;\n"
+    start += "\n"
+    start += "    for (auto &entry : stats_ops) {\n"
+    start += "        ops[entry[1]] += stats_runs[entry[0]] * entry[2];\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    for (auto &entry : stats_calls) {\n"
+    start += "        if (entry[2]) {\n"
+    start += "            syscalls[entry[1]] += stats_runs[entry[0]] * entry[2];\n"
+    start += "        }\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    std::cout.flush();\n"
+    start += "\n"
+    start += "    fprintf(stderr, \"Instructions executed: %llu\\n\", (unsigned long long) stats_total(ops));\n"
+    start += "    stats_print(ops, false);\n"
+    start += "    fprintf(stderr, \"Syscalls executed: %llu\\n\", (unsigned long long) stats_total(syscalls));\n"
+    start += "    stats_print(syscalls, true);\n"
+    start += "\n"
+    start += "    fprintf(stderr, \"Peak stack depth: %llu\\n\", (unsigned long long) pang_stats.peak);\n"
+    start += "    fprintf(stderr, \"Items moved by back/front: %%llu\\n\", (unsigned long long) (ops[%d] + ops[%d]));\n" % (
+        TokenType.BACK.value, TokenType.FRONT.value)
+    start += "    fprintf(stderr, \"Items purged: %llu\\n\", (unsigned long long) pang_stats.purged);\n"
+    start += "    fprintf(stderr, \"Items copied growing the stack: %llu\\n\", (unsigned long long) pang_stats.copied);\n"
+    start += "\n"
+    start += "    for (auto &written : pang_stats.written) {\n"
+    start += "        fprintf(stderr, \"Written to fd %lld: %llu\\n\", (long long) written.first, (unsigned long long) written.second);\n"
+    start += "    }\n"
+    start += "}\n"
+    start += "\n"
+
+    return start
+
+def compile_ops(program: Program, optimise: bool, stats: bool = False) -> str:
+    """ Compiles to C++, with the counters of --stats if stats is set """
+    
+    if len(program) <= 0:
+        Croak(ErrorType.Compile, "nothing to compile")
+
+    if optimise:
+        # Constants are folded through the whole program first, the code
+        # below only folds them into the instructions they are used by.
+        program = fold_constants(program, True)[0]
+
+    out: list[str] = []
+
+    indent_width = 4
+    jumps = resolve_jumps(program)
+    lows, peak = stack_depths(program, jumps)
+
+    # Instructions that always have the items they need pop without checks
+    safe = stack_safe(program, lows)
+    pre_allocator = PRE_ARGV_ALLOCATE
+    direct_syscall = False
+    direct_buf = False
+    direct_divmod = False
     direct_sleep = False
     direct_open = False
     direct_read = False
     direct_write = False
     direct_close = False
-    prev_chars = []
+    direct_mmap = False
+    direct_process = False
 
-    for tok in toks:
-        drop_prev_int = True
+    # Constants (with -O), string characters and a swap that are not written
+    # yet, so the instruction after them can use them directly. Only one
+    # kind is pending at a time.
+    pending_ints = []
+    pending_chars = []
+    pending_swap = -1
 
-        if tok.typ != TokenType.STR:
-            prev_chars = []
-        else:
+    def flush() -> None:
+        """ Writes what is pending """
+        nonlocal pending_swap
+
+        for value in pending_ints:
+            out.append("%sPUSH_INTEGER(%d);\n" % (" " * indent_width, value))
+
+        if pending_chars:
+            out.append("%svars.mem.insert(vars.mem.end(), {%s});\n" % (" " * indent_width, ", ".join(pending_chars)))
+
+        if pending_swap >= 0:
+            out.append("%s%s;\n" % (" " * indent_width, "PANG_SWAP_UNCHECKED" if safe[pending_swap] else "PANG_SWAP"))
+
+        pending_ints.clear()
+        pending_chars.clear()
+        pending_swap = -1
+
+    # Instructions and syscalls in each straight-line run (see compile_stats)
+    run_ops = [{}]
+    run_calls = [{}]
+
+    if stats:
+        out.append("%sSTATS_RUN(0);\n" % (" " * indent_width))
+
+    for ind, tok in enumerate(program.tokens()):
+        if stats:
+            run_ops[-1][tok.typ.value] = run_ops[-1].get(tok.typ.value, 0) + 1
+
+        if tok.typ == TokenType.STR:
+            if pending_ints or pending_swap >= 0:
+                flush()
+
+            # Strings in a row are pushed together
             chars = [ord(ch) for ch in tok.value]
             pre_allocator += len(chars)
+            pending_chars += [str(ch) for ch in chars] + [str(len(chars))]
+        elif tok.typ == TokenType.INT:
+            if pending_chars or pending_swap >= 0:
+                flush()
 
-            if prev_chars:
-                out = remove_newline(out)
-            
-            out += "%svars.mem.insert(vars.mem.end(), {%s});\n" % (
-                " " * indent_width,
-                ", ".join(prev_chars
-                    + [str(ch) for ch in chars]
-                    + [str(len(chars))]),
-            )
-                
-            prev_chars += [str(ch) for ch in chars] + [str(len(tok.value))]
-
-            if optimise:
-                prev_int += chars + [len(tok.value)]
-                drop_prev_int = False
-        
-        if tok.typ == TokenType.INT:
-            out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, tok.value)
+            pending_ints.append(tok.value)
             pre_allocator += 1
 
-            if optimise:
-                prev_int.append(tok.value)
-                drop_prev_int = False
+            if not optimise:
+                flush()
         elif tok.typ == TokenType.BUF:
-            if prev_int:
-                out = remove_newline(out)
-
-                if prev_int[-1] == 0:
-                    out += "%svars.buf += std::to_string(vars.mem.back());\n" % (" " * indent_width)
-                elif prev_int[-1] == 1:
-                    out += "%svars.buf += vars.mem.back();\n" % (" " * indent_width)
+            if pending_ints:
+                mode = pending_ints.pop()
+                flush()
+
+                if mode == 0:
+                    out.append("%svars.buf += std::to_string(vars.mem.back());\n" % (" " * indent_width))
+                elif mode == 1:
+                    out.append("%svars.buf += vars.mem.back();\n" % (" " * indent_width))
                 else:
                     Croak(ErrorType.Stack, "%d is not a valid number for the buf keyword (1 or 0)...")
-
-                prev_int.pop()
-                drop_prev_int = False
             else:
+                flush()
                 direct_buf = True
-                out += "%sPANG_BUF;\n" % (" " * indent_width)
+                out.append("%sPANG_BUF;\n" % (" " * indent_width))
         elif tok.typ == TokenType.DUP:
             pre_allocator += 1
-            if prev_int:
-                out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-1])
-                prev_int.append(prev_int[-1])
-                drop_prev_int = False
+            if pending_ints:
+                pending_ints.append(pending_ints[-1])
             else:
-                out += "%sPANG_DUP;\n" % (" " * indent_width)
+                flush()
+                out.append("%sPANG_DUP;\n" % (" " * indent_width))
         elif tok.typ == TokenType.BACK:
-            out += "%sPANG_BACK;\n" % (" " * indent_width)
+            flush()
+            out.append("%s%s;\n" % (" " * indent_width, "PANG_BACK_UNCHECKED" if safe[ind] else "PANG_BACK"))
         elif tok.typ == TokenType.FRONT:
-            out += "%sPANG_FRONT;\n" % (" " * indent_width)
+            flush()
+            out.append("%s%s;\n" % (" " * indent_width, "PANG_FRONT_UNCHECKED" if safe[ind] else "PANG_FRONT"))
         elif tok.typ == TokenType.SWAP:
-            if prev.typ == TokenType.SWAP:
-                out = remove_newline(out)
-            elif len(prev_int) >= 2:
-                # Remove two newlines
-                out = remove_newline(out)
-                out = remove_newline(out)
-
-                out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-1])
-                out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-2])
-
-                prev_int[-1], prev_int[-2] = prev_int[-2], prev_int[-1]
-
-                drop_prev_int = False
+            if len(pending_ints) >= 2:
+                pending_ints[-1], pending_ints[-2] = pending_ints[-2], pending_ints[-1]
+            elif pending_swap >= 0:
+                # Two swaps in a row cancel out
+                pending_swap = -1
             else:
-                out += "%sPANG_SWAP;\n" % (" " * indent_width)
-        
-        elif tok.typ == TokenType.ADD:
-            if prev_int:
-                out = remove_newline(out)
+                flush()
+                pending_swap = ind
 
-                if len(prev_int) == 1:
-                    out += "%svars.mem.back() += %d;\n" % (" " * indent_width, prev_int[-1])
-                    prev_int = []
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-2] + prev_int[-1])
-                    
-                    if len(prev_int) <= 2:
-                        prev_int = [prev_int[-2] + prev_int[-1]]
-                    else:
-                        prev_int = prev_int[:-2] + [prev_int[-2] + prev_int[-1]]
-
-                drop_prev_int = False
+        elif tok.typ == TokenType.ADD:
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] += right
+            elif pending_ints:
+                out.append("%svars.mem.back() += %d;\n" % (" " * indent_width, pending_ints.pop()))
             else:
-                if prev.typ == TokenType.SWAP:
-                    out = remove_newline(out)
-                out += "%sPANG_ADD;\n" % (" " * indent_width)
+                # The order does not matter, so a swap before it is left out
+                pending_swap = -1
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(+)" if safe[ind] else "PANG_ADD"))
         elif tok.typ == TokenType.SUB:
-            if prev_int:
-                out = remove_newline(out)
-                
-                if len(prev_int) == 1:
-                    out += "%svars.mem.back() -= %d;\n" % (" " * indent_width, prev_int[-1])
-                    prev_int = []
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-2] - prev_int[-1])
-
-                    if len(prev_int) <= 2:
-                        prev_int = [prev_int[-2] - prev_int[-1]]
-                    else:
-                        prev_int = prev_int[:-2] + [prev_int[-2] - prev_int[-1]]
-                drop_prev_int = False
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] -= right
+            elif pending_ints:
+                out.append("%svars.mem.back() -= %d;\n" % (" " * indent_width, pending_ints.pop()))
             else:
-                out += "%sPANG_SUB;\n" % (" " * indent_width)
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(-)" if safe[ind] else "PANG_SUB"))
         elif tok.typ == TokenType.MUL:
-            if prev_int:
-                cut = out[-out[::-1].find("\n"):]
-                out = remove_newline(out)
-
-                if len(prev_int) == 1:
-                    binary = bin(prev_int[-1])[2:][::-1]
-                    if prev_int[-1] == 1:
-                        out += cut
-                    elif binary.count("1") == 1:
-                        out += "%svars.mem.back() <<= %d;\n" % (" " * indent_width, binary.find("1"))
-                    else:
-                        out += "%svars.mem.back() *= %d;\n" % (" " * indent_width, prev_int[-1])
-                    
-                    prev_int = []
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] *= right
+            elif pending_ints:
+                factor = pending_ints.pop()
+
+                if factor == 1:
+                    # Multiplying by one, nothing to do
+                    pass
+                elif factor > 0 and factor & (factor - 1) == 0:
+                    out.append("%svars.mem.back() <<= %d;\n" % (" " * indent_width, factor.bit_length() - 1))
                 else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, prev_int[-2] * prev_int[-1])
-
-                    if len(prev_int) <= 2:
-                        prev_int = [prev_int[-2] * prev_int[-1]]
-                    else:
-                        prev_int = prev_int[:-2] + [prev_int[-2] * prev_int[-1]]
-                
-                drop_prev_int = False
+                    out.append("%svars.mem.back() *= %d;\n" % (" " * indent_width, factor))
             else:
-                out += "%sPANG_MUL;\n" % (" " * indent_width)
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(*)" if safe[ind] else "PANG_MUL"))
         elif tok.typ == TokenType.DIVMOD:
+            flush()
             direct_divmod = True
 
-            out += "%sPANG_DIVMOD(&vars.mem);\n" % (" " * indent_width)
+            out.append("%sPANG_DIVMOD(&vars.mem);\n" % (" " * indent_width))
         elif tok.typ == TokenType.GREATER_THAN:
-            if prev_int:
-                out = remove_newline(out)
-
-                if len(prev_int) == 1:
-                    out += "%sPUSH_INTEGER(pop(&vars.mem) < %d);\n" % (" " * indent_width, prev_int.pop())
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, (prev_int[-2] < prev_int[-1]))
-                    prev_int[-1] = prev_int.pop(-2) < prev_int[-1]
-                
-                drop_prev_int = False
-            elif prev.typ == TokenType.SWAP:
-                out = remove_newline(out)
-                out += "%sPANG_ST;\n" % (" " * indent_width)
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] = int(pending_ints[-1] < right)
+            elif pending_ints:
+                out.append((
+                    "%svars.mem.back() = vars.mem.back() < %d;\n" if safe[ind]
+                    else "%sPUSH_INTEGER(pop(&vars.mem) < %d);\n") % (" " * indent_width, pending_ints.pop()))
+            elif pending_swap >= 0:
+                pending_swap = -1
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(>)" if safe[ind] else "PANG_ST"))
             else:
-                out += "%sPANG_GT;\n" % (" " * indent_width)
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(<)" if safe[ind] else "PANG_GT"))
         elif tok.typ == TokenType.SMALLER_THAN:
-            if prev_int:
-                out = remove_newline(out)
-
-                if len(prev_int) == 1:
-                    out += "%sPUSH_INTEGER(pop(&vars.mem) > %d);\n" % (" " * indent_width, prev_int.pop())
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, (prev_int[-2] > prev_int[-1]))
-                    prev_int[-1] = prev_int.pop(-2) > prev_int[-1]
-                
-                drop_prev_int = False
-            elif prev.typ == TokenType.SWAP:
-                out = remove_newline(out)
-                out += "%sPANG_GT;\n" % (" " * indent_width)
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] = int(pending_ints[-1] > right)
+            elif pending_ints:
+                out.append((
+                    "%svars.mem.back() = vars.mem.back() > %d;\n" if safe[ind]
+                    else "%sPUSH_INTEGER(pop(&vars.mem) > %d);\n") % (" " * indent_width, pending_ints.pop()))
+            elif pending_swap >= 0:
+                pending_swap = -1
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(<)" if safe[ind] else "PANG_GT"))
             else:
-                out += "%sPANG_ST;\n" % (" " * indent_width)
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(>)" if safe[ind] else "PANG_ST"))
         elif tok.typ == TokenType.EQUAL:
-            if prev.typ == TokenType.SWAP:
-                out = remove_newline(out)
-            
-            if prev_int:
-                out = remove_newline(out)
-
-                if len(prev_int) == 1:
-                    out += "%sPUSH_INTEGER(pop(&vars.mem) == %d);\n" % (" " * indent_width, prev_int.pop())
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, (prev_int[-2] == prev_int[-1]))
-                    prev_int[-1] = prev_int.pop(-2) == prev_int[-1]
-            
-                drop_prev_int = False
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] = int(pending_ints[-1] == right)
+            elif pending_ints:
+                out.append((
+                    "%svars.mem.back() = vars.mem.back() == %d;\n" if safe[ind]
+                    else "%sPUSH_INTEGER(pop(&vars.mem) == %d);\n") % (" " * indent_width, pending_ints.pop()))
             else:
-                out += "%sPANG_EQU;\n" % (" " * indent_width)
+                pending_swap = -1
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(==)" if safe[ind] else "PANG_EQU"))
         elif tok.typ == TokenType.NOT_EQUAL:
-            if prev.typ == TokenType.SWAP:
-                out = remove_newline(out)
-            
-            if prev_int:
-                out = remove_newline(out)
-
-                if len(prev_int) == 1:
-                    out += "%sPUSH_INTEGER(pop(&vars.mem) != %d);\n" % (" " * indent_width, prev_int.pop())
-                else:
-                    out = remove_newline(out)
-                    out += "%sPUSH_INTEGER(%d);\n" % (" " * indent_width, (prev_int[-2] != prev_int[-1]))
-                    prev_int[-1] = prev_int.pop(-2) != prev_int[-1]
-                
-                drop_prev_int = False
+            if len(pending_ints) >= 2:
+                right = pending_ints.pop()
+                pending_ints[-1] = int(pending_ints[-1] != right)
+            elif pending_ints:
+                out.append((
+                    "%svars.mem.back() = vars.mem.back() != %d;\n" if safe[ind]
+                    else "%sPUSH_INTEGER(pop(&vars.mem) != %d);\n") % (" " * indent_width, pending_ints.pop()))
             else:
-                out += "%sPANG_NEQU;\n" % (" " * indent_width)
+                pending_swap = -1
+                flush()
+                out.append("%s%s;\n" % (" " * indent_width, "PANG_UNCHECKED(!=)" if safe[ind] else "PANG_NEQU"))
 
         elif tok.typ == TokenType.WHILE:
-            out += "\n%swhile (pop(&vars.mem)) {\n" % (" " * indent_width)
+            flush()
+            out.append("\n")
+            # The condition is popped by the while and by its end
+            checked = not (safe[ind] and jumps[ind] >= 0 and safe[jumps[ind]])
+            out.append("%swhile (%s) {\n" % (" " * indent_width, "pop(&vars.mem)" if checked else "POP_UNCHECKED"))
             indent_width += 4
         elif tok.typ == TokenType.IF:
-            out += "\n%sif (pop(&vars.mem)) {\n" % (" " * indent_width)
+            flush()
+            out.append("\n")
+            out.append("%sif (%s) {\n" % (" " * indent_width, "POP_UNCHECKED" if safe[ind] else "pop(&vars.mem)"))
             indent_width += 4
         
         elif tok.typ == TokenType.END:
+            flush()
             indent_width -= 4
-            out += "%s}\n\n" % (" " * indent_width)
+            out.append("%s}\n" % (" " * indent_width))
+            out.append("\n")
 
         elif tok.typ == TokenType.SYSCALL:
-            if len(prev_int) >= 2 and prev_int[-1] not in NEWLINE_SYSCALLS:
-                if prev_int[-1] == Syscall.SLEEP.value:
+            if len(pending_ints) >= 2 and pending_ints[-1] not in NEWLINE_SYSCALLS:
+                if pending_ints[-1] == Syscall.SLEEP.value:
                     direct_sleep = True
-                    
-                out = remove_newline(out)
-                out = remove_newline(out)
 
-                out += "%s%s" % ((" " * indent_width, get_syscall(prev_int.pop(), str(prev_int.pop()))))
-            elif prev_int:
-                if prev_int[-1] == Syscall.SLEEP.value:
+                number = pending_ints.pop()
+                code = get_syscall(number, str(pending_ints.pop()))
+                flush()
+
+                if stats:
+                    run_calls[-1][number] = run_calls[-1].get(number, 0) + 1
+
+                    if number == Syscall.RESIZE.value:
+                        code = "STATS_PURGE(0, %s);\n" % code[:-1]
+
+                out.append("%s%s" % (" " * indent_width, code))
+            elif pending_ints:
+                if pending_ints[-1] == Syscall.SLEEP.value:
                     direct_sleep = True
-                elif prev_int[-1] == Syscall.OPEN.value:
+                elif pending_ints[-1] == Syscall.OPEN.value:
                     direct_open = True
-                elif prev_int[-1] == Syscall.READ.value:
+                elif pending_ints[-1] == Syscall.READ.value:
                     direct_read = True
-                elif prev_int[-1] == Syscall.WRITE.value:
+                elif pending_ints[-1] == Syscall.WRITE.value:
                     direct_write = True
-                elif prev_int[-1] == Syscall.CLOSE.value:
+                elif pending_ints[-1] == Syscall.CLOSE.value:
                     direct_close = True
-                    
-                out = remove_newline(out)
+                elif pending_ints[-1] == Syscall.MMAP.value or pending_ints[-1] >= Syscall.MLOAD.value:
+                    direct_mmap = True
+                elif pending_ints[-1] in (Syscall.FORK.value, Syscall.EXEC.value, Syscall.GETPID.value, Syscall.PIPE.value):
+                    direct_process = True
 
-                out += "%s%s" % (" " * indent_width, get_syscall(prev_int.pop()))
+                number = pending_ints.pop()
+                code = get_syscall(number)
+                flush()
+
+                if stats:
+                    run_calls[-1][number] = run_calls[-1].get(number, 0) + 1
+
+                    if number == Syscall.RESIZE.value:
+                        # The count is left on the stack and purged with the items
+                        code = "STATS_PURGE(1, %s);\n" % code[:-1]
+
+                out.append("%s%s" % (" " * indent_width, code))
             else:
+                flush()
                 direct_syscall = True
-                out += "%sPANG_SYSCALL(&vars);\n" % (" " * indent_width)
-        
-        if drop_prev_int:
-            prev_int = []
+                out.append("%sPANG_SYSCALL(&vars);\n" % (" " * indent_width))
 
-        prev = tok
+        if stats and tok.typ in (TokenType.WHILE, TokenType.IF, TokenType.END, TokenType.SYSCALL):
+            # A new run starts after every jump (and syscall, which can exit)
+            run_ops.append({})
+            run_calls.append({})
+            out.append("%sSTATS_RUN(%d);\n" % (" " * indent_width, len(run_ops) - 1))
+
+    flush()
     
     start =  "#include <iostream>\n"
     start += "#include <fstream>\n"
     start += "#include <vector>\n"
     start += "#include <string>\n"
     start += "#include <cstring>\n"
+    start += "#include <algorithm>\n"
+    start += "#include <stdexcept>\n"
+    start += "#include <initializer_list>\n"
+
+    if stats:
+        start += "#include <cstdio>\n"
+        start += "#include <map>\n"
+
     start += "\n"
     
     if direct_syscall or direct_sleep or not optimise:
         start += "#include <chrono>\n"
         start += "#include <thread>\n"
         start += "\n"
+
+    if direct_syscall or direct_mmap or direct_process or not optimise:
+        start += "#if !((defined(WIN32) || defined(_WIN32) || defined(__WIN32)) && !defined(__CYGWIN__))\n"
+        start += "#include <fcntl.h>\n"
+        start += "#include <sys/mman.h>\n"
+        start += "#include <sys/stat.h>\n"
+        start += "#include <unistd.h>\n"
+        start += "#endif\n"
+        start += "\n"
      
     start += "#if (defined(WIN32) || defined(_WIN32) || defined(__WIN32)) && !defined(__CYGWIN__)\n"
     start += "#define ON_WINDOWS\n"
@@ -898,11 +2147,170 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "\n"
     start += "using std::fstream;\n"
     start += "\n"
+
+    if stats:
+        start += "struct Stats {\n"
+        start += "    uint64_t peak = 0;\n"
+        start += "    uint64_t copied = 0;\n"
+        start += "    uint64_t purged = 0;\n"
+        start += "    std::map<int64_t, uint64_t> syscalls;\n"
+        start += "    std::map<int64_t, uint64_t> written;\n"
+        start += "} pang_stats;\n"
+        start += "\n"
+        start += "#define STATS_RUN(run) stats_runs[run]++\n"
+        start += "#define STATS_PEAK(size) if ((size) > pang_stats.peak) { pang_stats.peak = (size); }\n"
+        start += "#define STATS_PURGE(count, code) { size_t before = vars.mem.size(); code; pang_stats.purged += before - vars.mem.size() - (count); }\n"
+        start += "\n"
+    start += "// Contiguous stack with free space at both ends, so pushing to and\n"
+    start += "// popping from the front (back and front) is O(1) like the top.\n"
+    start += "template<typename T> class Stack {\n"
+    start += "    T *data = nullptr;\n"
+    start += "    size_t head = 0;\n"
+    start += "    size_t tail = 0;\n"
+    start += "    size_t cap = 0;\n"
+    start += "\n"
+    start += "    // Makes room for front more items before and back more items after\n"
+    start += "    void grow(size_t front, size_t back) {\n"
+    start += "        size_t count = tail - head;\n"
+    start += "        size_t needed = count + front + back;\n"
+    start += "        T *items = data;\n"
+    start += "\n"
+    start += "        if (needed * 2 > cap) {\n"
+    start += "            cap = std::max(cap * 2, needed + 16);\n"
+    start += "            items = new T[cap];\n"
+    start += "        }\n"
+    start += "\n"
+    start += "        size_t spare = cap - needed;\n"
+    start += "        size_t new_head = front + (front ? spare / 2 : std::min(head, spare / 2));\n"
+    start += "\n"
+    start += "        if (count) {\n"
+    start += "            std::memmove(items + new_head, data + head, count * sizeof(T));\n"
+
+    if stats:
+        start += "            pang_stats.copied += count;\n"
+
+    start += "        }\n"
+    start += "\n"
+    start += "        if (items != data) {\n"
+    start += "            delete[] data;\n"
+    start += "            data = items;\n"
+    start += "        }\n"
+    start += "\n"
+    start += "        head = new_head;\n"
+    start += "        tail = new_head + count;\n"
+    start += "    }\n"
+    start += "\n"
+    start += "public:\n"
+    start += "    Stack() {}\n"
+    start += "    Stack(const Stack &) = delete;\n"
+    start += "    ~Stack() { delete[] data; }\n"
+    start += "\n"
+    start += "    size_t size() const { return tail - head; }\n"
+    start += "    T *begin() { return data + head; }\n"
+    start += "    T *end() { return data + tail; }\n"
+    start += "    T &back() { return data[tail - 1]; }\n"
+    start += "    T &operator[](size_t index) { return data[head + index]; }\n"
+    start += "\n"
+    start += "    T &at(size_t index) {\n"
+    start += "        if (index >= size()) {\n"
+    start += "            throw std::out_of_range(\"Stack::at\");\n"
+    start += "        }\n"
+    start += "        return data[head + index];\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    void reserve(size_t count) {\n"
+    start += "        if (cap - head < count) {\n"
+    start += "            grow(0, count - size());\n"
+    start += "        }\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    void resize(int64_t count) {\n"
+    start += "        if (count < 0) {\n"
+    start += "            std::cerr << \"StackError: Cannot purge more items than are on the stack.\\n\";\n"
+    start += "            exit(1);\n"
+    start += "        }\n"
+    start += "\n"
+    start += "        if ((size_t) count > size()) {\n"
+    start += "            reserve(count);\n"
+    start += "            std::fill(data + tail, data + head + count, T());\n"
+    start += "        }\n"
+    start += "        tail = head + count;\n"
+
+    if stats:
+        start += "        STATS_PEAK(count);\n"
+
+    start += "    }\n"
+    start += "\n"
+    start += "    void push_back(T value) {\n"
+    start += "        if (tail == cap) {\n"
+    start += "            grow(0, 1);\n"
+    start += "        }\n"
+    start += "        data[tail++] = value;\n"
+
+    if stats:
+        start += "        STATS_PEAK(tail - head);\n"
+
+    start += "    }\n"
+    start += "\n"
+    start += "    void push_front(T value) {\n"
+    start += "        if (!head) {\n"
+    start += "            grow(1, 0);\n"
+    start += "        }\n"
+    start += "        data[--head] = value;\n"
+
+    if stats:
+        start += "        STATS_PEAK(tail - head);\n"
+
+    start += "    }\n"
+    start += "\n"
+    start += "    T pop_front() { return data[head++]; }\n"
+    start += "    T pop_back() { return data[--tail]; }\n"
+    start += "\n"
+    start += "    T *erase(T *pos) {\n"
+    start += "        if (pos == begin()) {\n"
+    start += "            head++;\n"
+    start += "            return begin();\n"
+    start += "        }\n"
+    start += "        std::memmove(pos, pos + 1, (end() - pos - 1) * sizeof(T));\n"
+    start += "        tail--;\n"
+    start += "        return pos;\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    template<typename It> void insert(T *pos, It first, It last) {\n"
+    start += "        size_t offset = pos - begin();\n"
+    start += "        size_t count = std::distance(first, last);\n"
+    start += "\n"
+    start += "        if (tail + count > cap) {\n"
+    start += "            grow(0, count);\n"
+    start += "        }\n"
+    start += "\n"
+    start += "        pos = begin() + offset;\n"
+    start += "        std::memmove(pos + count, pos, (end() - pos) * sizeof(T));\n"
+    start += "        std::copy(first, last, pos);\n"
+    start += "        tail += count;\n"
+
+    if stats:
+        start += "        STATS_PEAK(tail - head);\n"
+
+    start += "    }\n"
+    start += "\n"
+    start += "    void insert(T *pos, std::initializer_list<T> values) {\n"
+    start += "        insert(pos, values.begin(), values.end());\n"
+    start += "    }\n"
+    start += "};\n"
+    start += "\n"
+    start += "typedef struct Mapping {\n"
+    start += "    unsigned char *data;\n"
+    start += "    size_t size;\n"
+    start += "    bool writable;\n"
+    start += "} Mapping;\n"
+    start += "\n"
     start += "typedef struct Variables {\n"
     start += "    int64_t exit_code;\n"
     start += "    std::string buf;\n"
-    start += "    std::vector<int64_t> mem;\n"
+    start += "    Stack<int64_t> mem;\n"
     start += "    std::vector<fstream> open_files;\n"
+    start += "    std::vector<Mapping> maps;\n"
     start += "} Variables;\n"
     start += "\n"
     start += "#define SYSCALL_FORK 1\n"
@@ -929,10 +2337,16 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "#define SYSCALL_POINTER 17\n"
     start += "#define SYSCALL_LENGTH 18\n"
     start += "\n"
+    start += "#define SYSCALL_MLOAD 19\n"
+    start += "#define SYSCALL_MSTORE 20\n"
+    start += "#define SYSCALL_MLOAD64 21\n"
+    start += "#define SYSCALL_MSTORE64 22\n"
+    start += "#define SYSCALL_MUNMAP 23\n"
+    start += "\n"
     start += "#define READALL -1\n"
     start += "#define READLINE 0\n"
     start += "\n"
-    start += "template<typename T> T pop(std::vector<T> *stack, int64_t index = -1) {\n"
+    start += "template<typename T> T pop(Stack<T> *stack, int64_t index = -1) {\n"
     start += "    T value;\n"
     start += "    if ((int64_t) stack->size() < index) {\n"
     start += "        std::cerr << \"StackError: Cannot pop from stack.\\n\";\n"
@@ -950,9 +2364,18 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "    return value;\n"
     start += "}\n"
     start += "\n"
+    start += "template<typename T> T pop_front(Stack<T> *stack) {\n"
+    start += "    if (!stack->size()) {\n"
+    start += "        std::cerr << \"StackError: Cannot pop from stack.\\n\";\n"
+    start += "        exit(1);\n"
+    start += "    }\n"
+    start += "\n"
+    start += "    return stack->pop_front();\n"
+    start += "}\n"
+    start += "\n"
     
     if direct_divmod or not optimise:
-        start += "template<typename T> void PANG_DIVMOD(std::vector<T> *stack) {\n"
+        start += "template<typename T> void PANG_DIVMOD(Stack<T> *stack) {\n"
         start += "    T denominator = pop(stack);\n"
         start += "    T numerator = pop(stack);\n"
         start += "\n"
@@ -964,18 +2387,27 @@ def compile_ops(toks: list, optimise: bool) -> str:
 
     if direct_open or direct_syscall or not optimise:
         start += "std::ios_base::openmode flags_to_mode(std::string flags) {\n"
+        start += "    std::ios_base::openmode binary = std::ios_base::openmode();\n"
+        start += "    size_t binary_flag = flags.find('b');\n"
+        start += "\n"
+        start += "    // rb, wb, r+b, rb+ and so on\n"
+        start += "    if (binary_flag != std::string::npos) {\n"
+        start += "        binary = std::ios::binary;\n"
+        start += "        flags.erase(binary_flag, 1);\n"
+        start += "    }\n"
+        start += "\n"
         start += "    if (flags == \"r\") {\n"
-        start += "        return std::ios::in;\n"
+        start += "        return std::ios::in | binary;\n"
         start += "    } else if (flags == \"w\") {\n"
-        start += "        return std::ios::out | std::ios::trunc;\n"
+        start += "        return std::ios::out | std::ios::trunc | binary;\n"
         start += "    } else if (flags == \"a\") {\n"
-        start += "        return std::ios::out | std::ios::app;\n"
+        start += "        return std::ios::out | std::ios::app | binary;\n"
         start += "    } else if (flags == \"r+\") {\n"
-        start += "        return std::ios::out | std::ios::in;\n"
+        start += "        return std::ios::out | std::ios::in | binary;\n"
         start += "    } else if (flags == \"w+\") {\n"
-        start += "        return std::ios::out | std::ios::in | std::ios::trunc;\n"
+        start += "        return std::ios::out | std::ios::in | std::ios::trunc | binary;\n"
         start += "    } else if (flags == \"a+\") {\n"
-        start += "        return std::ios::out | std::ios::in | std::ios::app;\n"
+        start += "        return std::ios::out | std::ios::in | std::ios::app | binary;\n"
         start += "    } else {\n"
         start += "        std::cerr << \"FlagError: Invalid flag for open \\\"\"\n"
         start += "                  << flags\n"
@@ -1030,7 +2462,7 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "            delete[] buf;\n"
         start += "        }\n"
         start += "\n"
-        start += "        vars->mem.insert(vars->mem.end(), contents.begin(), contents.end());\n"
+        start += "        vars->mem.insert(vars->mem.end(), (unsigned char*) contents.data(), (unsigned char*) contents.data() + contents.size());\n"
         start += "        vars->mem.push_back(contents.length());\n"
         start += "\n"
         start += "        return;\n"
@@ -1049,6 +2481,37 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "        std::getline(*file_ptr, contents);\n"
         start += "    } else {\n"
         start += "        file_ptr->seekg(0, file_ptr->end);\n"
+        start += "\n"
+        start += "        if (file_ptr->tellg() < 0) {\n"
+        start += "            // Pipes cannot seek, they are read until read_typ bytes or their end\n"
+        start += "            std::vector<char> chunk(%d);\n" % READ_CHUNK_SIZE
+        start += "            size_t total = 0;\n"
+        start += "\n"
+        start += "            file_ptr->clear();\n"
+        start += "\n"
+        start += "            while (read_typ == READALL || total < (size_t) read_typ) {\n"
+        start += "                size_t wanted = chunk.size();\n"
+        start += "\n"
+        start += "                if (read_typ != READALL && read_typ - total < wanted) {\n"
+        start += "                    wanted = read_typ - total;\n"
+        start += "                }\n"
+        start += "\n"
+        start += "                file_ptr->read(chunk.data(), wanted);\n"
+        start += "                size_t got = file_ptr->gcount();\n"
+        start += "\n"
+        start += "                if (!got) {\n"
+        start += "                    break;\n"
+        start += "                }\n"
+        start += "\n"
+        start += "                vars->mem.insert(vars->mem.end(), (unsigned char*) chunk.data(), (unsigned char*) chunk.data() + got);\n"
+        start += "                total += got;\n"
+        start += "            }\n"
+        start += "\n"
+        start += "            file_ptr->clear();\n"
+        start += "            vars->mem.push_back(total);\n"
+        start += "            return;\n"
+        start += "        }\n"
+        start += "\n"
         start += "        size_t length = file_ptr->tellg();\n"
         start += "        file_ptr->seekg(0, file_ptr->beg);\n"
         start += "\n"
@@ -1070,12 +2533,15 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "            exit(1);\n"
         start += "        }\n"
         start += "\n"
-        start += "        contents.assign(buf, length);\n"
+        start += "        // Bytes go straight from the buffer to the stack\n"
+        start += "        vars->mem.insert(vars->mem.end(), (unsigned char*) buf, (unsigned char*) buf + length);\n"
+        start += "        vars->mem.push_back(length);\n"
         start += "\n"
         start += "        delete[] buf;\n"
+        start += "        return;\n"
         start += "    }\n"
         start += "\n"
-        start += "    vars->mem.insert(vars->mem.end(), contents.begin(), contents.end());\n"
+        start += "    vars->mem.insert(vars->mem.end(), (unsigned char*) contents.data(), (unsigned char*) contents.data() + contents.size());\n"
         start += "    vars->mem.push_back(contents.length());\n"
         start += "}\n"
         start += "\n"
@@ -1084,6 +2550,10 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "void PANG_WRITE(Variables *vars) {\n"
         start += "    int64_t fd = pop(&vars->mem) - 3;\n"
         start += "\n"
+
+        if stats:
+            start += "    pang_stats.written[fd + 3] += vars->buf.size();\n"
+            start += "\n"
         start += "    if (fd >= 0) {\n"
         start += "        vars->open_files[fd] << vars->buf;\n"
         start += "        vars->open_files[fd].flush();\n"
@@ -1128,9 +2598,179 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "}\n"
         start += "\n"
 
-    if direct_buf or not optimise:
-        start += "#define PANG_BUF \\\n"
-        start += "    switch (pop(&vars.mem)) { \\\n"
+    if direct_process or direct_syscall or not optimise:
+        start += "void PANG_FORK(Variables *vars) {\n"
+        start += "    #ifdef ON_WINDOWS\n"
+        start += "    std::cerr << \"CommandError: fork is not supported on windows.\\n\";\n"
+        start += "    exit(1);\n"
+        start += "    #else\n"
+        start += "    // Otherwise whatever is waiting to be written comes out twice\n"
+        start += "    std::cout.flush();\n"
+        start += "    std::cerr.flush();\n"
+        start += "\n"
+        start += "    pid_t pid = fork();\n"
+        start += "\n"
+        start += "    if (pid < 0) {\n"
+        start += "        std::cerr << \"CommandError: Could not fork.\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    vars->mem.push_back(pid);\n"
+        start += "    #endif\n"
+        start += "}\n"
+        start += "\n"
+        start += "void PANG_EXEC(Variables *vars) {\n"
+        start += "    int64_t length = pop(&vars->mem);\n"
+        start += "    std::string command(vars->mem.end() - length, vars->mem.end());\n"
+        start += "    vars->mem.resize(vars->mem.size() - length);\n"
+        start += "\n"
+        start += "    #ifdef ON_WINDOWS\n"
+        start += "    std::cerr << \"CommandError: exec is not supported on windows.\\n\";\n"
+        start += "    #else\n"
+        start += "    std::cout.flush();\n"
+        start += "    std::cerr.flush();\n"
+        start += "\n"
+        start += "    execl(\"/bin/sh\", \"sh\", \"-c\", command.c_str(), (char*) NULL);\n"
+        start += "    std::cerr << \"FileError: Could not execute \" << command << \".\\n\";\n"
+        start += "    #endif\n"
+        start += "    exit(1);\n"
+        start += "}\n"
+        start += "\n"
+        start += "void PANG_GETPID(Variables *vars) {\n"
+        start += "    #ifdef ON_WINDOWS\n"
+        start += "    std::cerr << \"CommandError: getpid is not supported on windows.\\n\";\n"
+        start += "    exit(1);\n"
+        start += "    #else\n"
+        start += "    vars->mem.push_back(getpid());\n"
+        start += "    #endif\n"
+        start += "}\n"
+        start += "\n"
+        start += "void PANG_PIPE(Variables *vars) {\n"
+        start += "    #ifdef ON_WINDOWS\n"
+        start += "    std::cerr << \"CommandError: pipe is not supported on windows.\\n\";\n"
+        start += "    exit(1);\n"
+        start += "    #else\n"
+        start += "    int ends[2];\n"
+        start += "\n"
+        start += "    if (pipe(ends) < 0) {\n"
+        start += "        std::cerr << \"FileError: Could not create a pipe.\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    // fstream cannot take a descriptor, so the ends are opened again\n"
+        start += "    // through /proc and the original descriptors closed.\n"
+        start += "    vars->mem.push_back(vars->open_files.size() + 3);\n"
+        start += "    vars->open_files.push_back(fstream(\"/proc/self/fd/\" + std::to_string(ends[0]), std::ios::in | std::ios::binary));\n"
+        start += "    vars->mem.push_back(vars->open_files.size() + 3);\n"
+        start += "    vars->open_files.push_back(fstream(\"/proc/self/fd/\" + std::to_string(ends[1]), std::ios::out | std::ios::binary));\n"
+        start += "\n"
+        start += "    close(ends[0]);\n"
+        start += "    close(ends[1]);\n"
+        start += "\n"
+        start += "    if (!vars->open_files.back() || !vars->open_files[vars->open_files.size() - 2]) {\n"
+        start += "        std::cerr << \"FileError: Could not open the pipe.\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "    #endif\n"
+        start += "}\n"
+        start += "\n"
+
+    if direct_mmap or direct_syscall or not optimise:
+        start += "Mapping *get_mapping(Variables *vars, int64_t handle) {\n"
+        start += "    if (handle < 0 || handle >= (int64_t) vars->maps.size() || !vars->maps[handle].data) {\n"
+        start += "        std::cerr << \"FileError: Invalid memory map - \" << handle << '\\n';\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    return &vars->maps[handle];\n"
+        start += "}\n"
+        start += "\n"
+        start += "// Pops a handle and an offset, returns where width bytes can be accessed\n"
+        start += "unsigned char *map_offset(Variables *vars, size_t width, bool store) {\n"
+        start += "    int64_t handle = pop(&vars->mem);\n"
+        start += "    int64_t offset = pop(&vars->mem);\n"
+        start += "    Mapping *map = get_mapping(vars, handle);\n"
+        start += "\n"
+        start += "    if (offset < 0 || offset + width > map->size) {\n"
+        start += "        std::cerr << \"FileError: Offset \" << offset << \" is outside of memory map \" << handle << '\\n';\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    if (store && !map->writable) {\n"
+        start += "        std::cerr << \"FileError: Memory map \" << handle << \" is read-only.\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    return map->data + offset;\n"
+        start += "}\n"
+        start += "\n"
+        start += "void PANG_MMAP(Variables *vars) {\n"
+        start += "    int64_t length = pop(&vars->mem);\n"
+        start += "    std::string flags(vars->mem.end() - length, vars->mem.end());\n"
+        start += "    vars->mem.resize(vars->mem.size() - length);\n"
+        start += "\n"
+        start += "    length = pop(&vars->mem);\n"
+        start += "    std::string filename(vars->mem.end() - length, vars->mem.end());\n"
+        start += "    vars->mem.resize(vars->mem.size() - length);\n"
+        start += "\n"
+        start += "    flags.erase(std::remove(flags.begin(), flags.end(), 'b'), flags.end());\n"
+        start += "\n"
+        start += "    if (flags != \"r\" && flags != \"r+\") {\n"
+        start += "        std::cerr << \"FileError: Invalid mode for mmap \\\"\" << flags << \"\\\".\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    #ifdef ON_WINDOWS\n"
+        start += "    std::cerr << \"FileError: mmap is not supported on windows.\\n\";\n"
+        start += "    exit(1);\n"
+        start += "    #else\n"
+        start += "    bool writable = flags == \"r+\";\n"
+        start += "    int fd = open(filename.c_str(), writable ? O_RDWR : O_RDONLY);\n"
+        start += "    struct stat info;\n"
+        start += "\n"
+        start += "    if (fd < 0 || fstat(fd, &info) < 0) {\n"
+        start += "        std::cerr << \"FileError: Could not open \" << filename << \".\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    if (!info.st_size) {\n"
+        start += "        std::cerr << \"FileError: Cannot map the empty file \" << filename << \".\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    void *data = mmap(NULL, info.st_size, writable ? PROT_READ | PROT_WRITE : PROT_READ, MAP_SHARED, fd, 0);\n"
+        start += "    close(fd);\n"
+        start += "\n"
+        start += "    if (data == MAP_FAILED) {\n"
+        start += "        std::cerr << \"FileError: Could not map \" << filename << \".\\n\";\n"
+        start += "        exit(1);\n"
+        start += "    }\n"
+        start += "\n"
+        start += "    vars->mem.push_back(info.st_size);\n"
+        start += "    vars->mem.push_back(vars->maps.size());\n"
+        start += "    vars->maps.push_back({(unsigned char*) data, (size_t) info.st_size, writable});\n"
+        start += "    #endif\n"
+        start += "}\n"
+        start += "\n"
+        start += "void PANG_MUNMAP(Variables *vars) {\n"
+        start += "    int64_t handle = pop(&vars->mem);\n"
+        start += "    Mapping *map = get_mapping(vars, handle);\n"
+        start += "\n"
+        start += "    #ifndef ON_WINDOWS\n"
+        start += "    munmap(map->data, map->size);\n"
+        start += "    #endif\n"
+        start += "    map->data = NULL;\n"
+        start += "}\n"
+        start += "\n"
+        start += "#define PANG_MLOAD(vars) (vars)->mem.push_back(*map_offset(vars, 1, false))\n"
+        start += "#define PANG_MSTORE(vars) { unsigned char *at = map_offset(vars, 1, true); *at = pop(&(vars)->mem); }\n"
+        start += "#define PANG_MLOAD64(vars) { int64_t word; std::memcpy(&word, map_offset(vars, 8, false), 8); (vars)->mem.push_back(word); }\n"
+        start += "#define PANG_MSTORE64(vars) { unsigned char *at = map_offset(vars, 8, true); int64_t word = pop(&(vars)->mem); std::memcpy(at, &word, 8); }\n"
+        start += "\n"
+
+    if direct_buf or not optimise:
+        start += "#define PANG_BUF \\\n"
+        start += "    switch (pop(&vars.mem)) { \\\n"
         start += "        case 0: { vars.buf += std::to_string(vars.mem.back()); break; } \\\n"
         start += "        case 1: { vars.buf += vars.mem.back(); break; } \\\n"
         start += "    \\\n"
@@ -1144,25 +2784,43 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "void PANG_SYSCALL(Variables *vars) {\n"
         start += "    int64_t syscall_num = pop(&vars->mem);\n"
         start += "\n"
+
+        if stats:
+            start += "    pang_stats.syscalls[syscall_num]++;\n"
+            start += "\n"
         start += "    switch (syscall_num) {\n"
+        start += "        case SYSCALL_FORK: { PANG_FORK(vars); break; }\n"
         start += "        case SYSCALL_EXIT: { exit(pop(&vars->mem)); }\n"
+        start += "        case SYSCALL_EXEC: { PANG_EXEC(vars); break; }\n"
         start += "\n"
         start += "        case SYSCALL_OPEN: { PANG_OPEN(vars); break; }\n"
         start += "        case SYSCALL_READ: { PANG_READ(vars); break; }\n"
         start += "        case SYSCALL_WRITE: { PANG_WRITE(vars); break; }\n"
         start += "        case SYSCALL_CLOSE: { PANG_CLOSE(vars); break; }\n"
         start += "\n"
+        start += "        case SYSCALL_GETPID: { PANG_GETPID(vars); break; }\n"
         start += "        case SYSCALL_SLEEP: {\n"
         start += "            std::this_thread::sleep_for(std::chrono::milliseconds(pop(&vars->mem)));\n"
         start += "            break;\n"
         start += "        }\n"
         start += "\n"
+        start += "        case SYSCALL_PIPE: { PANG_PIPE(vars); break; }\n"
         start += "        case SYSCALL_RESIZE: {\n"
+
+        if stats:
+            start += "            size_t before = vars->mem.size();\n"
+            start += "\n"
+
         start += "            if (vars->mem.back() > 0) {\n"
         start += "                vars->mem.resize(((int64_t) vars->mem.size()) - vars->mem.back() - 1);\n"
         start += "            } else {\n"
         start += "                vars->mem.resize(-pop(&vars->mem));\n"
         start += "            }\n"
+
+        if stats:
+            start += "\n"
+            start += "            pang_stats.purged += before - vars->mem.size() - 1;\n"
+
         start += "            break;\n"
         start += "        }\n"
         start += "\n"
@@ -1175,6 +2833,13 @@ def compile_ops(toks: list, optimise: bool) -> str:
         start += "            break;\n"
         start += "        }\n"
         start += "        case SYSCALL_LENGTH: { vars->mem.push_back(vars->mem.size()); break; }\n"
+        start += "\n"
+        start += "        case SYSCALL_MMAP: { PANG_MMAP(vars); break; }\n"
+        start += "        case SYSCALL_MLOAD: { PANG_MLOAD(vars); break; }\n"
+        start += "        case SYSCALL_MSTORE: { PANG_MSTORE(vars); break; }\n"
+        start += "        case SYSCALL_MLOAD64: { PANG_MLOAD64(vars); break; }\n"
+        start += "        case SYSCALL_MSTORE64: { PANG_MSTORE64(vars); break; }\n"
+        start += "        case SYSCALL_MUNMAP: { PANG_MUNMAP(vars); break; }\n"
         start += "    }\n"
         start += "}\n"
         start += "\n"
@@ -1182,8 +2847,8 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "#define PUSH_INTEGER(x) vars.mem.push_back(x)\n"
     start += "#define PANG_DUP   vars.mem.push_back(vars.mem.back())\n"
     start += "\n"
-    start += "#define PANG_BACK  vars.mem.insert(vars.mem.begin(), pop(&vars.mem))\n"
-    start += "#define PANG_FRONT vars.mem.push_back(pop(&vars.mem, 0))\n"
+    start += "#define PANG_BACK  vars.mem.push_front(pop(&vars.mem))\n"
+    start += "#define PANG_FRONT vars.mem.push_back(pop_front(&vars.mem))\n"
     start += "#define PANG_SWAP  vars.mem.push_back(pop(&vars.mem, -2))\n"
     start += "\n"
     start += "#define PANG_ADD vars.mem.push_back(pop(&vars.mem, -2) + pop(&vars.mem))\n"
@@ -1195,6 +2860,17 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "#define PANG_EQU vars.mem.push_back(pop(&vars.mem, -2) == pop(&vars.mem))\n"
     start += "#define PANG_NEQU vars.mem.push_back(pop(&vars.mem, -2) != pop(&vars.mem))\n"
     start += "\n"
+    start += "// For instructions that always have the items they need (see stack_depths)\n"
+    start += "#define POP_UNCHECKED vars.mem.pop_back()\n"
+    start += "#define PANG_UNCHECKED(op) { int64_t right = vars.mem.pop_back(); vars.mem.back() = vars.mem.back() op right; }\n"
+    start += "\n"
+    start += "#define PANG_BACK_UNCHECKED  vars.mem.push_front(vars.mem.pop_back())\n"
+    start += "#define PANG_FRONT_UNCHECKED vars.mem.push_back(vars.mem.pop_front())\n"
+    start += "#define PANG_SWAP_UNCHECKED  std::swap(vars.mem.back(), vars.mem[vars.mem.size() - 2])\n"
+    start += "\n"
+
+    if stats:
+        start += compile_stats(run_ops, run_calls)
     start += "int main(int argc, char *argv[]) {\n"
     start += "    #ifdef ON_WINDOWS\n"
     start += "    setlocale(LC_ALL, \".utf-8\");\n"
@@ -1206,22 +2882,761 @@ def compile_ops(toks: list, optimise: bool) -> str:
     start += "    vars.buf = \"\";\n"
     start += "\n"
 
+    if stats:
+        start += "    std::atexit(stats_report);\n"
+        start += "\n"
+
+    # The stack never grows by more than peak items over argv, when a loop
+    # or a syscall can grow it without a limit it starts with some room.
     # For performance reasons, there may be multiple if statements that
     # do not get ran. So after 1024 bytes, simply allow the vector to grow naturally.
-    if pre_allocator < MAX_PREALLOC:
+    if peak is not None:
+        start += "    vars.mem.reserve(%d);\n" % PRE_ARGV_ALLOCATE
+    elif pre_allocator < MAX_PREALLOC:
         pre_allocator = 1 << (pre_allocator.bit_length())
         start += "    vars.mem.reserve(%d);\n" % pre_allocator
     else:
         start += "    vars.mem.reserve(%d);\n" % MAX_PREALLOC
-    
     start += "\n"
     start += "    for (; *argv; argv++) {\n"
     start += "        vars.mem.insert(vars.mem.end(), (unsigned char*) *argv, (unsigned char*) (*argv) + strlen(*argv));\n"
     start += "        vars.mem.push_back(strlen(*argv));\n"
     start += "    }\n"
-    start += "    vars.mem.push_back(argc);\n\n"
+    start += "    vars.mem.push_back(argc);\n"
+
+    if peak:
+        start += "    vars.mem.reserve(vars.mem.size() + %d);\n" % peak
+
+    start += "\n"
+    
+    return start + "".join(out) + "}"
+
+class PythonCodegen():
+    """ Translates a program into the source of one Python function.
+
+        Stack items produced inside a straight line of code are kept as
+        Python locals and expressions (the virtual stack, vstack) and only
+        written to mem at branches, loops and syscalls that need the real
+        stack. if and while become Python if and while statements. Values
+        stay Python ints, so programs keep the interpreter's bignum
+        semantics. """
+
+    # Kinds of virtual stack items
+    CONST = 0 # int literal (code is its repr)
+    NAME = 1 # local variable
+    EXPR = 2 # side effect free int expression
+    COND = 3 # comparison, a bool that must be turned into an int
+
+    # Operators that cannot raise as (python operator, constant folding)
+    binary_ops = {
+        OP_SUB: ("-", lambda left, right: left - right),
+        OP_ADD: ("+", lambda left, right: left + right),
+        OP_MUL: ("*", lambda left, right: left * right),
+        OP_BITAND: ("&", lambda left, right: left & right),
+        OP_BITOR: ("|", lambda left, right: left | right),
+        OP_EXCOR: ("^", lambda left, right: left ^ right),
+    }
+
+    compare_ops = {
+        OP_EQUAL: ("==", lambda left, right: left == right),
+        OP_NOT_EQUAL: ("!=", lambda left, right: left != right),
+        OP_GREATER_THAN: ("<", lambda left, right: left < right),
+        OP_SMALLER_THAN: (">", lambda left, right: left > right),
+    }
+
+    # Longer expressions are stored in a local first
+    max_expr = 120
+
+    def __init__(self, program: Program) -> None:
+        self.program = program
+        self.ops = program.ops
+        self.operands = program.operands
+        self.jumps = resolve_jumps(program)
+        self.safe = stack_safe(program, stack_depths(program, self.jumps)[0])
+        self.vstack: list[tuple[str, int]] = []
+        self.temps = 0
+        self.indent = 1
+        self.ind = 0
+        self.out = ["def pang_main():"]
+        self.line_map = [0]
+
+    def emit(self, line: str) -> None:
+        self.out.append("    " * self.indent + line)
+        self.line_map.append(self.ind)
+
+    def temp(self) -> str:
+        self.temps += 1
+        return "t%d" % self.temps
+
+    def value(self, item: tuple[str, int]) -> str:
+        """ Code for the item as an int """
+        code, kind = item
+        return "int(%s)" % code if kind == self.COND else code
+
+    def operand(self, item: tuple[str, int], bitwise: bool = False) -> str:
+        """ Code for the item inside a larger expression """
+        code, kind = item
+
+        if kind == self.COND and bitwise:
+            return "int(%s)" % code
+        if kind == self.EXPR or kind == self.COND:
+            return "(%s)" % code
+
+        return code
+
+    def store(self, item: tuple[str, int]) -> tuple[str, int]:
+        """ Evaluates an expression into a local """
+        if item[1] == self.CONST or item[1] == self.NAME:
+            return item
+
+        name = self.temp()
+        self.emit("%s = %s" % (name, self.value(item)))
+        return (name, self.NAME)
+
+    def push(self, item: tuple[str, int]) -> None:
+        if item[1] != self.CONST and len(item[0]) > self.max_expr:
+            item = self.store(item)
+
+        self.vstack.append(item)
+
+    def pull(self, count: int) -> None:
+        """ Makes sure the top count items are on the virtual stack """
+        while len(self.vstack) < count:
+            name = self.temp()
+            self.emit("%s = pop()" % name)
+            self.vstack.insert(0, (name, self.NAME))
+
+    def pop(self) -> tuple[str, int]:
+        self.pull(1)
+        return self.vstack.pop()
+
+    def flush(self) -> None:
+        """ Writes the virtual stack to mem """
+        if len(self.vstack) == 1:
+            self.emit("append(%s)" % self.value(self.vstack[0]))
+        elif self.vstack:
+            self.emit("extend((%s))" % ", ".join(self.value(item) for item in self.vstack))
+
+        self.vstack.clear()
+
+    def const(self, value: int) -> tuple[str, int]:
+        return (repr(value), self.CONST)
+
+    def unstructured(self, ind: int) -> None:
+        Croak(
+            ErrorType.Compile,
+            "block at line %d cannot be translated to python, use another engine" % self.program.lines[ind])
+
+    def generate(self) -> str:
+        self.block(0, len(self.ops))
+        self.emit("pass")
+
+        return "\n".join(self.out) + "\n"
+
+    def block(self, start: int, stop: int) -> None:
+        """ Translates the instructions in [start, stop) """
+        ind = start
+
+        while ind < stop:
+            self.ind = ind
+            op = self.ops[ind]
+
+            if op == OP_IF or op == OP_WHILE:
+                ind = self.branch(ind, stop)
+                continue
+            elif op == OP_END and self.jumps[ind] >= 0:
+                self.unstructured(self.jumps[ind])
+
+            self.instruction(op, ind)
+            ind += 1
+
+        self.ind = stop - 1
+
+    def branch(self, ind: int, stop: int) -> int:
+        end = self.jumps[ind]
+
+        if end >= stop or self.jumps[end] != (ind if self.ops[ind] == OP_WHILE else -1):
+            self.unstructured(ind)
+
+        if self.ops[ind] == OP_IF:
+            cond = self.pop()
+            self.flush()
+            self.emit("if %s:" % cond[0])
+        else:
+            cond = self.vstack.pop()[0] if self.vstack else self.while_condition(ind)
+            self.flush()
+            self.emit("if %s:" % cond)
+            self.indent += 1
+            self.emit("while True:")
+
+        self.indent += 1
+        lines = len(self.out)
+        self.block(ind + 1, end)
+
+        if self.ops[ind] == OP_WHILE:
+            self.ind = end
+            cond = self.vstack.pop()[0] if self.vstack else self.while_condition(end)
+            self.flush()
+            self.emit("if not (%s):" % cond)
+            self.emit("    break")
+            self.indent -= 1
+        else:
+            self.flush()
+
+            if len(self.out) == lines:
+                self.emit("pass")
+
+        self.indent -= 1
+        return end + 1
+
+    def while_condition(self, ind: int) -> str:
+        """ Code popping the condition of a while (or its end) from mem,
+            which is not popped when mem is empty """
+        return "pop()" if self.safe[ind] else "mem and pop()"
+
+    def instruction(self, op: int, ind: int) -> None:
+        if op == OP_INT:
+            self.push(self.const(self.operands[ind]))
+        elif op == OP_STR:
+            self.push_str(self.program.literals[self.operands[ind]])
+        elif op in self.binary_ops:
+            symbol, fold = self.binary_ops[op]
+            right, left = self.pop(), self.pop()
+
+            if left[1] == right[1] == self.CONST:
+                self.push(self.const(fold(int(left[0]), int(right[0]))))
+            else:
+                bitwise = op in (OP_BITAND, OP_BITOR, OP_EXCOR)
+                self.push(("%s %s %s" % (
+                    self.operand(left, bitwise), symbol, self.operand(right, bitwise)), self.EXPR))
+        elif op in self.compare_ops:
+            symbol, fold = self.compare_ops[op]
+            right, left = self.pop(), self.pop()
+
+            if left[1] == right[1] == self.CONST:
+                self.push(self.const(int(fold(int(left[0]), int(right[0])))))
+            else:
+                self.push(("%s %s %s" % (
+                    self.operand(left), symbol, self.operand(right)), self.COND))
+        elif op == OP_LSHIFT or op == OP_RSHIFT:
+            right, left = self.pop(), self.pop()
+            name = self.temp()
+            self.emit("%s = %s %s %s" % (
+                name, self.operand(left), "<<" if op == OP_LSHIFT else ">>", self.operand(right)))
+            self.push((name, self.NAME))
+        elif op == OP_DIVMOD:
+            right, left = self.pop(), self.pop()
+            quotient, remainder = self.temp(), self.temp()
+            self.emit("%s, %s = divmod(%s, %s)" % (quotient, remainder, self.value(left), self.value(right)))
+            self.push((quotient, self.NAME))
+            self.push((remainder, self.NAME))
+        elif op == OP_DUP:
+            if self.vstack:
+                self.vstack[-1] = self.store(self.vstack[-1])
+                self.push(self.vstack[-1])
+            else:
+                name = self.temp()
+                self.emit("%s = mem[-1]" % name)
+                self.push((name, self.NAME))
+        elif op == OP_SWAP:
+            self.pull(2)
+            self.vstack[-2], self.vstack[-1] = self.vstack[-1], self.vstack[-2]
+        elif op == OP_BITNOT:
+            name = self.temp()
+            self.emit("%s = bitnot(%s)" % (name, self.value(self.pop())))
+            self.push((name, self.NAME))
+        elif op == OP_BACK:
+            if len(self.vstack) >= 2:
+                self.emit("appendleft(%s)" % self.value(self.vstack.pop()))
+            else:
+                self.flush()
+                self.emit("appendleft(pop())" if self.safe[ind] else "back()")
+        elif op == OP_FRONT:
+            self.flush()
+            self.emit("append(popleft())" if self.safe[ind] else "front()")
+        elif op == OP_BUF:
+            self.buf()
+        elif op == OP_SYSCALL:
+            self.syscall()
+
+    def push_str(self, literal: tuple[int, ...]) -> None:
+        if len(literal) > 16:
+            self.flush()
+            self.emit("extend(%r)" % (literal,))
+        else:
+            for ch in literal:
+                self.push(self.const(ch))
+
+    def buf(self) -> None:
+        to_put = self.pop()
+        self.pull(1)
+        self.vstack[-1] = top = self.store(self.vstack[-1])
+
+        if to_put[1] != self.CONST:
+            self.emit("out(chr(%s) if %s else str(%s))" % (top[0], to_put[0], top[0]))
+        elif int(to_put[0]):
+            self.emit("out(chr(%s))" % top[0])
+        else:
+            self.emit("out(str(%s))" % top[0])
+
+    def syscall(self) -> None:
+        number = self.pop()
+
+        if number[1] != self.CONST:
+            self.flush()
+            self.emit("append(%s)" % self.value(number))
+            self.emit("syscall()")
+            self.emit("if vm.exit_code is not None:")
+            self.emit("    return")
+            return
+
+        number = int(number[0])
+
+        if number == Syscall.EXIT.value:
+            self.emit("vm.exit_code = %s" % self.value(self.pop()))
+            self.emit("return")
+        elif number == Syscall.SLEEP.value:
+            self.emit("sleep(%s / 1000)" % self.operand(self.pop()))
+        elif number == Syscall.CLOSE.value:
+            self.emit("vm.close(%s)" % self.value(self.pop()))
+        elif number == Syscall.LENGTH.value:
+            name = self.temp()
+            self.emit("%s = len(mem) + %d" % (name, len(self.vstack)))
+            self.push((name, self.NAME))
+        elif number == Syscall.POINTER.value:
+            index = self.pop()
+            self.flush()
+            name = self.temp()
+            self.emit("%s = mem[%s]" % (name, self.value(index)))
+            self.push((name, self.NAME))
+        elif number == Syscall.RESIZE.value:
+            purge = self.pop()
+
+            if purge[1] == self.CONST and 0 < int(purge[0]) <= len(self.vstack):
+                # Only items that were never written to mem are purged
+                del self.vstack[-int(purge[0]):]
+            else:
+                self.flush()
+                self.emit("purge(%s)" % self.value(purge))
+        else:
+            self.flush()
+            self.emit("append(%d)" % number)
+            self.emit("syscall()")
+
+def compile_python(program: Program) -> tuple[str, list[int]]:
+    """ Compiles to the source of a python function, pang_main.
+
+        Also returns the instruction index of every line of the source, used
+        to report errors at the right pang line. """
+    codegen = PythonCodegen(program)
+    return codegen.generate(), codegen.line_map
+
+def write_bytecode(program: Program, filename: str) -> None:
+    """ Writes an expanded program to a .pangc file.
+
+        Layout (little endian):
+            magic, u16 version, u32 instruction count
+            u8 opcode, i32 line, u32 filename index per instruction (as columns)
+            u8 1 then i64 operands, or u8 0 then (u16 length, signed bytes) per operand
+            u32 filename count, then (u32 length, utf-8 bytes) per filename
+            u32 literal count, then (u32 length, utf-8 bytes) per string literal
+    """
+    def pack_strings(strings: list[str]) -> list[bytes]:
+        packed = [struct.pack("<I", len(strings))]
+
+        for string in strings:
+            encoded = string.encode("utf-8", "surrogatepass")
+            packed.append(struct.pack("<I", len(encoded)) + encoded)
+
+        return packed
+
+    def column(values: array) -> bytes:
+        if sys.byteorder == "big":
+            values = array(values.typecode, values)
+            values.byteswap()
+
+        return values.tobytes()
+
+    out = [
+        BYTECODE_MAGIC,
+        struct.pack("<HI", BYTECODE_VERSION, len(program)),
+        column(program.ops),
+        column(program.lines),
+        column(program.files),
+    ]
+
+    if isinstance(program.operands, array):
+        out += [b"\x01", column(program.operands)]
+    else:
+        out.append(b"\x00")
+
+        for operand in program.operands:
+            value = operand.to_bytes((operand + (operand < 0)).bit_length() // 8 + 1, "little", signed=True)
+            out.append(struct.pack("<H", len(value)) + value)
+
+    out += pack_strings(program.filenames)
+    out += pack_strings([join(literal[:-1]) for literal in program.literals])
+
+    with open(filename, "wb") as file:
+        file.write(b"".join(out))
+
+def read_bytecode(filename: str) -> Program:
+    """ Reads a program written by write_bytecode. """
+    data = memoryview(open(filename, "rb").read())
+
+    try:
+        return decode_bytecode(data, filename)
+    except (struct.error, IndexError, KeyError, ValueError):
+        Croak(ErrorType.File, "invalid bytecode file \"%s\" (it may be truncated), rebuild it with -b" % filename)
+
+def decode_bytecode(data: memoryview, filename: str) -> Program:
+    """ Decodes the contents of a .pangc file, a file that is cut short or
+        corrupted raises struct.error, IndexError, KeyError or ValueError """
+    ind = len(BYTECODE_MAGIC)
+
+    if data[:ind] != BYTECODE_MAGIC:
+        Croak(ErrorType.File, "\"%s\" is not a pang bytecode file" % filename)
+
+    version, size = struct.unpack_from("<HI", data, ind)
+    ind += 6
     
-    return start + out + "}"
+    if version != BYTECODE_VERSION:
+        Croak(
+            ErrorType.File,
+            "\"%s\" was built for bytecode version %d (expected %d), rebuild it with -b" % (
+                filename, version, BYTECODE_VERSION
+            )
+        )
+
+    def take(length: int) -> memoryview:
+        nonlocal ind
+
+        if ind + length > len(data):
+            raise ValueError("bytecode ends early")
+
+        ind += length
+        return data[ind - length:ind]
+
+    def column(typecode: str) -> array:
+        values = array(typecode)
+        values.frombytes(take(size * values.itemsize))
+
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        return values
+
+    def unpack_strings() -> list[str]:
+        nonlocal ind
+
+        count, = struct.unpack_from("<I", data, ind)
+        ind += 4
+        strings = []
+
+        for _ in range(count):
+            length, = struct.unpack_from("<I", data, ind)
+            ind += 4
+            strings.append(str(take(length), "utf-8", "surrogatepass"))
+
+        return strings
+
+    program = Program()
+    program.ops = column("B")
+    program.lines = column("i")
+    program.files = column("I")
+
+    if take(1)[0]:
+        program.operands = column("q")
+    else:
+        program.operands = []
+
+        for _ in range(size):
+            length, = struct.unpack_from("<H", data, ind)
+            ind += 2
+            program.operands.append(int.from_bytes(take(length), "little", signed=True))
+
+    program.filenames = unpack_strings()
+    program.literals = [
+        tuple(ord(ch) for ch in literal) + (len(literal),)
+        for literal in unpack_strings()
+    ]
+
+    # Every opcode, filename and string literal must exist
+    for op in set(program.ops):
+        TokenType(op)
+
+    if size and max(program.files) >= len(program.filenames):
+        raise IndexError("filename index out of range")
+
+    for op, operand in zip(program.ops, program.operands):
+        if op == OP_STR:
+            program.literals[operand]
+
+    return program
+
+def file_mtime(filename: str) -> Optional[int]:
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+def watch(filename: str, lex_name: str, on_build) -> None:
+    """ Calls on_build with the lexed program every time filename or one of
+        its includes is modified. Tokens of every file are kept in memory,
+        so only the modified files are lexed again. """
+    memo = {}
+
+    try:
+        while True:
+            real_filename = os.path.realpath(filename)
+            mtime = file_mtime(real_filename)
+            lexer = Lexer("", lex_name)
+            lexer.include_memo = memo
+
+            try:
+                if real_filename not in memo or memo[real_filename][0] != mtime:
+                    main_lexer = Lexer(open(filename, "r", encoding="utf-8").read(), lex_name)
+                    main_lexer.scan()
+                    memo[real_filename] = (mtime, main_lexer.toks)
+
+                lexer.toks = memo[real_filename][1]
+                lexer.resolve_includes()
+                lexer.expand_macros()
+
+                on_build(lexer)
+            except (SystemExit, OSError) as error:
+                # Keep watching after errors, they have already been reported.
+                if isinstance(error, OSError):
+                    print("FileError: %s" % error)
+
+            watched = {name: file_mtime(name) for name in [real_filename] + lexer.includes}
+            print("\nWatching %d files for changes (Ctrl+C to stop)." % len(watched))
+
+            changed = []
+
+            while not changed:
+                sleep(WATCH_INTERVAL)
+                changed = [name for name, mtime in watched.items() if file_mtime(name) != mtime]
+            
+            print("Changed: %s\n" % ", ".join(changed))
+    except KeyboardInterrupt:
+        pass
+
+def print_macro_stats(lexer: Lexer, program: Program) -> None:
+    print("%-24s %8s %10s %12s %12s" % ("macro", "body", "expanded", "expansions", "tokens"))
+
+    for name, body_size, size, expansions in lexer.macro_stats():
+        if not expansions:
+            continue
+
+        print("%-24s %8d %10d %12d %12d" % (name, body_size, size, expansions, size * expansions))
+
+    print("\nExpanded program: %d tokens (%d macros defined)." % (len(program), len(lexer.macros)))
+
+def instruction_name(op: int) -> str:
+    typ = TokenType(op)
+    return reverse_keyword_map.get(typ, typ._name_.lower())
+
+class Profile():
+    """ Executions and wall time (in ns, timer overhead included) of every
+        instruction of a program, filled in by Interpreter.run_traced.
+
+        Instructions are attributed to the source line they were written on
+        and the chain of macros they were expanded from, using the sites of
+        the lexer (None for bytecode, which only has the lines). """
+
+    def __init__(self, program: Program, sites: Optional[list[Optional[Expansion]]] = None) -> None:
+        self.program = program
+        self.sites = sites
+        self.counts = [0] * len(program)
+        self.times = [0] * len(program)
+        self.start = 0
+
+    def enter(self, ind: int) -> None:
+        self.start = perf_counter_ns()
+
+    def leave(self, ind: int) -> None:
+        self.times[ind] += perf_counter_ns() - self.start
+        self.counts[ind] += 1
+
+    def location(self, ind: int) -> tuple[str, int, tuple[str, ...]]:
+        """ (file, line, macro chain) of the source that instruction ind came from """
+        site = self.sites[ind] if self.sites else None
+
+        if site is None:
+            program = self.program
+            return os.path.basename(program.filenames[program.files[ind]]), program.lines[ind], ()
+
+        call = site.call_site()
+        return os.path.basename(call.filename), call.ln, tuple(site.chain())
+
+    def rows(self) -> list[tuple[str, int, tuple[str, ...], int, int]]:
+        """ (file, line, chain, executions, time) for every location that
+            was executed, the slowest first """
+        totals = {}
+
+        for ind, count in enumerate(self.counts):
+            if not count:
+                continue
+
+            total = totals.setdefault(self.location(ind), [0, 0])
+            total[0] += count
+            total[1] += self.times[ind]
+
+        return sorted(
+            (location + tuple(total) for location, total in totals.items()),
+            key=lambda row: row[4], reverse=True
+        )
+
+    def report(self, limit: int = PROFILE_ROWS) -> str:
+        rows = self.rows()
+        total_time = sum(self.times) or 1
+        lines = ["%12s %7s %12s %10s  %-24s %s" % ("time (ms)", "%", "executions", "ns/exec", "location", "macros")]
+
+        for filename, ln, chain, count, time in rows[:limit]:
+            lines.append("%12.3f %6.1f%% %12d %10d  %-24s %s" % (
+                time / 1e6, 100 * time / total_time, count, time // count,
+                "%s:%d" % (filename, ln), " > ".join(chain)))
+
+        if len(rows) > limit:
+            lines.append("... %d more locations" % (len(rows) - limit))
+
+        lines.append("\n%d instructions executed in %.3f ms." % (sum(self.counts), sum(self.times) / 1e6))
+        return "\n".join(lines)
+
+    def write_collapsed(self, filename: str) -> None:
+        """ Writes the times as collapsed stacks (file:line;macro;...;instruction ns),
+            the input of flamegraph.pl and compatible tools """
+        stacks = {}
+
+        for ind, time in enumerate(self.times):
+            if not self.counts[ind]:
+                continue
+
+            source, ln, chain = self.location(ind)
+            stack = ";".join(("%s:%d" % (source, ln),) + chain + (instruction_name(self.program.ops[ind]),))
+            stacks[stack] = stacks.get(stack, 0) + time
+
+        with open(filename, "w", encoding="utf-8") as file:
+            for stack, time in stacks.items():
+                file.write("%s %d\n" % (stack, time))
+
+class Stats():
+    """ Execution statistics of an interpreter, filled in by run_traced:
+        instructions executed per opcode, syscalls executed per number, the
+        peak stack depth, items moved by back and front, items removed by
+        purge and bytes written per descriptor. """
+
+    def __init__(self, interpreter: "Interpreter") -> None:
+        self.interpreter = interpreter
+        self.ops = interpreter.ops
+        self.instructions = [0] * (max(typ.value for typ in TokenType) + 1)
+        self.syscalls: dict[int, int] = {}
+        self.written: dict[int, int] = {}
+        self.peak = 0
+        self.moved = 0
+        self.purged = 0
+
+        # Stack depth before the purge that is running
+        self.purge_depth: Optional[int] = None
+
+    def enter(self, ind: int) -> None:
+        op = self.ops[ind]
+        self.instructions[op] += 1
+
+        if op == OP_SYSCALL:
+            interpreter = self.interpreter
+            depth = interpreter.depth()
+
+            if not depth:
+                return
+
+            number = interpreter.mem[-1]
+            self.syscalls[number] = self.syscalls.get(number, 0) + 1
+
+            if number == Syscall.RESIZE.value:
+                self.purge_depth = depth
+            elif number == Syscall.WRITE.value and depth > 1:
+                fd = interpreter.mem[-2]
+                self.written[fd] = self.written.get(fd, 0) + interpreter.buffered(fd)
+        elif op == OP_BACK or op == OP_FRONT:
+            self.moved += 1
+
+    def leave(self, ind: int) -> None:
+        depth = self.interpreter.depth()
+
+        if depth > self.peak:
+            self.peak = depth
+
+        if self.purge_depth is not None:
+            # Neither the syscall number nor the count are purged items
+            self.purged += self.purge_depth - 2 - depth
+            self.purge_depth = None
+
+    def report(self) -> str:
+        lines = ["Instructions executed: %d" % sum(self.instructions)]
+        lines += [
+            "  %-16s %12d" % (instruction_name(op), count)
+            for op, count in sorted(enumerate(self.instructions), key=lambda item: (-item[1], item[0]))
+            if count
+        ]
+
+        lines.append("Syscalls executed: %d" % sum(self.syscalls.values()))
+        lines += [
+            "  %-16s %12d" % (syscall_name(number), count)
+            for number, count in sorted(self.syscalls.items(), key=lambda item: (-item[1], item[0]))
+        ]
+
+        lines.append("Peak stack depth: %d" % self.peak)
+        lines.append("Items moved by back/front: %d" % self.moved)
+        lines.append("Items purged: %d" % self.purged)
+        lines += ["Written to fd %d: %d" % item for item in sorted(self.written.items())]
+
+        return "\n".join(lines)
+
+def syscall_name(number: int) -> str:
+    try:
+        return "%s (0x%03X)" % (Syscall(number)._name_.lower(), number)
+    except ValueError:
+        return "0x%03X" % number
+
+def stack_keep(size: int, count: int) -> int:
+    """ Number of items left by del mem[-count:] on a stack of size items """
+    if count > 0:
+        return max(size - count, 0)
+    elif count < 0:
+        return min(-count, size)
+
+    return 0
+
+def stack_purge(mem: deque, count: int) -> None:
+    """ del mem[-count:] for the interpreter stack """
+    size = len(mem)
+    keep = stack_keep(size, count)
+
+    if size - keep > keep:
+        # Cheaper to rebuild from the items that are kept
+        kept = [mem.popleft() for _ in range(keep)]
+        mem.clear()
+        mem.extend(kept)
+    else:
+        for _ in range(size - keep):
+            mem.pop()
+
+def stack_cut(mem: deque, count: int) -> list[int]:
+    """ Removes and returns mem[-count:] from the interpreter stack """
+    keep = stack_keep(len(mem), count)
+    items = [mem.pop() for _ in range(len(mem) - keep)]
+    items.reverse()
+
+    return items
+
+def wrap64(value: int) -> int:
+    """ Wraps value around to a signed 64-bit integer, like int64_t overflow """
+    return ((value + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+def bitnot(value: int) -> int:
+    return int(bin(value)[2:].replace("1", " ").replace("0", "1").replace(" ", "0"), 2)
 
 def join(l: list[int]) -> str:
     out = ""
@@ -1231,46 +3646,95 @@ def join(l: list[int]) -> str:
     
     return out
 
+class Output():
+    """ Buffered writer for one file descriptor of the interpreter.
+
+        Writes are collected in a list and passed on to the file depending on
+        the policy: "line" after a write with a newline, an int once that
+        many characters are waiting, "exit" only when flushed (on close,
+        before reading stdin and when the program ends) and "unbuffered"
+        after every write. """
+
+    live: list["Output"] = []
+
+    def __init__(self, file, policy: Union[str, int]) -> None:
+        self.file = file
+        self.policy = policy
+        self.parts = []
+        self.pending = 0
+
+        Output.live.append(self)
+
+    def write(self, data: Union[str, bytes]) -> None:
+        if not data:
+            return
+
+        self.parts.append(data)
+        self.pending += len(data)
+
+        policy = self.policy
+
+        if policy == "unbuffered":
+            self.flush()
+        elif policy == "line":
+            if (b"\n" if isinstance(data, bytes) else "\n") in data:
+                self.flush()
+        elif policy != "exit" and self.pending >= policy:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.parts:
+            self.file.write(self.parts[0][:0].join(self.parts))
+            self.parts.clear()
+            self.pending = 0
+
+        if not self.file.closed:
+            self.file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        Output.live.remove(self)
+
+    @classmethod
+    def flush_all(cls) -> None:
+        for output in cls.live:
+            output.flush()
+
+def flush_policy(name: str) -> Union[str, int]:
+    """ Parses the policy given to --flush """
+    if name in ("line", "exit", "unbuffered"):
+        return name
+    elif name.isnumeric() and int(name) > 0:
+        return int(name)
+
+    Croak(ErrorType.Command, "invalid flush policy %s (expected line, exit, unbuffered or a size)" % name)
+
 class Interpreter():
     """ Experimental class for interpreting pang """
 
+    def jump_end(self) -> None:
+        """ Jumps past the end of the block started by the current token """
+        self.ind = self.jumps[self.ind - 1] + 1
+
     def loop(self) -> None:
-        if not self.mem:
-            self.ind = find_end(self.ind, self.ops)
-            return
-        
-        if not self.mem[-1]:
-            self.mem.pop()
+        if not self.mem or not self.mem.pop():
+            self.jump_end()
 
-            self.ind = find_end(self.ind, self.ops)
-            return
-        
-        start_index = self.ind
-        end_index = find_end(self.ind, self.ops)
-        
-        while self.mem:
-            if not self.mem.pop():
-                break
+    def end(self) -> None:
+        # Only the end of a while loop jumps, back to the start of the loop
+        start = self.jumps[self.ind - 1]
 
-            while self.ind < end_index:
-                self.inc()
-                self.simulate_tok()
-            
-            self.ind = start_index
-        
-        self.ind = end_index
+        if start >= 0 and self.mem and self.mem.pop():
+            self.ind = start + 1
 
     def push(self) -> None:
-        to_push = self.cur
-        value = to_push.value
+        operand = self.operands[self.ind - 1]
 
-        if to_push.typ == TokenType.INT:
-            self.mem.append(value)
+        if self.cur == OP_INT:
+            self.mem.append(operand)
         else:
-            for ch in value:
-                self.mem.append(ord(ch))
-            
-            self.mem.append(len(value))
+            # Strings are stored as their char codes followed by the length
+            self.mem += self.literals[operand]
     
     def syscall(self) -> None:
         syscall_number = Syscall(self.mem.pop())
@@ -1284,66 +3748,269 @@ class Interpreter():
         elif syscall_number == Syscall.READ:
             self.syscall_read()
         elif syscall_number == Syscall.CLOSE:
-            self.open_files[self.mem.pop()].close()
+            self.close(self.mem.pop())
         elif syscall_number == Syscall.SLEEP:
             sleep(self.mem.pop() / 1000)
         elif syscall_number == Syscall.RESIZE:
-            self.mem = self.mem[:-self.mem.pop()]
+            # The stack is changed in place, ThreadedInterpreter keeps
+            # references to it.
+            stack_purge(self.mem, self.mem.pop())
         elif syscall_number == Syscall.POINTER:
             self.mem.append(self.mem[self.mem.pop()])
         elif syscall_number == Syscall.LENGTH:
             self.mem.append(len(self.mem))
+        elif syscall_number == Syscall.FORK:
+            self.syscall_fork()
+        elif syscall_number == Syscall.EXEC:
+            self.syscall_exec()
+        elif syscall_number == Syscall.GETPID:
+            self.mem.append(os.getpid())
+        elif syscall_number == Syscall.PIPE:
+            self.syscall_pipe()
+        elif syscall_number == Syscall.MMAP:
+            self.syscall_mmap()
+        elif syscall_number.value >= Syscall.MLOAD.value:
+            self.syscall_map(syscall_number)
+
+    def pop(self) -> int:
+        return self.mem.pop()
+
+    def depth(self) -> int:
+        return len(self.mem)
+
+    def buffered(self, fd: int) -> int:
+        """ Bytes the output waiting in the buffer takes up in fd, as
+            syscall_write encodes it """
+        data = "".join(self.o_buf)
+
+        if "b" in getattr(self.open_files[fd], "mode", ""):
+            # Every character is a byte (latin-1)
+            return len(data)
+
+        return len(data.encode())
+
+    def pop_string(self) -> str:
+        """ Pops a string (its chars followed by its length) """
+        return join(stack_cut(self.mem, self.pop()))
+
+    def syscall_mmap(self) -> None:
+        """ Maps a file (r for read-only, r+ for read-write), pushes its size
+            and a handle for mload, mstore, mload64, mstore64 and munmap """
+        mode = self.pop_string().replace("b", "")
+        filename = self.pop_string()
+
+        if mode not in ("r", "r+"):
+            Croak(ErrorType.File, "invalid mode for mmap %s (expected r or r+)" % mode)
+
+        with open(filename, "rb" if mode == "r" else "r+b") as file:
+            if not os.fstat(file.fileno()).st_size:
+                Croak(ErrorType.File, "cannot map the empty file %s" % filename)
+
+            region = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ if mode == "r" else mmap.ACCESS_WRITE)
+
+        self.mem.append(len(region))
+        self.mem.append(len(self.maps))
+        self.maps.append(region)
+
+    def syscall_map(self, syscall_number: Syscall) -> None:
+        handle = self.pop()
+
+        if not 0 <= handle < len(self.maps) or self.maps[handle] is None:
+            Croak(ErrorType.File, "invalid memory map %d" % handle)
+
+        region = self.maps[handle]
+
+        if syscall_number == Syscall.MUNMAP:
+            region.close()
+            self.maps[handle] = None
+            return
+
+        offset = self.pop()
+        width = 8 if syscall_number in (Syscall.MLOAD64, Syscall.MSTORE64) else 1
+
+        if not 0 <= offset <= len(region) - width:
+            Croak(ErrorType.File, "offset %d is outside of memory map %d (size %d)" % (offset, handle, len(region)))
+
+        try:
+            if syscall_number == Syscall.MLOAD:
+                self.mem.append(region[offset])
+            elif syscall_number == Syscall.MSTORE:
+                region[offset] = self.pop() & 0xFF
+            elif syscall_number == Syscall.MLOAD64:
+                self.mem.append(struct.unpack_from("<q", region, offset)[0])
+            elif syscall_number == Syscall.MSTORE64:
+                struct.pack_into("<q", region, offset, wrap64(self.pop()))
+        except TypeError:
+            Croak(ErrorType.File, "memory map %d is read-only" % handle)
+
+    def syscall_fork(self) -> None:
+        """ Forks the process, pushes the pid of the child in the parent
+            and 0 in the child """
+        if not hasattr(os, "fork"):
+            Croak(ErrorType.Command, "fork is not supported on this platform")
+
+        # Otherwise whatever is waiting to be written comes out twice
+        Output.flush_all()
+        sys.stdout.flush()
+
+        pid = os.fork()
+
+        if not pid:
+            self.forked = True
+
+        self.mem.append(pid)
+
+    def syscall_exec(self) -> None:
+        """ Replaces the process with a command run by /bin/sh """
+        command = self.pop_string()
+
+        Output.flush_all()
+        sys.stdout.flush()
+
+        try:
+            os.execl("/bin/sh", "sh", "-c", command)
+        except OSError as error:
+            Croak(ErrorType.File, "could not execute %s (%s)" % (command, error.strerror))
+
+    def syscall_pipe(self) -> None:
+        """ Pushes the read and then the write descriptor of a new pipe """
+        read, write = os.pipe()
+
+        self.mem.append(len(self.open_files))
+        self.open_files.append(os.fdopen(read, "r", encoding="utf-8"))
+        self.mem.append(len(self.open_files))
+        self.open_files.append(os.fdopen(write, "w", encoding="utf-8"))
 
     def syscall_chdir(self) -> None:
         length = self.mem.pop()
-        os.chdir(join(self.mem[-length:]))
-        self.mem = self.mem[:-length]
+        os.chdir(join(stack_cut(self.mem, length)))
 
     def syscall_open(self) -> None:
         length = self.mem.pop()
-        mode = join(self.mem[-length:])
-        self.mem = self.mem[:-length]
+        mode = join(stack_cut(self.mem, length))
 
         length = self.mem.pop()
-        filename = join(self.mem[-length:])
-        self.mem = self.mem[:-length]
+        filename = join(stack_cut(self.mem, length))
 
         self.mem.append(len(self.open_files))
-        self.open_files.append(open(filename, mode, encoding="utf-8"))
+
+        if "b" in mode:
+            self.open_files.append(open(filename, mode))
+        else:
+            self.open_files.append(open(filename, mode, encoding="utf-8"))
     
     def syscall_read(self) -> None:
         fd = self.mem.pop()
         read_typ = self.mem.pop()
         
         file = self.open_files[fd]
+        self.before_read(fd)
+
+        if read_typ < -1:
+            Croak(ErrorType.File, "invalid read type: %d" % read_typ)
+        elif read_typ and hasattr(file, "readinto"):
+            # Binary files are read straight onto the stack
+            self.mem.append(self.read_bytes(file, read_typ))
+            return
 
         if not read_typ:
             contents = file.readline()[:-1]
         elif read_typ == -1:
             contents = file.read()
-        elif read_typ > 0:
+        else:
             contents = file.read(read_typ)
+
+        if isinstance(contents, str):
+            self.mem.extend(map(ord, contents))
         else:
-            Croak(ErrorType.File, "invalid read type: %d" % read_typ)
+            self.mem.extend(contents)
 
-        self.mem += [ord(ch) for ch in contents]
         self.mem.append(len(contents))
+
+    def read_bytes(self, file, count: int) -> int:
+        """ Pushes up to count bytes (all of them for -1) from a binary
+            file, in chunks of READ_CHUNK_SIZE so the file is only copied
+            once, onto the stack. Returns how many bytes were read. """
+        chunk = memoryview(bytearray(READ_CHUNK_SIZE))
+        total = 0
+
+        while count < 0 or total < count:
+            size = READ_CHUNK_SIZE if count < 0 else min(READ_CHUNK_SIZE, count - total)
+            read = file.readinto(chunk[:size])
+
+            if not read:
+                break
+
+            self.push_bytes(chunk[:read])
+            total += read
+
+        return total
+
+    def push_bytes(self, data: Union[bytes, memoryview]) -> None:
+        self.mem.extend(data)
     
     def syscall_write(self) -> None:        
-        file = self.open_files[self.mem.pop()]
-        
-        file.write(self.o_buf)
-        file.flush()
-        
-        self.o_buf = ""
+        fd = self.mem.pop()
+        data = "".join(self.o_buf)
+        self.o_buf.clear()
+
+        if "b" in getattr(self.open_files[fd], "mode", ""):
+            # Files opened in binary mode take every character as a byte
+            try:
+                data = data.encode("latin-1")
+            except UnicodeEncodeError:
+                Croak(ErrorType.File, "cannot write characters above 255 to a binary file")
+
+        self.output(fd).write(data)
+
+    def output_file(self, fd: int):
+        return self.open_files[fd]
+
+    def output(self, fd: int) -> Output:
+        """ The buffered writer for fd, made on its first write """
+        output = self.outputs.get(fd)
+
+        if output is None:
+            file = self.output_file(fd)
+            policy = self.flush
+
+            if policy is None:
+                # Like C stdio, terminals get every line as it is written
+                policy = "line" if file.isatty() else OUTPUT_FLUSH_SIZE
+
+            output = self.outputs[fd] = Output(file, policy)
+
+        return output
+
+    def before_read(self, fd: int) -> None:
+        """ Writes what is waiting to be written to fd (or to the terminal
+            when reading stdin, so prompts show up) """
+        for out_fd, output in self.outputs.items():
+            if out_fd == fd or not fd:
+                output.flush()
+
+    def close(self, fd: int) -> None:
+        output = self.outputs.pop(fd, None)
+
+        if output is not None:
+            output.close()
+
+        self.open_files[fd].close()
+
+    def close_outputs(self) -> None:
+        """ Writes everything still buffered, called when the program ends """
+        for output in self.outputs.values():
+            output.close()
+
+        self.outputs.clear()
 
     def buf(self) -> None:
         to_put = self.mem.pop()
 
         if not to_put:
-            self.o_buf += str(self.mem[-1])
+            self.o_buf.append(str(self.mem[-1]))
         else:
-            self.o_buf += chr(self.mem[-1])
+            self.o_buf.append(chr(self.mem[-1]))
         
         
     def inc(self) -> None:
@@ -1351,91 +4018,114 @@ class Interpreter():
         self.ind += 1
 
         #print([chr(s) for s in self.mem if 0x110000 >= s >= 0])
-        #print(self.cur.typ._name_, [chr(s) for s in self.mem if 0x110000 >= s >= 0])
+        #print(TokenType(self.cur)._name_, [chr(s) for s in self.mem if 0x110000 >= s >= 0])
 
     def condition(self) -> None:
         if self.mem.pop():
             return
         
-        self.ind = find_end(self.ind, self.ops)
-        self.cur = self.ops[self.ind]
+        self.jump_end()
     
     def simulate_tok(self) -> None:
-        tok = self.cur
+        op = self.cur
 
-        if tok.typ in (TokenType.INT, TokenType.STR):
+        if op == OP_INT or op == OP_STR:
             self.push()
         
         # Branches
-        elif tok.typ == TokenType.IF:
+        elif op == OP_IF:
             self.condition()
-        elif tok.typ == TokenType.WHILE:
+        elif op == OP_WHILE:
             self.loop()
+        elif op == OP_END:
+            self.end()
         
         # Syscalls
-        elif tok.typ == TokenType.SYSCALL:
+        elif op == OP_SYSCALL:
             self.syscall()
         
-        elif tok.typ == TokenType.DUP:            
+        elif op == OP_DUP:            
             self.mem.append(self.mem[-1])
-        elif tok.typ == TokenType.BITNOT:
-            self.mem[-1] = int(bin(self.mem[-1])[2:].replace("1", " ").replace("0", "1").replace(" ", "0"), 2)
+        elif op == OP_BITNOT:
+            self.mem[-1] = bitnot(self.mem[-1])
         
-        elif tok.typ in (TokenType.DO, TokenType.END):
+        elif op == OP_DO:
             pass
         # Need at least 2 items on stack
         else:
             self.simple()
     
     def simple(self) -> None:
-        tok = self.cur
+        op = self.cur
 
-        if len(self.mem) < 2:
-            Croak(
-                ErrorType.Stack,
-                "not enough items on stack for stack operation %s (detected at line: %d)" % (
-                tok.typ._name_, tok.ln))
+        if not self.safe[self.ind - 1] and len(self.mem) < 2:
+            self.stack_error(self.ind - 1)
 
-        if tok.typ == TokenType.BUF:
+        if op == OP_BUF:
             self.buf()
-        elif tok.typ == TokenType.SWAP:                
+        elif op == OP_SWAP:                
             self.mem[-2], self.mem[-1] = self.mem[-1], self.mem[-2]
-        elif tok.typ == TokenType.BACK:
-            self.mem.insert(0, self.mem.pop(-1))
-        elif tok.typ == TokenType.FRONT:
-            self.mem.append(self.mem.pop(0))
+        elif op == OP_BACK:
+            self.mem.appendleft(self.mem.pop())
+        elif op == OP_FRONT:
+            self.mem.append(self.mem.popleft())
         
         # Arithmetic operations
-        elif tok.typ == TokenType.SUB:
-            self.mem.append(self.mem.pop(-2) - self.mem.pop())
-        elif tok.typ == TokenType.ADD:
-            self.mem.append(self.mem.pop(-2) + self.mem.pop())
-        elif tok.typ == TokenType.MUL:
-            self.mem.append(self.mem.pop(-2) * self.mem.pop())
-        elif tok.typ == TokenType.DIVMOD:
-            self.mem += divmod(self.mem.pop(-2), self.mem.pop())
+        elif op == OP_SUB:
+            right = self.mem.pop()
+            self.mem[-1] -= right
+        elif op == OP_ADD:
+            right = self.mem.pop()
+            self.mem[-1] += right
+        elif op == OP_MUL:
+            right = self.mem.pop()
+            self.mem[-1] *= right
+        elif op == OP_DIVMOD:
+            right = self.mem.pop()
+            self.mem += divmod(self.mem.pop(), right)
         
         # Conditionals
-        elif tok.typ == TokenType.EQUAL:
-            self.mem.append(int(self.mem.pop(-2) == self.mem.pop()))
-        elif tok.typ == TokenType.NOT_EQUAL:
-            self.mem.append(int(self.mem.pop(-2) != self.mem.pop()))
-        elif tok.typ == TokenType.GREATER_THAN:
-            self.mem.append(int(self.mem.pop(-2) < self.mem.pop()))
-        elif tok.typ == TokenType.SMALLER_THAN:
-            self.mem.append(int(self.mem.pop(-2) > self.mem.pop()))
+        elif op == OP_EQUAL:
+            right = self.mem.pop()
+            self.mem[-1] = int(self.mem[-1] == right)
+        elif op == OP_NOT_EQUAL:
+            right = self.mem.pop()
+            self.mem[-1] = int(self.mem[-1] != right)
+        elif op == OP_GREATER_THAN:
+            right = self.mem.pop()
+            self.mem[-1] = int(self.mem[-1] < right)
+        elif op == OP_SMALLER_THAN:
+            right = self.mem.pop()
+            self.mem[-1] = int(self.mem[-1] > right)
         
         # Bitwise operations
-        elif tok.typ == TokenType.BITAND:
-            self.mem[-1] &= self.mem.pop(-2)
-        elif tok.typ == TokenType.BITOR:
-            self.mem[-1] |= self.mem.pop(-2)
-        elif tok.typ == TokenType.EXCOR:
-            self.mem[-1] ^= self.mem.pop(-2)
-        elif tok.typ == TokenType.LSHIFT:
-            self.mem.append(self.mem.pop(-2) << self.mem.pop())
-        elif tok.typ == TokenType.RSHIFT:
-            self.mem.append(self.mem.pop(-2) >> self.mem.pop())
+        elif op == OP_BITAND:
+            right = self.mem.pop()
+            self.mem[-1] &= right
+        elif op == OP_BITOR:
+            right = self.mem.pop()
+            self.mem[-1] |= right
+        elif op == OP_EXCOR:
+            right = self.mem.pop()
+            self.mem[-1] ^= right
+        elif op == OP_LSHIFT:
+            right = self.mem.pop()
+            self.mem[-1] <<= right
+        elif op == OP_RSHIFT:
+            right = self.mem.pop()
+            self.mem[-1] >>= right
+
+    def stack_error(self, ind: int) -> None:
+        """ Reports the instruction at ind running out of items, for the
+            instructions simple checks (the ones that need two items).
+            Returns for the others, which fail with an IndexError. """
+        op = self.ops[ind]
+
+        if STACK_EFFECTS.get(op, (0,))[0] >= 2:
+            Croak(
+                ErrorType.Stack,
+                "not enough items on stack for stack operation %s (detected at line: %d)" % (
+                TokenType(op)._name_, self.program.lines[ind]))
 
     def run(self) -> None:
         while self.ind < self.size:
@@ -1447,16 +4137,40 @@ class Interpreter():
 
         if self.exit_code is None:
             self.exit_code = -1
+
+    def run_traced(self, tracer: Union["Profile", "Stats"]) -> None:
+        """ Like run, calling tracer.enter and tracer.leave with the index
+            of every instruction before and after running it """
+        enter = tracer.enter
+        leave = tracer.leave
+
+        while self.ind < self.size:
+            ind = self.ind
+            enter(ind)
+
+            self.inc()
+            self.simulate_tok()
+
+            leave(ind)
+
+            if self.exit_code is not None:
+                break
+
+        if self.exit_code is None:
+            self.exit_code = -1
     
     def cleanup(self):
+        self.close_outputs()
+        self.maps = []
         self.ind = 0
-        self.o_buf = ""
-        self.mem = []
+        self.o_buf.clear()
+        self.mem.clear()
         self.exit_code = None
         self.open_files = [sys.stdin, sys.stdout, sys.stderr]
 
-    def __init__(self, args: list[str], ops: list[Token]):
-        self.mem = []
+    def __init__(self, args: list[str], program: "Program", flush: Optional[Union[str, int]] = None):
+        # A deque so back and front are O(1) like the top of the stack
+        self.mem = deque()
 
         for arg in args:
             for ch in arg:
@@ -1468,21 +4182,832 @@ class Interpreter():
 
         self.ind = 0
         self.exit_code = None
-        self.ops = ops
-        self.size = len(ops)
-        self.o_buf = ""
+        self.program = program
+        self.ops = program.ops
+        self.operands = program.operands
+        self.jumps = resolve_jumps(program)
+        self.literals = program.literals
+        self.size = len(program)
+        self.o_buf = []
+
+        # Instructions that always have the items they need skip the check
+        self.safe = stack_safe(program, stack_depths(program, self.jumps)[0])
+
+        # Flush policy of the outputs (see Output), None picks one per file
+        self.flush = flush
+        self.outputs: dict[int, Output] = {}
 
         self.open_files = [sys.stdin, sys.stdout, sys.stderr]
+        self.maps: list[Optional[mmap.mmap]] = []
+
+        # Set in the child after a fork
+        self.forked = False
+
+class ThreadedInterpreter(Interpreter):
+    """ Interpreter that translates the program into a list of closures
+        (one per instruction, with its operand baked in) before running it.
+        Each closure takes its own index and returns the next one. """
+
+    def translate(self) -> list:
+        mem = self.mem
+        pop = mem.pop
+        append = mem.append
+        extend = mem.extend
+        size = self.size
+        jumps = self.jumps
+
+        def nop(ind: int) -> int:
+            return ind + 1
+
+        def push_int(value: int):
+            def run(ind: int) -> int:
+                append(value)
+                return ind + 1
+            return run
+
+        def push_str(literal: tuple[int, ...]):
+            def run(ind: int) -> int:
+                extend(literal)
+                return ind + 1
+            return run
+
+        def branch_if(end: int):
+            def run(ind: int) -> int:
+                if pop():
+                    return ind + 1
+                return end + 1
+            return run
+
+        def branch_while(end: int):
+            def run(ind: int) -> int:
+                if mem and pop():
+                    return ind + 1
+                return end + 1
+            return run
+
+        def end_while(start: int):
+            def run(ind: int) -> int:
+                if mem and pop():
+                    return start + 1
+                return ind + 1
+            return run
+
+        def end_while_unchecked(start: int):
+            def run(ind: int) -> int:
+                if pop():
+                    return start + 1
+                return ind + 1
+            return run
+
+        def syscall(ind: int) -> int:
+            self.syscall()
+            return ind + 1 if self.exit_code is None else size
+
+        def buf(ind: int) -> int:
+            self.buf()
+            return ind + 1
+
+        def dup(ind: int) -> int:
+            append(mem[-1])
+            return ind + 1
+
+        def bitnot_(ind: int) -> int:
+            mem[-1] = bitnot(mem[-1])
+            return ind + 1
+
+        def swap(ind: int) -> int:
+            mem[-2], mem[-1] = mem[-1], mem[-2]
+            return ind + 1
+
+        def back(ind: int) -> int:
+            if len(mem) < 2:
+                raise IndexError
+            mem.appendleft(pop())
+            return ind + 1
+
+        def front(ind: int) -> int:
+            if len(mem) < 2:
+                raise IndexError
+            append(mem.popleft())
+            return ind + 1
+
+        def back_unchecked(ind: int) -> int:
+            mem.appendleft(pop())
+            return ind + 1
+
+        def front_unchecked(ind: int) -> int:
+            append(mem.popleft())
+            return ind + 1
+
+        def sub(ind: int) -> int:
+            right = pop()
+            mem[-1] -= right
+            return ind + 1
+
+        def add(ind: int) -> int:
+            right = pop()
+            mem[-1] += right
+            return ind + 1
+
+        def mul(ind: int) -> int:
+            right = pop()
+            mem[-1] *= right
+            return ind + 1
+
+        def divmod_(ind: int) -> int:
+            right = pop()
+            extend(divmod(pop(), right))
+            return ind + 1
+
+        def equal(ind: int) -> int:
+            right = pop()
+            mem[-1] = int(mem[-1] == right)
+            return ind + 1
+
+        def not_equal(ind: int) -> int:
+            right = pop()
+            mem[-1] = int(mem[-1] != right)
+            return ind + 1
+
+        def greater_than(ind: int) -> int:
+            right = pop()
+            mem[-1] = int(mem[-1] < right)
+            return ind + 1
+
+        def smaller_than(ind: int) -> int:
+            right = pop()
+            mem[-1] = int(mem[-1] > right)
+            return ind + 1
+
+        def bitand(ind: int) -> int:
+            right = pop()
+            mem[-1] &= right
+            return ind + 1
+
+        def bitor(ind: int) -> int:
+            right = pop()
+            mem[-1] |= right
+            return ind + 1
+
+        def excor(ind: int) -> int:
+            right = pop()
+            mem[-1] ^= right
+            return ind + 1
+
+        def lshift(ind: int) -> int:
+            right = pop()
+            mem[-1] <<= right
+            return ind + 1
+
+        def rshift(ind: int) -> int:
+            right = pop()
+            mem[-1] >>= right
+            return ind + 1
+
+        handlers = {
+            OP_DO: nop,
+            OP_SYSCALL: syscall,
+            OP_BUF: buf,
+            OP_DUP: dup,
+            OP_BITNOT: bitnot_,
+            OP_SWAP: swap,
+            OP_BACK: back,
+            OP_FRONT: front,
+            OP_SUB: sub,
+            OP_ADD: add,
+            OP_MUL: mul,
+            OP_DIVMOD: divmod_,
+            OP_EQUAL: equal,
+            OP_NOT_EQUAL: not_equal,
+            OP_GREATER_THAN: greater_than,
+            OP_SMALLER_THAN: smaller_than,
+            OP_BITAND: bitand,
+            OP_BITOR: bitor,
+            OP_EXCOR: excor,
+            OP_LSHIFT: lshift,
+            OP_RSHIFT: rshift,
+        }
+
+        # For instructions that stack_depths proved to have enough items
+        unchecked = {
+            OP_BACK: back_unchecked,
+            OP_FRONT: front_unchecked,
+        }
+
+        code = []
+        safe = self.safe
+
+        for ind, op in enumerate(self.ops):
+            if op == OP_INT:
+                code.append(push_int(self.operands[ind]))
+            elif op == OP_STR:
+                code.append(push_str(self.literals[self.operands[ind]]))
+            elif op == OP_IF:
+                code.append(branch_if(jumps[ind]))
+            elif op == OP_WHILE:
+                # The condition is always popped when the stack is not empty
+                code.append(branch_if(jumps[ind]) if safe[ind] else branch_while(jumps[ind]))
+            elif op == OP_END:
+                if jumps[ind] < 0:
+                    code.append(nop)
+                else:
+                    code.append(end_while_unchecked(jumps[ind]) if safe[ind] else end_while(jumps[ind]))
+            elif safe[ind] and op in unchecked:
+                code.append(unchecked[op])
+            else:
+                code.append(handlers.get(op, nop))
+
+        return code
+
+    def run(self) -> None:
+        code = self.translate()
+        size = self.size
+        ind = self.ind
+
+        try:
+            while ind < size:
+                ind = code[ind](ind)
+        except IndexError:
+            # Raised again when it is not an underflow simple reports
+            self.stack_error(ind)
+            raise
+
+        self.ind = ind
+
+        if self.exit_code is None:
+            self.exit_code = -1
+
+    def run_traced(self, tracer: Union["Profile", "Stats"]) -> None:
+        code = self.translate()
+        enter = tracer.enter
+        leave = tracer.leave
+        size = self.size
+        ind = self.ind
+
+        try:
+            while ind < size:
+                enter(ind)
+                next_ind = code[ind](ind)
+                leave(ind)
+                ind = next_ind
+        except IndexError:
+            self.stack_error(ind)
+            raise
+
+        self.ind = ind
+
+        if self.exit_code is None:
+            self.exit_code = -1
+
+class FusedInterpreter(ThreadedInterpreter):
+    """ ThreadedInterpreter with a peephole pass that replaces common
+        instruction sequences with one closure (a superinstruction). """
+
+    # Comparisons as (second item, last item) -> int
+    compares = {
+        OP_EQUAL: lambda left, right: int(left == right),
+        OP_NOT_EQUAL: lambda left, right: int(left != right),
+        OP_GREATER_THAN: lambda left, right: int(left < right),
+        OP_SMALLER_THAN: lambda left, right: int(left > right),
+    }
+
+    def jump_targets(self) -> set[int]:
+        """ Indexes that can be jumped to, sequences are not fused across them """
+        targets = set()
+
+        for ind, op in enumerate(self.ops):
+            if (op == OP_IF or op == OP_WHILE or op == OP_END) and self.jumps[ind] >= 0:
+                targets.add(self.jumps[ind] + 1)
+
+        return targets
+
+    def fuse(self, code: list) -> None:
+        mem = self.mem
+        pop = mem.pop
+        append = mem.append
+        ops = self.ops
+        operands = self.operands
+        size = self.size
+        compares = self.compares
+        targets = self.jump_targets()
+
+        def add_imm(value: int):
+            def run(ind: int) -> int:
+                mem[-1] += value
+                return ind + 2
+            return run
+
+        def sub_imm(value: int):
+            def run(ind: int) -> int:
+                mem[-1] -= value
+                return ind + 2
+            return run
+
+        def mul_imm(value: int):
+            def run(ind: int) -> int:
+                mem[-1] *= value
+                return ind + 2
+            return run
+
+        def compare_imm(compare, value: int):
+            def run(ind: int) -> int:
+                mem[-1] = compare(mem[-1], value)
+                return ind + 2
+            return run
+
+        def dup_compare_imm(compare, value: int):
+            def run(ind: int) -> int:
+                append(compare(mem[-1], value))
+                return ind + 3
+            return run
+
+        def swap_compare(compare):
+            def run(ind: int) -> int:
+                left = pop()
+                mem[-1] = compare(left, mem[-1])
+                return ind + 2
+            return run
+
+        def drop_n(count: int):
+            def run(ind: int) -> int:
+                if len(mem) >= count > 0:
+                    for _ in range(count):
+                        pop()
+                else:
+                    stack_purge(mem, count)
+                return ind + 3
+            return run
+
+        def purge(ind: int) -> int:
+            stack_purge(mem, pop())
+            return ind + 2
+
+        def pointer(ind: int) -> int:
+            append(mem[pop()])
+            return ind + 2
+
+        def length(ind: int) -> int:
+            append(len(mem))
+            return ind + 2
+
+        def fusable(ind: int, count: int) -> bool:
+            return ind + count <= size and all(
+                ind + offset not in targets for offset in range(1, count))
+
+        self.fused = {}
+        self.groups = {}
+        ind = 0
+
+        while ind < size:
+            op = ops[ind]
+            fused = None
+            count = 0
+
+            if op == OP_INT and fusable(ind, 3) and ops[ind + 1] == OP_INT and ops[ind + 2] == OP_SYSCALL \
+                    and operands[ind + 1] == Syscall.RESIZE.value:
+                fused, count, name = drop_n(operands[ind]), 3, "drop-n"
+            elif op == OP_INT and fusable(ind, 2):
+                next_op = ops[ind + 1]
+                value = operands[ind]
+
+                if next_op == OP_ADD:
+                    fused, count, name = add_imm(value), 2, "add-immediate"
+                elif next_op == OP_SUB:
+                    fused, count, name = sub_imm(value), 2, "sub-immediate"
+                elif next_op == OP_MUL:
+                    fused, count, name = mul_imm(value), 2, "mul-immediate"
+                elif next_op in compares:
+                    fused, count, name = compare_imm(compares[next_op], value), 2, "compare-immediate"
+                elif next_op == OP_SYSCALL and value == Syscall.RESIZE.value:
+                    fused, count, name = purge, 2, "purge"
+                elif next_op == OP_SYSCALL and value == Syscall.POINTER.value:
+                    fused, count, name = pointer, 2, "ptr"
+                elif next_op == OP_SYSCALL and value == Syscall.LENGTH.value:
+                    fused, count, name = length, 2, "length"
+            elif op == OP_DUP and fusable(ind, 3) and ops[ind + 1] == OP_INT and ops[ind + 2] in compares:
+                fused, count, name = dup_compare_imm(compares[ops[ind + 2]], operands[ind + 1]), 3, "dup-compare-immediate"
+            elif op == OP_SWAP and fusable(ind, 2) and ops[ind + 1] in compares:
+                fused, count, name = swap_compare(compares[ops[ind + 1]]), 2, "swap-compare"
+
+            if fused is None:
+                ind += 1
+                continue
+
+            code[ind] = fused
+            self.fused[name] = self.fused.get(name, 0) + count
+            self.groups[ind] = count
+            ind += count
+
+    def translate(self) -> list:
+        code = super().translate()
+        self.fuse(code)
+
+        return code
+
+    def stack_error(self, ind: int) -> None:
+        # Ints cannot fail, a superinstruction fails at its first other
+        # instruction
+        failed = ind
+
+        while failed < ind + self.groups.get(ind, 1) - 1 and self.ops[failed] == OP_INT:
+            failed += 1
+
+        super().stack_error(failed)
+
+    def fusion_report(self) -> str:
+        if not self.fused:
+            return "No instructions were fused."
+
+        return "Fused %d instructions (%s)." % (
+            sum(self.fused.values()),
+            ", ".join("%s: %d" % fused for fused in sorted(self.fused.items(), key=lambda fused: -fused[1]))
+        )
+
+class PythonInterpreter(Interpreter):
+    """ Runs the program as python code generated by compile_python """
+
+    def namespace(self) -> dict:
+        mem = self.mem
+        pop = mem.pop
+        append = mem.append
+
+        def back() -> None:
+            if len(mem) < 2:
+                raise IndexError
+            mem.appendleft(pop())
+
+        def front() -> None:
+            if len(mem) < 2:
+                raise IndexError
+            append(mem.popleft())
+
+        return {
+            "mem": mem,
+            "pop": pop,
+            "append": append,
+            "extend": mem.extend,
+            "appendleft": mem.appendleft,
+            "popleft": mem.popleft,
+            "purge": lambda count: stack_purge(mem, count),
+            "back": back,
+            "front": front,
+            "bitnot": bitnot,
+            "out": self.o_buf.append,
+            "sleep": sleep,
+            "syscall": self.syscall,
+            "vm": self,
+        }
+
+    def run(self) -> None:
+        source, line_map = compile_python(self.program)
+
+        try:
+            code = compile(source, "<pang>", "exec")
+        except (SyntaxError, RecursionError) as err:
+            Croak(ErrorType.Compile, "generated python could not be compiled (%s), use another engine" % err)
+
+        namespace = self.namespace()
+        exec(code, namespace)
+
+        try:
+            namespace["pang_main"]()
+        except IndexError as err:
+            tb = err.__traceback__
+            ind = 0
+
+            while tb is not None:
+                if tb.tb_frame.f_code.co_filename == "<pang>":
+                    ind = line_map[tb.tb_lineno - 1]
+                tb = tb.tb_next
+
+            # Raised again when it is not an underflow simple reports
+            self.stack_error(ind)
+            raise
+
+        if self.exit_code is None:
+            self.exit_code = -1
+
+class Int64Interpreter(Interpreter):
+    """ Interpreter that stores the stack as signed 64-bit integers in an
+        array('q') and behaves like compiled programs: arithmetic wraps
+        around, divmod truncates towards zero, shifts use the low 6 bits of
+        the count and argv, files and output are bytes.
+
+        The bottom of the stack is mem[self.head], the items before it are
+        free space so back stays O(1). """
+
+    def depth(self) -> int:
+        return len(self.mem) - self.head
+
+    def buffered(self, fd: int) -> int:
+        return len(self.o_buf)
+
+    def need(self, count: int) -> None:
+        if len(self.mem) - self.head < count:
+            Croak(
+                ErrorType.Stack,
+                "not enough items on stack for stack operation %s (detected at line: %d)" % (
+                TokenType(self.cur)._name_, self.program.lines[self.ind - 1]))
+
+    def pop(self) -> int:
+        self.need(1)
+        return self.mem.pop()
+
+    def cut(self, count: int) -> bytes:
+        """ Removes the top count items (like stack_cut) as a byte string """
+        start = self.head + stack_keep(self.depth(), count)
+        items = bytes(value & 0xFF for value in self.mem[start:])
+        del self.mem[start:]
+
+        return items
+
+    def back(self, value: int) -> None:
+        if not self.head:
+            grow = max(self.depth(), 16)
+            self.mem[0:0] = array("q", bytes(8 * grow))
+            self.head = grow
+
+        self.head -= 1
+        self.mem[self.head] = value
+
+    def front(self) -> None:
+        self.mem.append(self.mem[self.head])
+        self.head += 1
+
+        # Gives back the free space once it is larger than the stack
+        depth = self.depth()
+
+        if self.head > 2 * depth + 1024:
+            del self.mem[:self.head - depth]
+            self.head = depth
+
+    def loop(self) -> None:
+        if not self.depth() or not self.mem.pop():
+            self.jump_end()
+
+    def end(self) -> None:
+        start = self.jumps[self.ind - 1]
+
+        if start >= 0 and self.depth() and self.mem.pop():
+            self.ind = start + 1
+
+    def condition(self) -> None:
+        if self.pop():
+            return
+
+        self.jump_end()
+
+    def push(self) -> None:
+        operand = self.operands[self.ind - 1]
+
+        if self.cur == OP_INT:
+            self.mem.append(wrap64(operand))
+        else:
+            self.mem.extend(self.literals[operand])
+
+    def syscall(self) -> None:
+        syscall_number = Syscall(self.pop())
+
+        if syscall_number == Syscall.EXIT:
+            self.exit_code = self.pop()
+        elif syscall_number == Syscall.OPEN:
+            self.syscall_open()
+        elif syscall_number == Syscall.WRITE:
+            self.syscall_write()
+        elif syscall_number == Syscall.READ:
+            self.syscall_read()
+        elif syscall_number == Syscall.CLOSE:
+            self.close(self.pop())
+        elif syscall_number == Syscall.SLEEP:
+            sleep(self.pop() / 1000)
+        elif syscall_number == Syscall.RESIZE:
+            purge = self.pop()
+            del self.mem[self.head + stack_keep(self.depth(), purge):]
+        elif syscall_number == Syscall.POINTER:
+            index = self.pop()
+
+            if not -self.depth() <= index < self.depth():
+                Croak(ErrorType.Stack, "pointer %d is outside of the stack (detected at line: %d)" % (
+                    index, self.program.lines[self.ind - 1]))
+
+            self.mem.append(self.mem[index if index < 0 else self.head + index])
+        elif syscall_number == Syscall.LENGTH:
+            self.mem.append(self.depth())
+        elif syscall_number == Syscall.FORK:
+            self.syscall_fork()
+        elif syscall_number == Syscall.EXEC:
+            self.syscall_exec()
+        elif syscall_number == Syscall.GETPID:
+            self.mem.append(os.getpid())
+        elif syscall_number == Syscall.PIPE:
+            self.syscall_pipe()
+        elif syscall_number == Syscall.MMAP:
+            self.syscall_mmap()
+        elif syscall_number.value >= Syscall.MLOAD.value:
+            self.syscall_map(syscall_number)
+
+    def pop_string(self) -> str:
+        length = self.pop()
+        return os.fsdecode(self.cut(length))
+
+    def syscall_chdir(self) -> None:
+        length = self.pop()
+        os.chdir(os.fsdecode(self.cut(length)))
+
+    def syscall_open(self) -> None:
+        length = self.pop()
+        mode = self.cut(length).decode()
+
+        length = self.pop()
+        filename = os.fsdecode(self.cut(length))
+
+        self.mem.append(len(self.open_files))
+        self.open_files.append(open(filename, mode if "b" in mode else mode + "b"))
+
+    def syscall_read(self) -> None:
+        fd = self.pop()
+        read_typ = self.pop()
+
+        file = self.open_files[fd]
+        file = getattr(file, "buffer", file)
+        self.before_read(fd)
+
+        if read_typ < -1:
+            Croak(ErrorType.File, "invalid read type: %d" % read_typ)
+        elif read_typ:
+            self.mem.append(self.read_bytes(file, read_typ))
+        else:
+            contents = file.readline()[:-1]
+            self.push_bytes(contents)
+            self.mem.append(len(contents))
+
+    def push_bytes(self, data: Union[bytes, memoryview]) -> None:
+        # Each byte is widened to an int64 with one slice assignment, which
+        # is much faster than extending the array one byte at a time.
+        wide = bytearray(8 * len(data))
+        wide[0 if sys.byteorder == "little" else 7::8] = data
+        self.mem.frombytes(wide)
+
+    def syscall_write(self) -> None:
+        self.output(self.pop()).write(bytes(self.o_buf))
+        self.o_buf.clear()
+
+    def output_file(self, fd: int):
+        file = self.open_files[fd]
+        stream = getattr(file, "buffer", file)
+
+        if stream is not file:
+            # Text written before (such as by print) has to come out first
+            file.flush()
+
+        return stream
+
+    def buf(self) -> None:
+        to_put = self.mem.pop()
+
+        if not to_put:
+            self.o_buf += str(self.mem[-1]).encode()
+        else:
+            # Like appending an int64_t to a std::string, only the low byte is kept
+            self.o_buf.append(self.mem[-1] & 0xFF)
+
+    def simulate_tok(self) -> None:
+        op = self.cur
+
+        if op == OP_INT or op == OP_STR:
+            self.push()
+        elif op == OP_IF:
+            self.condition()
+        elif op == OP_WHILE:
+            self.loop()
+        elif op == OP_END:
+            self.end()
+        elif op == OP_SYSCALL:
+            self.syscall()
+        elif op == OP_DUP:
+            if not self.safe[self.ind - 1]:
+                self.need(1)
+            self.mem.append(self.mem[-1])
+        elif op == OP_BITNOT:
+            if not self.safe[self.ind - 1]:
+                self.need(1)
+            self.mem[-1] = wrap64(bitnot(self.mem[-1]))
+        elif op == OP_DO:
+            pass
+        else:
+            self.simple()
+
+    def simple(self) -> None:
+        op = self.cur
+        mem = self.mem
+
+        if not self.safe[self.ind - 1]:
+            self.need(2)
+
+        if op == OP_BUF:
+            self.buf()
+            return
+        elif op == OP_SWAP:
+            mem[-2], mem[-1] = mem[-1], mem[-2]
+            return
+        elif op == OP_BACK:
+            self.back(mem.pop())
+            return
+        elif op == OP_FRONT:
+            self.front()
+            return
+
+        right = mem.pop()
+        left = mem[-1]
+
+        if op == OP_SUB:
+            result = left - right
+        elif op == OP_ADD:
+            result = left + right
+        elif op == OP_MUL:
+            result = left * right
+        elif op == OP_DIVMOD:
+            # std::lldiv rounds towards zero
+            quotient = abs(left) // abs(right)
+
+            if (left < 0) != (right < 0):
+                quotient = -quotient
+
+            mem[-1] = wrap64(quotient)
+            mem.append(wrap64(left - right * quotient))
+            return
+        elif op == OP_EQUAL:
+            result = int(left == right)
+        elif op == OP_NOT_EQUAL:
+            result = int(left != right)
+        elif op == OP_GREATER_THAN:
+            result = int(left < right)
+        elif op == OP_SMALLER_THAN:
+            result = int(left > right)
+        elif op == OP_BITAND:
+            result = left & right
+        elif op == OP_BITOR:
+            result = left | right
+        elif op == OP_EXCOR:
+            result = left ^ right
+        elif op == OP_LSHIFT:
+            result = left << (right & 63)
+        elif op == OP_RSHIFT:
+            result = left >> (right & 63)
+        else:
+            return
+
+        try:
+            mem[-1] = result
+        except OverflowError:
+            mem[-1] = wrap64(result)
+
+    def cleanup(self):
+        super().cleanup()
+        self.mem = array("q")
+        self.head = 0
+
+    def __init__(self, args: list[str], program: "Program", flush: Optional[Union[str, int]] = None):
+        super().__init__([], program, flush)
+
+        self.mem = array("q")
+        self.head = 0
+        self.o_buf = bytearray()
+        self.literals = [array("q", literal) for literal in program.literals]
+
+        # Pushed as bytes, like argv in compiled programs
+        for arg in args:
+            data = os.fsencode(arg)
+            self.push_bytes(data)
+            self.mem.append(len(data))
+
+        self.mem.append(len(args))
+
+# Interpreter engines selectable with -engine
+ENGINES = {
+    "switch": Interpreter,
+    "threaded": ThreadedInterpreter,
+    "fused": FusedInterpreter,
+    "python": PythonInterpreter,
+}
 
 def run_program() -> None:
     arg_st = False
     comp = False
+    bytecode = False
     optimise = False
     filename = False
     cpp = False
     asm = False
     gdb = False
     keep_temp = False
+    show_macros = False
+    watch_files = False
+    engine_name = False
+    int64 = False
+    flush = False
+    profile = False
+    stats = False
 
     args = []
     outname = "a"
@@ -1494,12 +5019,19 @@ def run_program() -> None:
         elif filename:
             outname = arg
             filename = None
-        elif comp and arg == "-o":
+        elif engine_name is True:
+            if arg not in ENGINES:
+                Croak(ErrorType.Command, "unknown engine %s (expected %s)" % (arg, " or ".join(ENGINES)))
+
+            engine_name = arg
+        elif flush is True:
+            flush = flush_policy(arg)
+        elif (comp or bytecode) and arg == "-o":
             if filename is None:
                 Croak(ErrorType.Command, "cannot have two output names...")
             
             filename = True
-        elif comp and arg.startswith("-O"):
+        elif arg.startswith("-O"):
             if len(arg) != 3:
                 Croak(ErrorType.Command, "invalid flag %s" % arg)
             elif not arg[2].isnumeric():
@@ -1511,58 +5043,159 @@ def run_program() -> None:
             asm = True
         elif arg in ("-c", "-com"):
             comp = True
+        elif arg == "-b":
+            bytecode = True
         elif arg in ("-C", "-cpp"):
             cpp = True
         elif arg == "-g":
             gdb = True
         elif arg == "-t":
             keep_temp = True
+        elif arg == "-engine":
+            engine_name = True
+        elif arg == "-macros":
+            show_macros = True
+        elif arg in ("-w", "--watch"):
+            watch_files = True
+        elif arg == "--int64":
+            int64 = True
+        elif arg == "--flush":
+            flush = True
+        elif arg == "--unbuffered":
+            flush = "unbuffered"
+        elif arg == "--profile":
+            profile = True
+        elif arg == "--stats":
+            stats = True
         elif arg == "-args":
             arg_st = True
     
     if len(sys.argv) < 2:
         Croak(ErrorType.Command, "must input a file name")
     
-    if not (comp or arg_st):
+    if not (comp or bytecode or arg_st):
         args = sys.argv[1:]
-    elif comp:
+    elif comp or bytecode:
         args = [sys.argv[1]]
     
-    src = open(sys.argv[1], "r", encoding="utf-8").read()
-    
-    lex_src = Lexer(src, args[0])
-    lex_src.get_tokens()
+    engine = ENGINES[engine_name or "switch"]
 
-    if comp:
-        print("You must have g++ in order to compile pang.")
-        name = "temp.cc" if not cpp else outname + ".cc"
+    if profile and (comp or bytecode):
+        # Only the interpreter can time instructions
+        Croak(ErrorType.Command, "--profile cannot be used with %s" % ("-c" if comp else "-b"))
 
-        open(name, "w", encoding="utf-8").write(compile_ops(lex_src.toks, optimise))
-        command = "g++ %s -o %s -Werror -Bdynamic -lstdc++" % (name, outname)
+    if (profile or stats) and not comp and engine not in (Interpreter, ThreadedInterpreter):
+        # Fused and compiled code no longer runs one instruction at a time
+        Croak(ErrorType.Command, "--%s can only be used with the switch and threaded engines" % (
+            "profile" if profile else "stats"))
 
-        if gdb:
-            command += " -g"
-        else:
-            command += " -s"
+    if profile and stats:
+        # The statistics would be counted in the times
+        Croak(ErrorType.Command, "cannot use --profile and --stats together")
 
-        if optimise:
-            command += "%s" % optimise_flag
-        if asm:
-            command += " -S"
-        
-        if not cpp:
-            os.system(command)
-            if not keep_temp:
-                os.remove(name)
+    if int64:
+        if engine is not Interpreter:
+            Croak(ErrorType.Command, "--int64 can only be used with the switch engine")
+
+        engine = Int64Interpreter
+
+    if bytecode and filename is False:
+        outname = os.path.splitext(sys.argv[1])[0] + ".pangc"
+
+    def run(program: Program, sites: Optional[list[Optional[Expansion]]] = None) -> None:
+        if bytecode:
+            write_bytecode(program, outname)
+        elif comp:
+            print("You must have g++ in order to compile pang.")
+            name = "temp.cc" if not cpp else outname + ".cc"
+
+            open(name, "w", encoding="utf-8").write(compile_ops(program, optimise, stats))
+            command = "g++ %s -o %s -Werror -Bdynamic -lstdc++" % (name, outname)
+
+            if gdb:
+                command += " -g"
+            else:
+                command += " -s"
+
+            if optimise:
+                command += "%s" % optimise_flag
+            if asm:
+                command += " -S"
             
-        elif asm:
-            os.system(command)
-        
+            if not cpp:
+                os.system(command)
+                if not keep_temp:
+                    os.remove(name)
+                
+            elif asm:
+                os.system(command)
+            
+        else:
+            if optimise:
+                program, origins = fold_constants(program, engine is Int64Interpreter)
+
+                if sites is not None:
+                    sites = [sites[origin] for origin in origins]
+
+            st = perf_counter()
+            interpret = engine(args, program, flush or None)
+            profiler = Profile(program, sites) if profile else None
+            tracer = Stats(interpret) if stats else profiler
+
+            try:
+                if tracer is None:
+                    interpret.run()
+                else:
+                    interpret.run_traced(tracer)
+            finally:
+                interpret.close_outputs()
+
+            if interpret.forked:
+                # Only the original process reports, the child ends here so
+                # it never gets back to the caller (watch would keep it going)
+                sys.stderr.flush()
+                os._exit(0)
+
+            print(f"\nProgram finished in {perf_counter() - st} seconds (exit code: {interpret.exit_code}).")
+
+            if isinstance(interpret, FusedInterpreter):
+                # Kept out of the program's own output
+                print(interpret.fusion_report(), file=sys.stderr)
+
+            if profiler is not None:
+                profile_name = os.path.splitext(sys.argv[1])[0] + ".folded"
+                profiler.write_collapsed(profile_name)
+
+                # Kept out of the program's own output, like the fusion report
+                print("\n" + profiler.report(), file=sys.stderr)
+                print("Collapsed stacks written to %s." % profile_name, file=sys.stderr)
+            elif stats:
+                print("\n" + tracer.report(), file=sys.stderr)
+
+    def run_lexed(lex_src: Lexer) -> None:
+        program = Program(lex_src.toks)
+
+        if show_macros:
+            print_macro_stats(lex_src, program)
+
+        run(program, lex_src.sites)
+
+    if sys.argv[1].endswith(".pangc"):
+        if watch_files:
+            Croak(ErrorType.Command, "cannot watch a bytecode file")
+
+        run(read_bytecode(sys.argv[1]))
+    elif watch_files:
+        watch(sys.argv[1], args[0], run_lexed)
     else:
-        st = perf_counter()
-        interpret = Interpreter(args, lex_src.toks)
-        interpret.run()
-        print(f"\nProgram finished in {perf_counter() - st} seconds (exit code: {interpret.exit_code}).")
+        lex_src, program = stream_program(sys.argv[1], args[0], profile)
+        sites = lex_src.sites if profile else None
+
+        if show_macros:
+            print_macro_stats(lex_src, program)
+
+        del lex_src
+        run(program, sites)
 
 if __name__ == "__main__":
     run_program()